@@ -0,0 +1,287 @@
+"""Кэш готовых ответов по версии индекса.
+
+Ответ цепочки (temperature 0) на один и тот же вопрос по одной и той же версии
+индекса не меняется, поэтому ModelCascade сохраняет ответы в answer_cache.db и
+отдает повторные вопросы из кэша без поиска и генерации. Ключ - пространство
+имен (коллекция и версия ее индекса) и нормализованный вопрос (регистр, ё,
+пробелы и знаки в конце не важны); после публикации новой версии индекса старые
+ответы не используются и вытесняются как давно не нужные.
+
+Кэш наполняется живыми ответами и заранее - cache_warmer.py в простое отвечает
+на самые частые вопросы из activity.log и истории чатов. ACTIVITY отмечает
+запросы пользователей, чтобы прогрев уступал им сразу. Запросы идут в нескольких
+процессах (Streamlit, HTTP API), поэтому счетчик каждого процесса записывается в
+таблицу activity того же answer_cache.db, а прогревает один процесс на машине
+(аренда в таблице leases).
+"""
+import logging
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+DEFAULT_DB_PATH = "answer_cache.db"
+ANSWER_CACHE_ENV = "ANSWER_CACHE"   # "0" - не кэшировать ответы
+MAX_ENTRIES = 5000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    namespace TEXT NOT NULL,
+    question TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    source TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    used_at REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (namespace, question)
+);
+CREATE INDEX IF NOT EXISTS idx_answers_used_at ON answers(used_at);
+"""
+
+ACTIVITY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS activity (
+    owner TEXT PRIMARY KEY,
+    active INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+# Запрос дольше этого (или запрос упавшего процесса) больше не считается идущим, с
+ACTIVE_TIMEOUT = 900.0
+
+
+def normalize_question(question):
+    """Ключ вопроса: нижний регистр, ё -> е, одиночные пробелы, без знаков в конце"""
+    text = re.sub(r"\s+", " ", question.lower().replace("ё", "е")).strip()
+    return text.rstrip(" ?!.")
+
+
+def index_namespace(name, index_dir):
+    """Пространство имен кэша для индекса: имя и отметка версии (папка и время записи индекса)"""
+    stamp = 0
+    for file in ("index.faiss", "shards.json"):
+        path = os.path.join(index_dir, file)
+        if os.path.exists(path):
+            stamp = int(os.path.getmtime(path))
+            break
+    return f"{name}={os.path.basename(os.path.normpath(index_dir))}@{stamp}"
+
+
+class AnswerCache:
+    """Ответы в SQLite (answer_cache.db), общие для процессов Streamlit и HTTP API"""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, max_entries=MAX_ENTRIES):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0}
+        self._stats_lock = threading.Lock()
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, key):
+        with self._stats_lock:
+            self._stats[key] += 1
+
+    def get(self, namespace, question):
+        key = normalize_question(question)
+        conn = self._connection()
+        row = conn.execute("SELECT answer FROM answers WHERE namespace = ? AND question = ?",
+                           (namespace, key)).fetchone()
+        if row is None:
+            self._count("misses")
+            return None
+        conn.execute("UPDATE answers SET hits = hits + 1, used_at = ? WHERE namespace = ? AND question = ?",
+                     (time.time(), namespace, key))
+        self._count("hits")
+        return row[0]
+
+    def contains(self, namespace, question):
+        return self._connection().execute(
+            "SELECT 1 FROM answers WHERE namespace = ? AND question = ?",
+            (namespace, normalize_question(question))).fetchone() is not None
+
+    def put(self, namespace, question, answer, source="live"):
+        """source - live (ответ пользователю) или warm (прогрев)"""
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO answers (namespace, question, answer, source, created_at, used_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (namespace, normalize_question(question), answer, source, datetime.now().isoformat(), time.time()),
+        )
+        # Давно не использованные ответы (в том числе старых версий индекса) вытесняются
+        conn.execute("DELETE FROM answers WHERE rowid IN (SELECT rowid FROM answers ORDER BY used_at DESC "
+                     "LIMIT -1 OFFSET ?)", (self.max_entries,))
+        self._count("stores")
+
+    def bind(self, namespace):
+        return BoundAnswerCache(self, namespace)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["entries"] = self._connection().execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        return stats
+
+
+class BoundAnswerCache:
+    """Кэш одного пространства имен; answer() - в интерфейсе источников ответов без LLM ModelCascade"""
+
+    def __init__(self, cache, namespace):
+        self.cache = cache
+        self.namespace = namespace
+
+    def answer(self, question, metadata_filter=None):
+        return self.cache.get(self.namespace, question)
+
+    def contains(self, question):
+        return self.cache.contains(self.namespace, question)
+
+    def put(self, question, answer, source="live"):
+        self.cache.put(self.namespace, question, answer, source)
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_cache():
+    """Кэш ответов процесса или None, если он отключен (ANSWER_CACHE=0)"""
+    global _shared
+    if os.environ.get(ANSWER_CACHE_ENV) == "0":
+        return None
+    with _shared_lock:
+        if _shared is None:
+            _shared = AnswerCache()
+        return _shared
+
+
+def index_cache(name, index_dir):
+    """Кэш ответов цепочки индекса (пространство имен - его версия) или None, если кэш отключен"""
+    cache = shared_cache()
+    return cache.bind(index_namespace(name, index_dir)) if cache is not None else None
+
+
+class RequestActivity:
+    """Запросы пользователей всех процессов на машине: прогрев кэша идет только в простое.
+
+    Счетчик процесса дублируется в таблицу activity answer_cache.db; без кэша ответов
+    (ANSWER_CACHE=0) прогрева нет, и счетчик остается только в процессе.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        self.db_path = db_path
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._active = 0
+        self._last = 0.0
+
+    def _shared(self):
+        return os.environ.get(ANSWER_CACHE_ENV) != "0"
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            conn.executescript(ACTIVITY_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def _publish(self):
+        # Под self._lock: записи процесса идут в порядке изменений счетчика
+        if not self._shared():
+            return
+        try:
+            conn = self._connection()
+            conn.execute("INSERT OR REPLACE INTO activity (owner, active, updated_at) VALUES (?, ?, ?)",
+                         (self.owner, self._active, self._last))
+            conn.execute("DELETE FROM activity WHERE updated_at < ?", (self._last - ACTIVE_TIMEOUT,))
+        except sqlite3.Error as e:
+            logging.warning(f"Request activity update error: {e}")
+
+    @contextmanager
+    def request(self):
+        with self._lock:
+            self._active += 1
+            self._last = time.time()
+            self._publish()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._last = time.time()
+                self._publish()
+
+    def _others(self):
+        """(идущие запросы, время последнего изменения) других процессов"""
+        if not self._shared():
+            return 0, 0.0
+        try:
+            active, last = self._connection().execute(
+                "SELECT COALESCE(SUM(CASE WHEN updated_at > ? THEN active ELSE 0 END), 0), "
+                "COALESCE(MAX(updated_at), 0) FROM activity WHERE owner != ?",
+                (time.time() - ACTIVE_TIMEOUT, self.owner)).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Request activity read error: {e}")
+            return 0, 0.0
+        return active, last
+
+    @property
+    def active(self):
+        """Идущие запросы всех процессов"""
+        return self._active or self._others()[0]
+
+    def idle_for(self):
+        """Секунд без запросов во всех процессах (0, пока запрос выполняется)"""
+        if self._active:
+            return 0.0
+        active, last = self._others()
+        return 0.0 if active else time.time() - max(self._last, last)
+
+    def lease(self, name, ttl):
+        """Занимает или продлевает на ttl секунд аренду name; False - ее держит другой процесс"""
+        if not self._shared():
+            return True
+        now = time.time()
+        try:
+            cursor = self._connection().execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                (name, self.owner, now + ttl, now))
+        except sqlite3.Error as e:
+            logging.warning(f"Lease error - {name}: {e}")
+            return False
+        return cursor.rowcount > 0
+
+    def release(self, name):
+        if not self._shared():
+            return
+        try:
+            self._connection().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, self.owner))
+        except sqlite3.Error as e:
+            logging.warning(f"Lease release error - {name}: {e}")
+
+
+ACTIVITY = RequestActivity()
@@ -1,24 +1,334 @@
 import streamlit as st
 import os
+import logging
 import fitz
 import time
-from datetime import datetime
+from functools import partial
+from datetime import datetime, date, timedelta
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
-from chain_factory import create_rag_chain, create_tt_chain
-from async_handlers import process_search_request_async, process_tt_request_async
+from answer_cache import ACTIVITY
+from index_manager import current_index_dir, load_chain_resources
+from query_router import route_question
+from async_handlers import process_search_request_async, process_tt_section_regeneration_async
+from job_queue import ACTIVE_STATUSES, QUEUED, DONE, JobLostError
 from web_interface import (
     load_css, init_theme, toggle_theme, apply_theme,
-    load_chat_history, save_chat_history, create_new_chat, update_chat_title,
+    get_cache_warmer, get_chat_store, get_collection_cache, get_embeddings, get_index_manager, get_job_manager,
+    update_chat_title,
+    render_message_html,
     check_word_export_request, generate_word_document
 )
 
+# Размер страницы списка чатов и результатов поиска по истории
+CHAT_LIST_PAGE_SIZE = 50
+# Сколько последних сообщений чата показывать сразу
+MESSAGES_PAGE_SIZE = 20
+
+
 # Streamlit app
 def clear_chat():
     st.session_state.messages = []
-    if os.path.exists("chat_history.json"):
-        os.remove("chat_history.json")
+    get_chat_store().clear()
+
+
+def select_chat(store, chat_id):
+    """Делает чат текущим и лениво загружает его сообщения"""
+    st.session_state.current_chat_id = chat_id
+    st.session_state.messages = store.get_messages(chat_id)
+    st.session_state.messages_chat_id = chat_id
+    st.session_state.visible_messages = MESSAGES_PAGE_SIZE
+    store.set_setting("current_chat_id", chat_id)
+
+
+def make_tt_job_handler(tt_engine, store):
+    """Обработчик фоновой задачи ТТ: разделы сохраняются по мере готовности, итог - в чат"""
+    def handler(job, report):
+        texts = {}
+        total = len(tt_engine.sections)
+        result = None
+        try:
+            for index, heading, text in tt_engine.stream_sections(job["prompt"]):
+                texts[index] = text
+                report(len(texts) / total, {"texts": texts})
+            result = tt_engine.assemble(texts)
+        except JobLostError:
+            # Задачу выполняет другой процесс - сообщение в чат добавит он
+            raise
+        except Exception as e:
+            result = f"Ошибка генерации ТТ: {e}"
+            raise
+        finally:
+            if result is not None and job["chat_id"] and store.get_chat(job["chat_id"]) is not None:
+                store.append_message(job["chat_id"], "assistant", result)
+        return result
+    return handler
+
+
+def attach_job(job_id):
+    """Привязывает сессию к фоновой задаче; id сохраняется в URL и переживает обновление страницы"""
+    st.session_state.active_job = job_id
+    st.query_params["job"] = job_id
+
+
+def detach_job():
+    st.session_state.active_job = None
+    if "job" in st.query_params:
+        del st.query_params["job"]
+
+
+@st.fragment(run_every=2)
+def render_active_job(jobs):
+    """Статус, прогресс и готовые разделы выполняющейся задачи ТТ (опрос каждые 2 с)"""
+    job = jobs.get(st.session_state.active_job)
+    if job is None:
+        detach_job()
+        return
+
+    if job["status"] in ACTIVE_STATUSES:
+        if job["status"] == QUEUED:
+            status_text = f"Генерация ТТ в очереди (задач впереди: {jobs.queue_position(job['id'])})"
+        else:
+            status_text = f"Генерация ТТ: готово {int(job['progress'] * 100)}%"
+        st.markdown(f"""
+        <div class="status-indicator">
+            <div class="status-dot"></div>
+            <span>{status_text}</span>
+        </div>
+        <div class="progress-container">
+            <div class="progress-bar" style="width: {int(job['progress'] * 100)}%;"></div>
+        </div>
+        """, unsafe_allow_html=True)
+        texts = job_texts(job)
+        if texts:
+            st.markdown(
+                render_message_html({"role": "assistant", "content": st.session_state.tt_chain.assemble(texts)}),
+                unsafe_allow_html=True
+            )
+        return
+
+    # Задача завершена: результат (или ошибка) уже добавлен в чат рабочим потоком
+    detach_job()
+    if job["status"] == DONE:
+        st.session_state.last_tt = {
+            "chat_id": job["chat_id"],
+            "question": job["prompt"],
+            "texts": job_texts(job),
+        }
+    st.session_state.messages_chat_id = None  # перечитать сообщения чата
+    st.rerun()
+
+
+def job_texts(job):
+    """Готовые разделы задачи ТТ: номер раздела -> текст"""
+    partial = job.get("partial") or {}
+    return {int(index): text for index, text in partial.get("texts", {}).items()}
+
+
+@st.cache_data(max_entries=32)
+def job_word_document(job_id, result, prompt):
+    return generate_word_document(result, prompt, "Генерация ТТ").getvalue()
+
+
+def render_job_exports(jobs):
+    """Кнопки скачивания в Word для завершенных ТТ текущего чата"""
+    for job in jobs.list_jobs(chat_id=st.session_state.current_chat_id, statuses=(DONE,), limit=3):
+        title = job["prompt"][:40] + ("..." if len(job["prompt"]) > 40 else "")
+        st.download_button(
+            label=f"📝 Скачать ТТ в Word: {title}",
+            data=job_word_document(job["id"], job["result"], job["prompt"]),
+            file_name=f"ТТ_{job['created_at'][:19].replace(':', '').replace('-', '')}.docx",
+            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+            key=f"job_export_{job['id']}"
+        )
+
+
+def render_tt_regeneration(store):
+    """Перегенерация одного раздела последних ТТ без повтора остальных"""
+    last_tt = st.session_state.get("last_tt")
+    if not last_tt or last_tt["chat_id"] != st.session_state.current_chat_id:
+        return
+    tt_engine = st.session_state.tt_chain
+    with st.expander("🔄 Перегенерировать раздел ТТ"):
+        index = st.selectbox(
+            "Раздел",
+            range(len(tt_engine.sections)),
+            format_func=lambda i: f"{i + 1}. {tt_engine.sections[i][0]}",
+            key="tt_regenerate_section"
+        )
+        if st.button("Перегенерировать", key="tt_regenerate"):
+            with st.spinner(f"Генерация раздела {index + 1}..."):
+                texts = process_tt_section_regeneration_async(
+                    tt_engine, last_tt["question"], index, last_tt["texts"]
+                )
+                if isinstance(texts, str):
+                    response = texts
+                else:
+                    response = tt_engine.assemble(texts)
+                    last_tt["texts"] = texts
+            st.session_state.messages.append(
+                store.append_message(st.session_state.current_chat_id, "assistant", response)
+            )
+            st.rerun()
+
+
+def _show_more_chats():
+    st.session_state.chat_list_pages += 1
+
+
+def _show_earlier_messages():
+    st.session_state.visible_messages = st.session_state.get("visible_messages", MESSAGES_PAGE_SIZE) + MESSAGES_PAGE_SIZE
+
+
+@st.fragment
+def render_sidebar(store):
+    """Боковая панель со списком чатов.
+
+    Фрагмент: ввод в поиске и листание списка перерисовывают только панель.
+    Переключение, создание и удаление чата перезапускают всю страницу.
+    """
+    # Заголовок боковой панели
+    st.markdown("""
+    <div class="sidebar-header">
+        <h3>📋 Управление чатами</h3>
+    </div>
+    """, unsafe_allow_html=True)
+
+    # Новый чат
+    if st.button("➕ Новый чат", use_container_width=True):
+        select_chat(store, store.create_chat())
+        st.rerun()
+
+    # История чатов
+    st.markdown("### 📂 История чатов")
+
+    # Поиск по чатам
+    search_query = st.text_input(
+        "Поиск чатов",
+        placeholder="🔍 Поиск чатов...",
+        key="chat_search",
+        label_visibility="collapsed"
+    )
+
+    # Новый запрос - список снова с первой страницы
+    if st.session_state.get("chat_search_query") != search_query:
+        st.session_state.chat_search_query = search_query
+        st.session_state.chat_list_pages = 1
+
+    # Список чатов с прокруткой, постранично
+    list_limit = CHAT_LIST_PAGE_SIZE * st.session_state.chat_list_pages
+    if search_query:
+        # Полнотекстовый поиск по заголовкам и сообщениям, результаты по релевантности
+        chats = store.search_chats(search_query, limit=list_limit + 1)
+    else:
+        chats = store.list_chats(limit=list_limit + 1)
+    has_more_results = len(chats) > list_limit
+    chats = chats[:list_limit]
+
+    if chats:
+        # Чаты уже отсортированы (по релевантности или по времени обновления)
+        filtered_chats = [(chat["id"], chat) for chat in chats]
+
+        if search_query:
+            grouped_chats = {"Результаты поиска": filtered_chats}
+        else:
+            # Группируем чаты по датам
+            today = date.today()
+            yesterday = today - timedelta(days=1)
+
+            grouped_chats = {
+                "Сегодня": [],
+                "Вчера": [],
+                "Ранее": []
+            }
+
+            for chat_id, chat in filtered_chats:
+                try:
+                    updated_date = datetime.fromisoformat(chat["updated_at"]).date()
+                    if updated_date == today:
+                        grouped_chats["Сегодня"].append((chat_id, chat))
+                    elif updated_date == yesterday:
+                        grouped_chats["Вчера"].append((chat_id, chat))
+                    else:
+                        grouped_chats["Ранее"].append((chat_id, chat))
+                except:
+                    grouped_chats["Ранее"].append((chat_id, chat))
+
+        # Контейнер с прокруткой для списка чатов
+        with st.container(height=500):
+            for group_name, group_chats in grouped_chats.items():
+                if group_chats:  # Показываем группу только если есть чаты
+                    st.markdown(f"**{group_name}**")
+
+                    for chat_id, chat in group_chats:
+                        # Определяем, является ли этот чат текущим
+                        is_current = chat_id == st.session_state.current_chat_id
+
+                        # Компактная карточка чата
+                        col1, col2 = st.columns([1, 0.2])
+                        with col1:
+                            if st.button(
+                                chat['title'][:30] + "..." if len(chat['title']) > 30 else chat['title'],
+                                key=f"chat_{chat_id}",
+                                use_container_width=True,
+                                type="primary" if is_current else "secondary"
+                            ):
+                                # Переключаемся на выбранный чат
+                                select_chat(store, chat_id)
+                                st.rerun()
+
+                        with col2:
+                            # Кнопка удаления чата
+                            if st.button("🗑️", key=f"delete_{chat_id}", help="Удалить чат"):
+                                store.delete_chat(chat_id)
+                                # Если удаляем текущий чат, переключаемся на другой
+                                if chat_id == st.session_state.current_chat_id:
+                                    remaining_chats = store.list_chats(limit=1)
+                                    if remaining_chats:
+                                        select_chat(store, remaining_chats[0]["id"])
+                                    else:
+                                        # Создаем новый чат если не осталось
+                                        select_chat(store, store.create_chat())
+                                st.rerun()
+
+                        # Фрагмент сообщения, в котором найдено совпадение
+                        if chat.get("snippet") and chat["snippet"] != chat["title"]:
+                            st.caption(chat["snippet"])
+
+                    st.markdown("---")  # Разделитель между группами
+
+            if has_more_results:
+                st.button("Показать ещё", key="chat_list_more", use_container_width=True,
+                          on_click=_show_more_chats)
+    elif search_query:
+        st.write("Ничего не найдено")
+    else:
+        st.write("История пуста")
+
+    # Переключатель темы
+    st.markdown("---")
+    st.markdown("**Тема**")
+    theme_icon = "☀️" if st.session_state.get("theme", "light") == "light" else "🌙"
+    if st.button(theme_icon, key="theme_toggle", help="Переключить тему"):
+        toggle_theme()
+        st.rerun()
+
+
+@st.fragment
+def render_chat_messages():
+    """Сообщения текущего чата: последние MESSAGES_PAGE_SIZE, более ранние - по кнопке"""
+    messages = st.session_state.messages
+    visible = st.session_state.get("visible_messages", MESSAGES_PAGE_SIZE)
+    hidden = max(0, len(messages) - visible)
+    if hidden:
+        st.button(f"⬆ Показать предыдущие сообщения ({hidden})", key="show_earlier_messages",
+                  on_click=_show_earlier_messages)
+
+    # Одним элементом: HTML каждого сообщения берется из кэша
+    st.markdown(
+        "".join(render_message_html(message) for message in messages[hidden:]),
+        unsafe_allow_html=True
+    )
+
 
 def main():
     st.set_page_config(layout="wide")
@@ -137,21 +447,32 @@ def main():
     </style>
     """, unsafe_allow_html=True)
 
-    # Инициализация структуры чатов
-    if "chat_data" not in st.session_state:
-        st.session_state.chat_data = load_chat_history()
-
-    # Если нет текущего чата, создаем новый
-    if not st.session_state.chat_data.get("current_chat_id"):
-        chat_id, chat = create_new_chat()
-        st.session_state.chat_data["chats"][chat_id] = chat
-        st.session_state.chat_data["current_chat_id"] = chat_id
-        save_chat_history(st.session_state.chat_data)
-
-    # Получаем текущий чат
-    current_chat_id = st.session_state.chat_data["current_chat_id"]
-    current_chat = st.session_state.chat_data["chats"][current_chat_id]
-    st.session_state.messages = current_chat["messages"]
+    # Инициализация хранилища чатов
+    store = get_chat_store()
+    if "current_chat_id" not in st.session_state:
+        st.session_state.current_chat_id = store.get_setting("current_chat_id")
+
+    # Если нет текущего чата (или он удален в другой сессии), создаем новый
+    if not st.session_state.current_chat_id or store.get_chat(st.session_state.current_chat_id) is None:
+        select_chat(store, store.create_chat())
+
+    # Повторное подключение к фоновой задаче ТТ после обновления страницы
+    jobs = get_job_manager()
+    if "active_job" not in st.session_state:
+        st.session_state.active_job = None
+        job = jobs.get(st.query_params["job"]) if "job" in st.query_params else None
+        if job is None:
+            # Незавершенная задача в текущем чате (например, вкладка была закрыта)
+            active = jobs.list_jobs(chat_id=st.session_state.current_chat_id, statuses=ACTIVE_STATUSES, limit=1)
+            job = active[0] if active else None
+        if job is not None:
+            attach_job(job["id"])
+            if job["chat_id"] and job["chat_id"] != st.session_state.current_chat_id and store.get_chat(job["chat_id"]):
+                select_chat(store, job["chat_id"])
+
+    # Сообщения загружаются только для открытого чата
+    if st.session_state.get("messages_chat_id") != st.session_state.current_chat_id:
+        select_chat(store, st.session_state.current_chat_id)
 
     # Set default mode if not set
     if "mode" not in st.session_state:
@@ -159,191 +480,72 @@ def main():
 
     # Sidebar for new chat and mode selection
     with st.sidebar:
-        # Заголовок боковой панели
-        st.markdown("""
-        <div class="sidebar-header">
-            <h3>📋 Управление чатами</h3>
+        render_sidebar(store)
+
+    # Загрузка векторного хранилища: снимок текущей версии индексов процесса.
+    # После пересборки индекса новые запросы берут новую версию, начатые дорабатывают на старой.
+    if st.session_state.get("index_version") is None:
+        loading_progress_placeholder = st.empty()
+        loading_status_placeholder = st.empty()
+        loading_progress_placeholder.progress(0)
+        loading_status_placeholder.markdown("""
+        <div class="status-indicator">
+            <div class="status-dot"></div>
+            <span>Загрузка индексов документов...</span>
         </div>
         """, unsafe_allow_html=True)
 
-        # Новый чат
-        if st.button("➕ Новый чат", use_container_width=True):
-            chat_id, chat = create_new_chat()
-            st.session_state.chat_data["chats"][chat_id] = chat
-            st.session_state.chat_data["current_chat_id"] = chat_id
-            save_chat_history(st.session_state.chat_data)
-            st.rerun()
-
-        # История чатов
-        st.markdown("### 📂 История чатов")
-
-        # Поиск по чатам
-        search_query = st.text_input(
-            "Поиск чатов",
-            placeholder="🔍 Поиск чатов...",
-            key="chat_search",
-            label_visibility="collapsed"
-        )
-
-        # Список чатов с прокруткой
-        chats = st.session_state.chat_data["chats"]
-        if chats:
-            # Сортируем чаты по времени обновления (новые сверху)
-            sorted_chats = sorted(chats.items(), key=lambda x: x[1]["updated_at"], reverse=True)
-
-            # Фильтруем чаты по поисковому запросу
-            if search_query:
-                filtered_chats = [
-                    (chat_id, chat) for chat_id, chat in sorted_chats
-                    if search_query.lower() in chat["title"].lower()
-                ]
-            else:
-                filtered_chats = sorted_chats
-
-            # Группируем чаты по датам
-            from datetime import datetime, date, timedelta
-
-            today = date.today()
-            yesterday = today - timedelta(days=1)
-
-            grouped_chats = {
-                "Сегодня": [],
-                "Вчера": [],
-                "Ранее": []
-            }
-
-            for chat_id, chat in filtered_chats:
-                try:
-                    updated_date = datetime.fromisoformat(chat["updated_at"]).date()
-                    if updated_date == today:
-                        grouped_chats["Сегодня"].append((chat_id, chat))
-                    elif updated_date == yesterday:
-                        grouped_chats["Вчера"].append((chat_id, chat))
-                    else:
-                        grouped_chats["Ранее"].append((chat_id, chat))
-                except:
-                    grouped_chats["Ранее"].append((chat_id, chat))
-
-            # Контейнер с прокруткой для списка чатов
-            with st.container(height=500):
-                for group_name, group_chats in grouped_chats.items():
-                    if group_chats:  # Показываем группу только если есть чаты
-                        st.markdown(f"**{group_name}**")
-
-                        for chat_id, chat in group_chats:
-                            # Определяем, является ли этот чат текущим
-                            is_current = chat_id == st.session_state.chat_data["current_chat_id"]
-
-                            # Компактная карточка чата
-                            col1, col2 = st.columns([1, 0.2])
-                            with col1:
-                                if st.button(
-                                    chat['title'][:30] + "..." if len(chat['title']) > 30 else chat['title'],
-                                    key=f"chat_{chat_id}",
-                                    use_container_width=True,
-                                    type="primary" if is_current else "secondary"
-                                ):
-                                    # Переключаемся на выбранный чат
-                                    st.session_state.chat_data["current_chat_id"] = chat_id
-                                    save_chat_history(st.session_state.chat_data)
-                                    st.rerun()
-
-                            with col2:
-                                # Кнопка удаления чата
-                                if st.button("🗑️", key=f"delete_{chat_id}", help="Удалить чат"):
-                                    if chat_id in st.session_state.chat_data["chats"]:
-                                        del st.session_state.chat_data["chats"][chat_id]
-                                        # Если удаляем текущий чат, переключаемся на другой
-                                        if chat_id == st.session_state.chat_data["current_chat_id"]:
-                                            remaining_chats = list(st.session_state.chat_data["chats"].keys())
-                                            if remaining_chats:
-                                                st.session_state.chat_data["current_chat_id"] = remaining_chats[0]
-                                            else:
-                                                # Создаем новый чат если не осталось
-                                                new_chat_id, new_chat = create_new_chat()
-                                                st.session_state.chat_data["chats"][new_chat_id] = new_chat
-                                                st.session_state.chat_data["current_chat_id"] = new_chat_id
-                                        save_chat_history(st.session_state.chat_data)
-                                        st.rerun()
-
-                        st.markdown("---")  # Разделитель между группами
-        else:
-            st.write("История пуста")
-
-        # Переключатель темы
-        st.markdown("---")
-        st.markdown("**Тема**")
-        theme_icon = "☀️" if st.session_state.get("theme", "light") == "light" else "🌙"
-        if st.button(theme_icon, key="theme_toggle", help="Переключить тему"):
-            toggle_theme()
-            st.rerun()
-
-    # Загрузка векторного хранилища
-    if "vectorstore" not in st.session_state or "tt_vectorstore" not in st.session_state:
-        with st.spinner(""):
-            # Показываем прогресс бар
-            loading_progress_placeholder = st.empty()
-            loading_status_placeholder = st.empty()
-            loading_progress_placeholder.progress(0)
-            loading_status_placeholder.markdown("""
-            <div class="status-indicator">
-                <div class="status-dot"></div>
-                <span>Загрузка индексов документов...</span>
-            </div>
-            """, unsafe_allow_html=True)
-
-            try:
-                embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/paraphrase-multilingual-mpnet-base-v2")
-            except Exception as e:
-                st.error(f"Ошибка загрузки модели эмбеддингов: {e}")
-                st.error("Попробуйте перезапустить приложение или проверить подключение к интернету.")
-                return
-
-            # Загрузка нормативного индекса
-            loading_progress_placeholder.progress(25)
-            if not os.path.exists("./faiss_index"):
-                st.error("Индекс нормативных документов не найден. Сначала запустите main.py для создания индексов.")
-                return
-            normative_vectorstore = FAISS.load_local("./faiss_index", embeddings, allow_dangerous_deserialization=True)
-            st.session_state.vectorstore = normative_vectorstore
-
-            # Загрузка TT индекса
-            loading_progress_placeholder.progress(75)
-            if os.path.exists("./faiss_index_tt"):
-                tt_vectorstore = FAISS.load_local("./faiss_index_tt", embeddings, allow_dangerous_deserialization=True)
-                st.session_state.tt_vectorstore = tt_vectorstore
-            else:
-                st.session_state.tt_vectorstore = normative_vectorstore  # fallback
-                st.warning("Индекс ТТ документов не найден. Используется нормативный индекс для ТТ.")
-
-            loading_progress_placeholder.progress(100)
-            st.session_state.qa_chain = create_rag_chain(st.session_state.vectorstore)
-            st.session_state.tt_chain = create_tt_chain(st.session_state.tt_vectorstore)
-
+    try:
+        embeddings = get_embeddings()
+    except Exception as e:
+        st.error(f"Ошибка загрузки модели эмбеддингов: {e}")
+        st.error("Попробуйте перезапустить приложение или проверить подключение к интернету.")
+        return
+
+    if not os.path.exists(current_index_dir("./faiss_index")):
+        st.error("Индекс нормативных документов не найден. Сначала запустите main.py для создания индексов.")
+        return
+    index_manager = get_index_manager(partial(load_chain_resources, embeddings))
+    snapshot = index_manager.current()
+    collections = get_collection_cache(embeddings, index_manager)
+    get_cache_warmer(index_manager)
+
+    if st.session_state.get("index_version") != snapshot.version:
+        first_load = st.session_state.get("index_version") is None
+        resources = snapshot.resources
+        st.session_state.vectorstore = resources["vectorstore"]
+        st.session_state.tt_vectorstore = resources["tt_vectorstore"]
+        st.session_state.qa_chain = resources["qa_chain"]
+        st.session_state.tt_chain = resources["tt_chain"]
+        jobs.register_handler("tt", make_tt_job_handler(st.session_state.tt_chain, store))
+        st.session_state.index_version = snapshot.version
+
+        if first_load:
             loading_progress_placeholder.empty()
             loading_status_placeholder.empty()
-
+            if resources["tt_vectorstore"] is resources["vectorstore"]:
+                st.warning("Индекс ТТ документов не найден. Используется нормативный индекс для ТТ.")
             # Устанавливаем флаг, что загрузка завершена
             st.session_state.indexes_loaded = True
             st.rerun()  # Перезагружаем страницу, чтобы скрыть сообщение о загрузке
 
+    # Коллекция для поиска (ТТ всегда по своему индексу); список - из collections.json
+    search_collections = {name: title for name, title in collections.titles().items() if name != "tt"}
+    if len(search_collections) > 1:
+        with st.sidebar:
+            st.selectbox("Коллекция для поиска", list(search_collections), key="collection",
+                         format_func=search_collections.get)
+
     # Отображение сообщений чата
     st.markdown('<div class="chat-container">', unsafe_allow_html=True)
 
-    for message in st.session_state.messages:
-        message_class = "user" if message["role"] == "user" else "assistant"
-        avatar_class = "user-avatar" if message["role"] == "user" else "assistant-avatar"
-        avatar_text = "U" if message["role"] == "user" else "AI"
+    render_chat_messages()
 
-        st.markdown(f"""
-        <div class="chat-message {message_class}">
-            <div class="message-avatar {avatar_class}">{avatar_text}</div>
-            <div class="message-content">
-                {message["content"].replace(chr(10), '<br>')}
-                <div class="message-time">{datetime.now().strftime("%H:%M")}</div>
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
+    if st.session_state.get("indexes_loaded", False):
+        if st.session_state.active_job:
+            render_active_job(jobs)
+        render_tt_regeneration(store)
+        render_job_exports(jobs)
 
     # Placeholder for status during search
     st.session_state.status_placeholder = st.empty()
@@ -387,15 +589,28 @@ def main():
         # Проверка на запрос экспорта в Word
         word_export_requested = check_word_export_request(prompt)
 
-        # Добавление сообщения пользователя
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        # Добавление сообщения пользователя (сразу сохраняется в хранилище)
+        current_chat_id = st.session_state.current_chat_id
+        st.session_state.messages.append(store.append_message(current_chat_id, "user", prompt))
 
         # Определение режима
+        retrieved = None
+        collection = st.session_state.get("collection", "normative")
         if st.session_state.mode == "Автоматично":
-            is_tt_mode = (
-                prompt.strip().startswith('/tt') or
-                any(word in prompt.lower() for word in ['требования', 'ТТ', 'технические требования', 'генерировать тт'])
-            )
+            # По /tt или по тому, в каком индексе нашлись более релевантные фрагменты: ТТ или
+            # выбранной коллекции; найденное в коллекции переиспользуется цепочкой ответа
+            try:
+                # Поиски маршрутизации - тоже запрос пользователя: прогрев кэша уступает им
+                with ACTIVITY.request():
+                    search_chain = st.session_state.qa_chain
+                    if collection != "normative":
+                        search_chain = collections.get(collection)["qa_chain"]
+                    decision = route_question(prompt, search_chain, st.session_state.tt_vectorstore)
+                is_tt_mode = decision.mode == "tt"
+                retrieved = decision.retrieved
+            except Exception as e:
+                logging.error(f"Auto route error: {e}")
+                is_tt_mode = prompt.strip().startswith('/tt')
         elif st.session_state.mode == "Генерация ТТ":
             is_tt_mode = True
         else:
@@ -403,6 +618,16 @@ def main():
 
         chain = st.session_state.tt_chain if is_tt_mode else st.session_state.qa_chain
         mode_name = "Генерация ТТ" if is_tt_mode else "Поиск информации"
+        if not is_tt_mode and collection != "normative":
+            mode_name = f"Поиск: {search_collections[collection]}"
+
+        if is_tt_mode:
+            # ТТ генерируется фоновой задачей: обновление страницы или закрытие вкладки ее не прерывает,
+            # результат появится в чате, а скачать его в Word можно и позже
+            attach_job(jobs.submit("tt", prompt, chat_id=current_chat_id))
+            if len(st.session_state.messages) == 1:
+                store.update_title(current_chat_id, update_chat_title(current_chat_id, st.session_state.messages))
+            st.rerun()
 
         # Генерация ответа
         with st.spinner(""):
@@ -422,10 +647,10 @@ def main():
             """, unsafe_allow_html=True)
 
             try:
-                if is_tt_mode:
-                    response = process_tt_request_async(chain, prompt)
-                else:
-                    response = process_search_request_async(chain, prompt)
+                if not is_tt_mode and collection != "normative":
+                    # Индекс коллекции загружается при первом вопросе к ней
+                    chain = collections.get(collection)["qa_chain"]
+                response = process_search_request_async(chain, prompt, retrieved)
 
                 # Обновляем прогресс
                 st.session_state.progress_placeholder.markdown("""
@@ -442,8 +667,8 @@ def main():
             st.session_state.status_placeholder.empty()
             st.session_state.progress_placeholder.empty()
 
-        # Add message to session state
-        st.session_state.messages.append({"role": "assistant", "content": response})
+        # Add message to session state and the chat store
+        st.session_state.messages.append(store.append_message(current_chat_id, "assistant", response))
 
         # Если запрошен экспорт в Word, показываем кнопку скачивания
         if word_export_requested and not response.startswith("Ошибка:"):
@@ -458,18 +683,10 @@ def main():
                 mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
             )
 
-        # Обновляем текущий чат в структуре данных
-        current_chat_id = st.session_state.chat_data["current_chat_id"]
-        st.session_state.chat_data["chats"][current_chat_id]["messages"] = st.session_state.messages
-        st.session_state.chat_data["chats"][current_chat_id]["updated_at"] = datetime.now().isoformat()
-
         # Обновляем заголовок чата, если это первое сообщение
         if len(st.session_state.messages) == 2:  # пользователь + ответ
             new_title = update_chat_title(current_chat_id, st.session_state.messages)
-            st.session_state.chat_data["chats"][current_chat_id]["title"] = new_title
-
-        # Сохраняем всю структуру чатов
-        save_chat_history(st.session_state.chat_data)
+            store.update_title(current_chat_id, new_title)
 
         # Перезагружаем страницу, чтобы отобразить новое сообщение в чате
         st.rerun()
@@ -1,5 +1,6 @@
 import os
 import logging
+import threading
 import concurrent.futures
 from langchain_core.prompts import PromptTemplate
 from langchain_core.runnables import RunnablePassthrough
@@ -17,10 +18,15 @@ import atexit
 atexit.register(shutdown_request_executor)
 
 
-def process_search_request_async(search_chain, question):
-    """Асинхронная обработка поискового запроса с использованием глобального ThreadPoolExecutor"""
+def process_search_request_async(search_chain, question, retrieved=None):
+    """Асинхронная обработка поискового запроса с использованием глобального ThreadPoolExecutor.
+
+    retrieved - результат поиска, уже выполненного при выборе режима (передается в цепочку).
+    """
     def _sync_invoke():
         try:
+            if retrieved is not None:
+                return search_chain.invoke(question, retrieved=retrieved)
             return search_chain.invoke(question)
         except Exception as e:
             logging.error(f"Error in search request processing: {e}")
@@ -55,3 +61,21 @@ def process_tt_request_async(tt_chain, question):
         return "Превышено время ожидания генерации ТТ. Попробуйте сформулировать запрос проще."
     except Exception as e:
         return f"Ошибка генерации ТТ: {str(e)}"
+
+
+def process_tt_section_regeneration_async(tt_engine, question, index, texts):
+    """Перегенерация одного раздела ТТ в глобальном пуле потоков.
+
+    Возвращает обновленный словарь разделов или строку с сообщением об ошибке.
+    """
+    cancelled = threading.Event()
+    future = REQUEST_EXECUTOR.submit(tt_engine.regenerate_section, question, index, texts, cancelled.is_set)
+    try:
+        return future.result(timeout=240)
+    except concurrent.futures.TimeoutError:
+        # Генерация раздела прерывается, чтобы не занимать LLM после ответа пользователю
+        cancelled.set()
+        return "Превышено время ожидания генерации раздела ТТ. Попробуйте перегенерировать раздел позже."
+    except Exception as e:
+        logging.error(f"Error in TT section regeneration: {e}")
+        return f"Ошибка перегенерации раздела ТТ: {str(e)}"
@@ -0,0 +1,151 @@
+"""Пакетный режим ответов на вопросы с возобновляемым JSONL вводом/выводом.
+
+    python main.py --batch questions.jsonl --mode search|rag|tt --out answers.jsonl
+
+Входной файл: по одному JSON-объекту на строку, {"id": ..., "question": ...}
+(поле id необязательно - по умолчанию номер строки). Результаты дописываются
+в выходной файл по мере готовности; при повторном запуске вопросы, для которых
+уже есть успешный ответ, пропускаются.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import concurrent.futures
+
+from chain_factory import get_mode_settings, create_generation_chain
+from retrievers import batch_search, scored_search, select_context
+
+# Размер пачки при кодировании вопросов
+ENCODE_BATCH_SIZE = 64
+
+
+def read_questions(path):
+    """Читает вопросы из JSONL файла"""
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Пропущена строка {line_no}: некорректный JSON ({e})")
+                continue
+            if isinstance(record, str):
+                record = {"question": record}
+            question = record.get("question") or record.get("text")
+            if not question:
+                print(f"Пропущена строка {line_no}: нет поля 'question'")
+                continue
+            questions.append({"id": str(record.get("id", line_no)), "question": question})
+    return questions
+
+
+def read_completed_ids(path):
+    """Возвращает id вопросов, для которых в выходном файле уже есть успешный ответ"""
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Последняя строка могла быть не дописана при прерывании
+                continue
+            if record.get("status") == "ok":
+                completed.add(str(record.get("id")))
+    return completed
+
+
+def _ensure_trailing_newline(path):
+    """Если прошлый запуск оборвался посреди строки, начинаем новую строку"""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+
+def retrieve_batch(vectorstore, questions, settings):
+    """Поиск контекста для всей пачки сразу с пакетным кодированием вопросов"""
+    texts = [q["question"] for q in questions]
+    vectors = []
+    for start in range(0, len(texts), ENCODE_BATCH_SIZE):
+        vectors.extend(vectorstore.embeddings.embed_documents(texts[start:start + ENCODE_BATCH_SIZE]))
+
+    calibration = settings.get("calibration")
+    if not calibration:
+        results = []
+        for start in range(0, len(vectors), ENCODE_BATCH_SIZE):
+            results.extend(batch_search(vectorstore, vectors[start:start + ENCODE_BATCH_SIZE], settings))
+        return results
+
+    k = settings["k"]
+    return [
+        [doc for doc, _ in select_context(scored_search(vectorstore, vector, settings, k), settings, k)]
+        for vector in vectors
+    ]
+
+
+def _sources(docs):
+    return [
+        {"filename": doc.metadata.get("filename"), "sections": doc.metadata.get("sections", [])}
+        for doc in docs
+    ]
+
+
+def run_batch(vectorstore, input_path, output_path, mode="search", concurrency=2, **kwargs):
+    """Отвечает на вопросы из input_path и дописывает результаты в output_path"""
+    settings, _, formatter = get_mode_settings(mode, **kwargs)
+    questions = read_questions(input_path)
+    completed = read_completed_ids(output_path)
+    pending = [q for q in questions if q["id"] not in completed]
+    print(f"Вопросов: {len(questions)}, уже отвечено: {len(questions) - len(pending)}, осталось: {len(pending)}")
+    if not pending:
+        return True
+
+    started = time.perf_counter()
+    print("Поиск контекста для всей пачки...")
+    contexts = retrieve_batch(vectorstore, pending, settings)
+    print(f"Поиск завершен за {time.perf_counter() - started:.1f} с")
+
+    generation_chain = create_generation_chain(mode, **kwargs)
+    _ensure_trailing_newline(output_path)
+    write_lock = threading.Lock()
+    failures = 0
+
+    def _answer(item, docs):
+        item_started = time.perf_counter()
+        answer = generation_chain.invoke({"context": formatter(docs), "question": item["question"]})
+        return answer, time.perf_counter() - item_started
+
+    with open(output_path, "a", encoding="utf-8") as out, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch-llm") as executor:
+        futures = {
+            executor.submit(_answer, item, docs): (item, docs)
+            for item, docs in zip(pending, contexts)
+        }
+        for done_count, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            item, docs = futures[future]
+            record = {"id": item["id"], "question": item["question"], "mode": mode, "sources": _sources(docs)}
+            try:
+                answer, elapsed = future.result()
+                record.update({"status": "ok", "answer": answer, "elapsed": round(elapsed, 2)})
+            except Exception as e:
+                failures += 1
+                record.update({"status": "error", "error": str(e)})
+                logging.error(f"Batch {mode} error for question {item['id']}: {e}")
+            with write_lock:
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                os.fsync(out.fileno())
+            print(f"[{done_count}/{len(pending)}] {item['id']}: {record['status']}")
+
+    logging.info(f"Batch {mode} - Input: {input_path} - Answered: {len(pending) - failures} - Errors: {failures}")
+    print(f"Готово за {time.perf_counter() - started:.1f} с, ошибок: {failures}")
+    return failures == 0
@@ -0,0 +1,82 @@
+"""Сравнение плоского поиска с двухуровневым (документы по центроидам, затем их фрагменты).
+
+Корпус - случайные векторы: у каждого документа свое направление, его фрагменты
+разбросаны вокруг него. Для каждого размера корпуса (--documents) измеряются:
+    flat    - поиск k ближайших среди всех фрагментов
+    coarse  - выбор --top-documents документов по центроидам и поиск среди их фрагментов
+и доля k ближайших плоского поиска, найденных двухуровневым (полнота).
+
+    python bench_coarse.py --documents 250 1000 2000 --chunks 200 --dim 384 --k 8
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+
+from document_index import build_document_index
+from retrievers import batch_similarity_search_with_score
+
+
+def build_corpus(documents, chunks, dim, spread, queries, seed):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(documents, dim)).astype(np.float32)
+    vectors = np.repeat(centers, chunks, axis=0) + spread * rng.normal(size=(documents * chunks, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    store = FAISS.from_embeddings(
+        [(f"chunk {i}", vector.tolist()) for i, vector in enumerate(vectors)],
+        DeterministicFakeEmbedding(size=dim),
+        metadatas=[{"doc_id": i // chunks} for i in range(len(vectors))],
+    )
+    with tempfile.TemporaryDirectory() as index_dir:
+        store.document_index = build_document_index(store, index_dir)
+    picked = vectors[rng.integers(0, len(vectors), size=queries)]
+    picked = picked + 0.5 * spread * rng.normal(size=picked.shape).astype(np.float32)
+    picked /= np.linalg.norm(picked, axis=1, keepdims=True)
+    return store, picked
+
+
+def _timed_search(store, queries, k, top_documents):
+    started = time.perf_counter()
+    results = [batch_similarity_search_with_score(store, [query], k, top_documents=top_documents)[0]
+               for query in queries]
+    return time.perf_counter() - started, [{doc.page_content for doc, _ in docs_and_scores} for docs_and_scores in results]
+
+
+def bench(store, queries, k, top_documents):
+    flat_time, flat = _timed_search(store, queries, k, None)
+    coarse_time, coarse = _timed_search(store, queries, k, top_documents)
+    recall = np.mean([len(a & b) / max(len(a), 1) for a, b in zip(flat, coarse)])
+    return flat_time, coarse_time, recall
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк двухуровневого поиска")
+    parser.add_argument("--documents", type=int, nargs="+", default=[250, 1000, 2000], help="размеры корпуса в документах")
+    parser.add_argument("--chunks", type=int, default=200, help="фрагментов в документе")
+    parser.add_argument("--dim", type=int, default=384, help="размерность векторов")
+    parser.add_argument("--spread", type=float, default=0.7, help="разброс фрагментов вокруг направления документа")
+    parser.add_argument("--queries", type=int, default=100, help="число запросов")
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--top-documents", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    print(f"Фрагментов в документе: {args.chunks}, размерность: {args.dim}, запросов: {args.queries}, "
+          f"k={args.k}, документов на запрос: {args.top_documents}")
+    print(f"{'документов':>10} {'фрагментов':>11} {'flat':>10} {'coarse':>10} {'ускорение':>10} {'полнота':>8}")
+    for documents in args.documents:
+        store, queries = build_corpus(documents, args.chunks, args.dim, args.spread, args.queries, args.seed)
+        flat_time, coarse_time, recall = bench(store, queries, args.k, args.top_documents)
+        per_query = lambda seconds: f"{seconds / len(queries) * 1000:.2f} мс"
+        print(f"{documents:>10} {store.index.ntotal:>11} {per_query(flat_time):>10} {per_query(coarse_time):>10} "
+              f"{flat_time / coarse_time:>9.1f}x {recall:>7.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Сравнение MMR LangChain (цикл на Python для каждого запроса) с векторизованным MMR.
+
+Корпус - случайные кластеризованные векторы (кластеры имитируют похожие фрагменты
+одного документа), модель эмбеддингов не нужна. Для каждого fetch_k измеряются:
+    langchain  - max_marginal_relevance_search_with_score_by_vector по одному запросу
+    vec x1     - векторизованный MMR по одному запросу (одновременные пользователи)
+    vec xN     - векторизованный MMR пачками по --batch-size запросов (ТТ, пакетный режим)
+и доля запросов, для которых выбранные фрагменты совпали с LangChain.
+
+    python bench_mmr.py --docs 20000 --dim 768 --fetch-k 60 200 --k 8
+"""
+import argparse
+import time
+
+import numpy as np
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+
+from retrievers import batch_mmr_search_with_score
+
+
+def build_corpus(docs, dim, clusters, seed):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=docs)
+    vectors = centers[labels] + 0.35 * rng.normal(size=(docs, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = centers[rng.integers(0, clusters, size=docs)] + 0.5 * rng.normal(size=(docs, dim)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    store = FAISS.from_embeddings(
+        [(f"chunk {i}", vector.tolist()) for i, vector in enumerate(vectors)],
+        DeterministicFakeEmbedding(size=dim),
+    )
+    return store, queries
+
+
+def _ids(results):
+    return [[doc.page_content for doc, _ in docs_and_scores] for docs_and_scores in results]
+
+
+def bench(store, queries, k, fetch_k, lambda_mult, batch_size):
+    started = time.perf_counter()
+    reference = [
+        store.max_marginal_relevance_search_with_score_by_vector(
+            query.tolist(), k=k, fetch_k=fetch_k, lambda_mult=lambda_mult)
+        for query in queries
+    ]
+    langchain_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    single = [
+        batch_mmr_search_with_score(store, [query], k=k, fetch_k=fetch_k, lambda_mult=lambda_mult)[0]
+        for query in queries
+    ]
+    single_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    batched = []
+    for start in range(0, len(queries), batch_size):
+        batched.extend(batch_mmr_search_with_score(
+            store, queries[start:start + batch_size], k=k, fetch_k=fetch_k, lambda_mult=lambda_mult))
+    batched_time = time.perf_counter() - started
+
+    reference_ids = _ids(reference)
+    agreement = np.mean([a == b for a, b in zip(reference_ids, _ids(batched))])
+    assert _ids(single) == _ids(batched), "одиночный и пакетный режимы разошлись"
+    return langchain_time, single_time, batched_time, agreement
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк векторизованного MMR")
+    parser.add_argument("--docs", type=int, default=20000, help="размер корпуса")
+    parser.add_argument("--dim", type=int, default=768, help="размерность векторов")
+    parser.add_argument("--clusters", type=int, default=400, help="число кластеров в корпусе")
+    parser.add_argument("--queries", type=int, default=200, help="число запросов")
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--fetch-k", type=int, nargs="+", default=[20, 60, 200])
+    parser.add_argument("--lambda-mult", type=float, default=0.8)
+    parser.add_argument("--batch-size", type=int, default=32, help="размер пачки запросов")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    print(f"Корпус: {args.docs} x {args.dim}, запросов: {args.queries}, k={args.k}, lambda={args.lambda_mult}")
+    store, queries = build_corpus(args.docs, args.dim, args.clusters, args.seed)
+    queries = queries[:args.queries]
+
+    print(f"{'fetch_k':>8} {'langchain':>12} {'vec x1':>12} {f'vec x{args.batch_size}':>12} {'ускорение':>10} {'совпадение':>11}")
+    for fetch_k in args.fetch_k:
+        langchain_time, single_time, batched_time, agreement = bench(
+            store, queries, args.k, fetch_k, args.lambda_mult, args.batch_size)
+        per_query = lambda seconds: f"{seconds / len(queries) * 1000:.2f} мс"
+        print(f"{fetch_k:>8} {per_query(langchain_time):>12} {per_query(single_time):>12} "
+              f"{per_query(batched_time):>12} {langchain_time / batched_time:>9.1f}x {agreement:>10.0%}")
+
+
+if __name__ == "__main__":
+    main()
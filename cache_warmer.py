@@ -0,0 +1,223 @@
+"""Прогрев кэша ответов частыми вопросами в простое.
+
+Большая часть вопросов повторяется: одни и те же пункты стандартов спрашивают
+разные инженеры. Кэш ответов (answer_cache.py) отдает повторный вопрос без
+генерации, но первый пользователь все равно ждет полный ответ 8B, а после
+публикации новой версии индекса кэш начинается с нуля.
+
+CacheWarmer в фоновом потоке берет самые частые вопросы из activity.log (строки
+маршрутизации и консольного поиска) и истории чатов (chat_history.db) и, пока
+пользователей нет, заранее отвечает на них основной моделью и сохраняет ответы в
+кэш текущей версии индекса. Прогрев идет только после idle_seconds без запросов
+и прерывается, как только приходит запрос пользователя (ACTIVITY - запросы всех
+процессов на машине): прерванная генерация отбрасывается, вопрос повторяется в
+следующем простое. Warmer запускают и веб-интерфейс, и HTTP API, но прогревает
+только тот, кто держит аренду WARMER_LEASE, остальные ждут ее освобождения. Когда
+IndexManager подменяет версию индекса, у цепочки меняется пространство имен
+кэша, и частые вопросы прогреваются заново.
+
+Однократный прогрев без сервера: python cache_warmer.py --top 50
+"""
+import argparse
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+from answer_cache import ACTIVITY, normalize_question
+
+WARM_TOP = 50          # сколько самых частых вопросов прогревать
+MIN_COUNT = 2          # вопрос, заданный один раз, не прогревается
+IDLE_SECONDS = 5.0     # столько секунд без запросов - простой
+CHECK_INTERVAL = 30.0  # как часто проверять версию индекса, с
+REMINE_INTERVAL = 600.0  # как часто заново собирать частые вопросы, с
+WARMER_LEASE = "cache-warmer"
+LEASE_TTL = 120.0      # аренда прогрева продлевается перед каждым вопросом, с
+
+_LOG_QUESTIONS = [
+    re.compile(r" - Routing - .* - Question: (.+)$"),
+    re.compile(r" - Search - Question: (.+?) - Answer length: \d+$"),
+]
+TT_PREFIX = "/tt"
+
+
+def _log_questions(log_path):
+    if not os.path.exists(log_path):
+        return []
+    questions = []
+    with open(log_path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            for pattern in _LOG_QUESTIONS:
+                match = pattern.search(line.rstrip("\n"))
+                if match:
+                    questions.append(match.group(1))
+                    break
+    return questions
+
+
+def _chat_questions(chat_db_path):
+    if not os.path.exists(chat_db_path):
+        return []
+    from chat_store import ChatStore
+    store = ChatStore(chat_db_path)
+    try:
+        return store.recent_questions()
+    finally:
+        store.close()
+
+
+def frequent_questions(log_path="activity.log", chat_db_path="chat_history.db", top=WARM_TOP, min_count=MIN_COUNT):
+    """[(вопрос, число), ...] самых частых вопросов поиска, частые первыми"""
+    wordings = defaultdict(Counter)
+    counts = []
+    for questions in (_log_questions(log_path), _chat_questions(chat_db_path)):
+        source_counts = Counter()
+        for question in questions:
+            question = question.strip()
+            if not question or question.lower().startswith(TT_PREFIX):
+                continue
+            key = normalize_question(question)
+            source_counts[key] += 1
+            wordings[key][question] += 1
+        counts.append(source_counts)
+    # Вопрос из веб-интерфейса есть и в логе, и в истории чатов - берется большее из чисел
+    total = Counter()
+    for source_counts in counts:
+        total |= source_counts
+    return [(wordings[key].most_common(1)[0][0], count)
+            for key, count in total.most_common(top) if count >= min_count]
+
+
+class CacheWarmer:
+    """Фоновый прогрев кэша ответов цепочки qa_chain текущего снимка IndexManager"""
+
+    def __init__(self, index_manager, top=WARM_TOP, min_count=MIN_COUNT, idle_seconds=IDLE_SECONDS,
+                 check_interval=CHECK_INTERVAL, log_path="activity.log", chat_db_path="chat_history.db",
+                 activity=ACTIVITY):
+        self.index_manager = index_manager
+        self.top = top
+        self.min_count = min_count
+        self.idle_seconds = idle_seconds
+        self.check_interval = check_interval
+        self.log_path = log_path
+        self.chat_db_path = chat_db_path
+        self.activity = activity
+        self._namespace = None
+        self._queue = []
+        self._mined_at = 0.0
+        self._stats = {"warmed": 0, "skipped": 0, "interrupted": 0, "errors": 0}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Запускает фоновый прогрев; без кэша ответов (ANSWER_CACHE=0) поток только ждет"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="cache-warmer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.activity.release(WARMER_LEASE)
+
+    def stats(self):
+        return dict(self._stats, namespace=self._namespace, pending=len(self._queue))
+
+    def _should_stop(self):
+        return self.activity.active > 0 or self._stop.is_set()
+
+    def _wait_idle(self):
+        """Ждет простоя idle_seconds; False - прогрев остановлен"""
+        while self.activity.idle_for() < self.idle_seconds:
+            if self._stop.wait(1.0):
+                return False
+        return not self._stop.is_set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.warm()
+            except Exception as e:
+                self._stats["errors"] += 1
+                logging.error(f"Cache warmer error: {e}")
+            self._stop.wait(self.check_interval)
+
+    def warm(self):
+        """Прогревает частые вопросы текущей версии индекса; возвращает число новых ответов в кэше"""
+        qa_chain = self.index_manager.current().resources["qa_chain"]
+        cache = getattr(qa_chain, "answer_cache", None)
+        if cache is None:
+            return 0
+        if cache.namespace != self._namespace or (not self._queue and
+                                                  time.monotonic() - self._mined_at >= REMINE_INTERVAL):
+            self._queue = [question for question, _ in frequent_questions(
+                self.log_path, self.chat_db_path, self.top, self.min_count)]
+            self._mined_at = time.monotonic()
+            if cache.namespace != self._namespace:
+                logging.info(f"Cache warm started - {cache.namespace} - {len(self._queue)} questions")
+            self._namespace = cache.namespace
+
+        warmed = 0
+        while self._queue and self._wait_idle():
+            if self.index_manager.current().resources["qa_chain"] is not qa_chain:
+                # Версия индекса сменилась - вопросы прогреваются заново для новой цепочки
+                return warmed
+            if not self.activity.lease(WARMER_LEASE, LEASE_TTL):
+                # Прогревает другой процесс - ответы окажутся в общем кэше
+                return warmed
+            question = self._queue[0]
+            started = time.perf_counter()
+            stored = qa_chain.precompute(question, should_stop=self._should_stop)
+            if not stored and self._should_stop():
+                # Пришел запрос пользователя - вопрос остается в очереди до следующего простоя
+                self._stats["interrupted"] += 1
+                logging.info(f"Cache warm paused - Question: {question}")
+                continue
+            self._queue.pop(0)
+            if stored:
+                warmed += 1
+                self._stats["warmed"] += 1
+                logging.info(f"Cache warmed - {time.perf_counter() - started:.2f}s - Question: {question}")
+            else:
+                # Уже в кэше или отвечается без LLM
+                self._stats["skipped"] += 1
+        return warmed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Однократный прогрев кэша ответов частыми вопросами")
+    parser.add_argument("--top", type=int, default=WARM_TOP, help="сколько самых частых вопросов прогревать")
+    parser.add_argument("--min-count", type=int, default=MIN_COUNT, help="минимальное число повторов вопроса")
+    parser.add_argument("--list", action="store_true", help="только показать частые вопросы")
+    args = parser.parse_args()
+
+    questions = frequent_questions(top=args.top, min_count=args.min_count)
+    if args.list or not questions:
+        print(f"Частых вопросов: {len(questions)}")
+        for question, count in questions:
+            print(f"{count:5d}  {question}")
+        return
+
+    logging.basicConfig(filename='activity.log', level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    from functools import partial
+
+    from index_manager import IndexManager, load_chain_resources
+    from retrieval_worker import create_query_embeddings
+
+    index_manager = IndexManager(partial(load_chain_resources, create_query_embeddings()), watch_corpus=False)
+    if getattr(index_manager.current().resources["qa_chain"], "answer_cache", None) is None:
+        raise SystemExit("Кэш ответов отключен (ANSWER_CACHE=0)")
+    warmer = CacheWarmer(index_manager, top=args.top, min_count=args.min_count, idle_seconds=0)
+    started = time.perf_counter()
+    warmed = warmer.warm()
+    warmer.stop()
+    stats = warmer.stats()
+    print(f"Прогрето ответов: {warmed}, уже в кэше или без LLM: {stats['skipped']}, "
+          f"время: {time.perf_counter() - started:.1f} с")
+
+
+if __name__ == "__main__":
+    main()
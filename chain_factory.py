@@ -1,53 +1,60 @@
+import re
+import json
+import time
+import logging
+import threading
 from langchain_core.prompts import PromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
 from langchain_ollama import OllamaLLM
 
-
-def create_search_chain(vectorstore, **kwargs):
-    """Создает цепочку для строгого поиска по нормативным документам"""
-    # Параметры по умолчанию
-    defaults = {
-        "search_type": "mmr",
-        "k": 6,
-        "fetch_k": 60,
-        "lambda_mult": 0.8,
-        "model": "qwen3:8b",
-        "temperature": 0.0
-    }
-    defaults.update(kwargs)
-
-    retriever = vectorstore.as_retriever(
-        search_type=defaults["search_type"],
-        search_kwargs={"k": defaults["k"], "fetch_k": defaults["fetch_k"], "lambda_mult": defaults.get("lambda_mult", 0.5)}
-    )
-
-    def format_docs(docs):
-        formatted_docs = []
-        for doc in docs:
-            content = doc.page_content
-            metadata = doc.metadata
-            sections = metadata.get('sections', [])
-            filename = metadata.get('filename', 'Unknown')
-
-            # Clean up filename to get document designation
-            doc_name = filename.replace('.pdf', '').replace('_', ' ').strip()
-
-            # Add section references to the content
-            if sections:
-                section_refs = ", ".join(sections)
-                content = f"[Разделы: {section_refs}] {content}"
-
-            # Add document reference
-            content = f"[Документ: {doc_name}]\n{content}"
-
-            formatted_docs.append(content)
-
-        return "\n\n".join(formatted_docs)
-
-    llm = OllamaLLM(model=defaults["model"], temperature=defaults["temperature"])
-
-    template = """Ты - ПРЕЦИЗИОННЫЙ АНАЛИЗАТОР нормативных документов с максимальной точностью и релевантностью. Твоя задача - предоставлять ТОЛЬКО релевантную информацию из контекста, строго отвечая на вопрос.
+from answer_cache import ACTIVITY
+from retrievers import DynamicKRetriever, MMRRetriever, scored_search, select_context
+
+
+# Параметры по умолчанию для каждого режима
+SEARCH_DEFAULTS = {
+    "search_type": "mmr",
+    "k": 6,
+    "fetch_k": 60,
+    "lambda_mult": 0.8,
+    "model": "qwen3:8b",
+    "temperature": 0.0
+}
+
+RAG_DEFAULTS = {
+    "search_type": "mmr",
+    "k": 8,
+    "lambda_mult": 0.8,
+    "model": "qwen3:8b",
+    "temperature": 0.0
+}
+
+# Каскад моделей: простые вопросы с уверенным поиском - малой модели, остальное - основной
+ROUTING_DEFAULTS = {
+    "small_model": "qwen3:1.7b",
+    "large_model": "qwen3:8b",
+    "min_relevance": 0.55,       # порог релевантности лучшего фрагмента для малой модели без калибровки индекса
+    "max_question_words": 20,    # длинные вопросы считаются сложными
+    "min_grounding": 0.6,        # доля слов ответа малой модели, найденных в контексте
+    "log_path": "routing_log.jsonl"
+}
+
+# Признаки вопросов, которые малой модели не отдаются
+COMPLEX_QUESTION_MARKERS = [
+    "сравни", "рассчита", "расчет", "расчёт", "почему", "обоснуй", "проанализируй",
+    "требования", "технические требования", "/tt", "генерир", "создай", "составь"
+]
+
+TT_DEFAULTS = {
+    "search_type": "mmr",
+    "k": 10,
+    "lambda_mult": 0.5,
+    "model": "qwen3:8b",
+    "temperature": 0.2
+}
+
+SEARCH_TEMPLATE = """Ты - ПРЕЦИЗИОННЫЙ АНАЛИЗАТОР нормативных документов с максимальной точностью и релевантностью. Твоя задача - предоставлять ТОЛЬКО релевантную информацию из контекста, строго отвечая на вопрос.
 
 КРИТИЧЕСКИ ВАЖНЫЕ ПРАВИЛА (НАРУШЕНИЕ НЕДОПУСТИМО):
 1. ИСПОЛЬЗУЙ ТОЛЬКО информацию из предоставленного контекста, которая НАПРЯМУЮ относится к вопросу
@@ -71,37 +78,7 @@ def create_search_chain(vectorstore, **kwargs):
 
 ТОЧНЫЙ И РЕЛЕВАНТНЫЙ ОТВЕТ НА РУССКОМ ЯЗЫКЕ (только по контексту с обязательными ссылками):"""
 
-    prompt = PromptTemplate(template=template, input_variables=["context", "question"])
-    search_chain = (
-        {"context": retriever | format_docs, "question": RunnablePassthrough()}
-        | prompt | llm | StrOutputParser()
-    )
-    return search_chain
-
-
-def create_rag_chain(vectorstore, **kwargs):
-    """Создает цепочку RAG для экспертного анализа нормативных документов"""
-    # Параметры по умолчанию
-    defaults = {
-        "search_type": "mmr",
-        "k": 8,
-        "lambda_mult": 0.8,
-        "model": "qwen3:8b",
-        "temperature": 0.0
-    }
-    defaults.update(kwargs)
-
-    retriever = vectorstore.as_retriever(
-        search_type=defaults["search_type"],
-        search_kwargs={"k": defaults["k"], "lambda_mult": defaults["lambda_mult"]}
-    )
-
-    def format_docs(docs):
-        return "\n\n".join(doc.page_content for doc in docs)
-
-    llm = OllamaLLM(model=defaults["model"], temperature=defaults["temperature"])
-
-    template = """Ты ПРЕЦИЗИОННЫЙ ЭКСПЕРТ по корпоративным нормативным документам с максимальной точностью и релевантностью ответов.
+RAG_TEMPLATE = """Ты ПРЕЦИЗИОННЫЙ ЭКСПЕРТ по корпоративным нормативным документам с максимальной точностью и релевантностью ответов.
 
 КРИТИЧЕСКИ ВАЖНЫЕ ТРЕБОВАНИЯ К ТОЧНОСТИ И РЕЛЕВАНТНОСТИ:
 1. Отвечай ТОЛЬКО на основе информации из контекста, которая НАПРЯМУЮ относится к вопросу
@@ -128,37 +105,7 @@ def create_rag_chain(vectorstore, **kwargs):
 
 ТОЧНЫЙ И РЕЛЕВАНТНЫЙ ОТВЕТ ТОЛЬКО НА РУССКОМ ЯЗЫКЕ (с обязательными ссылками на пункты документов):"""
 
-    prompt = PromptTemplate(template=template, input_variables=["context", "question"])
-    rag_chain = (
-        {"context": retriever | format_docs, "question": RunnablePassthrough()}
-        | prompt | llm | StrOutputParser()
-    )
-    return rag_chain
-
-
-def create_tt_chain(vectorstore, **kwargs):
-    """Создает цепочку для генерации технических требований (ТТ)"""
-    # Параметры по умолчанию
-    defaults = {
-        "search_type": "mmr",
-        "k": 10,
-        "lambda_mult": 0.5,
-        "model": "qwen3:8b",
-        "temperature": 0.2
-    }
-    defaults.update(kwargs)
-
-    retriever = vectorstore.as_retriever(
-        search_type=defaults["search_type"],
-        search_kwargs={"k": defaults["k"], "lambda_mult": defaults["lambda_mult"]}
-    )
-
-    def format_docs(docs):
-        return "\n\n".join(doc.page_content for doc in docs)
-
-    llm = OllamaLLM(model=defaults["model"], temperature=defaults["temperature"])
-
-    template = """Ты инженер-технолог, специализирующийся на создании технических требований (ТТ) на основе нормативных документов.
+TT_TEMPLATE = """Ты инженер-технолог, специализирующийся на создании технических требований (ТТ) на основе нормативных документов.
 
 На основе следующего контекста из нормативных документов создай технические требования для запроса инженера.
 
@@ -187,9 +134,310 @@ def create_tt_chain(vectorstore, **kwargs):
 
 Сгенерируй технические требования ТОЛЬКО НА РУССКОМ ЯЗЫКЕ:"""
 
+
+def format_docs(docs):
+    return "\n\n".join(doc.page_content for doc in docs)
+
+
+def format_docs_with_references(docs):
+    formatted_docs = []
+    for doc in docs:
+        content = doc.page_content
+        metadata = doc.metadata
+        sections = metadata.get('sections', [])
+        filename = metadata.get('filename', 'Unknown')
+
+        # Clean up filename to get document designation
+        doc_name = filename.replace('.pdf', '').replace('_', ' ').strip()
+
+        # Add section references to the content
+        if sections:
+            section_refs = ", ".join(sections)
+            content = f"[Разделы: {section_refs}] {content}"
+
+        # Page provenance of parent sections (small-to-big index)
+        if 'page_start' in metadata:
+            pages = metadata['page_start'] if metadata['page_start'] == metadata['page_end'] \
+                else f"{metadata['page_start']}–{metadata['page_end']}"
+            doc_name = f"{doc_name}, стр. {pages}"
+
+        # Add document reference
+        content = f"[Документ: {doc_name}]\n{content}"
+
+        formatted_docs.append(content)
+
+    return "\n\n".join(formatted_docs)
+
+
+# Режим -> (параметры по умолчанию, шаблон промпта, форматирование контекста)
+CHAIN_MODES = {
+    "search": (SEARCH_DEFAULTS, SEARCH_TEMPLATE, format_docs_with_references),
+    "rag": (RAG_DEFAULTS, RAG_TEMPLATE, format_docs),
+    "tt": (TT_DEFAULTS, TT_TEMPLATE, format_docs),
+}
+
+
+def get_mode_settings(mode, **kwargs):
+    """Возвращает (параметры, шаблон, функцию форматирования) для режима с учетом переопределений"""
+    if mode not in CHAIN_MODES:
+        raise ValueError(f"Неизвестный режим цепочки: {mode}")
+    defaults, template, formatter = CHAIN_MODES[mode]
+    settings = dict(defaults)
+    settings.update(kwargs)
+    return settings, template, formatter
+
+
+def get_search_kwargs(settings):
+    """Параметры поиска ретривера из настроек цепочки"""
+    search_kwargs = {"k": settings["k"], "lambda_mult": settings.get("lambda_mult", 0.5)}
+    if "fetch_k" in settings:
+        search_kwargs["fetch_k"] = settings["fetch_k"]
+    return search_kwargs
+
+
+def create_generation_chain(mode, **kwargs):
+    """Создает генерирующую часть цепочки без ретривера: вход {"context", "question"}"""
+    settings, template, _ = get_mode_settings(mode, **kwargs)
+    llm = OllamaLLM(model=settings["model"], temperature=settings["temperature"])
     prompt = PromptTemplate(template=template, input_variables=["context", "question"])
-    tt_chain = (
-        {"context": retriever | format_docs, "question": RunnablePassthrough()}
-        | prompt | llm | StrOutputParser()
+    return prompt | llm | StrOutputParser()
+
+
+def create_retriever(vectorstore, settings):
+    """Ретривер режима: с динамическим k, если передана калибровка индекса (calibration=...).
+
+    С хранилищем разделов (parent_store=...) найденные фрагменты расширяются до разделов,
+    с metadata_filter=... поиск идет только по подходящим фрагментам.
+    """
+    if settings.get("calibration"):
+        return DynamicKRetriever(vectorstore=vectorstore, settings=settings, calibration=settings["calibration"])
+    if settings["search_type"] == "mmr" or settings.get("parent_store") or settings.get("metadata_filter"):
+        return MMRRetriever(vectorstore=vectorstore, settings=settings)
+    return vectorstore.as_retriever(
+        search_type=settings["search_type"],
+        search_kwargs=get_search_kwargs(settings)
+    )
+
+
+def _create_chain(mode, vectorstore, **kwargs):
+    settings, template, formatter = get_mode_settings(mode, **kwargs)
+    retriever = create_retriever(vectorstore, settings)
+    return (
+        {"context": retriever | formatter, "question": RunnablePassthrough()}
+        | create_generation_chain(mode, **kwargs)
     )
-    return tt_chain
+
+
+def create_search_chain(vectorstore, **kwargs):
+    """Создает цепочку для строгого поиска по нормативным документам"""
+    return _create_chain("search", vectorstore, **kwargs)
+
+
+def create_rag_chain(vectorstore, **kwargs):
+    """Создает цепочку RAG для экспертного анализа нормативных документов"""
+    return _create_chain("rag", vectorstore, **kwargs)
+
+
+def create_tt_chain(vectorstore, **kwargs):
+    """Создает цепочку для генерации технических требований (ТТ)"""
+    return _create_chain("tt", vectorstore, **kwargs)
+
+
+class RoutingStats:
+    """Накопленная статистика маршрутизации для оценки экономии"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {"cache": 0, "definition": 0, "table": 0, "small": 0, "large": 0, "escalated": 0}
+        self.latency = {"cache": 0.0, "definition": 0.0, "table": 0.0, "small": 0.0, "large": 0.0, "escalated": 0.0}
+
+    def record(self, route, latency):
+        with self.lock:
+            self.counts[route] += 1
+            self.latency[route] += latency
+
+    def snapshot(self):
+        with self.lock:
+            avg = {route: (self.latency[route] / self.counts[route] if self.counts[route] else 0.0)
+                   for route in self.counts}
+            # Экономия: сколько заняли бы запросы без основной модели (малая модель, таблицы, термины, кэш) на ней
+            saved = sum(self.counts[route] * max(0.0, avg["large"] - avg[route])
+                        for route in ("cache", "definition", "table", "small")) if self.counts["large"] else 0.0
+            return {"counts": dict(self.counts), "avg_latency": avg, "estimated_seconds_saved": saved}
+
+
+def _grounding_score(answer, context):
+    """Доля значимых слов ответа (по основе из 6 букв), встречающихся в контексте"""
+    stems = lambda text: {word[:6] for word in re.findall(r"\w{5,}", text.lower())}
+    answer_stems = stems(answer)
+    if not answer_stems:
+        return 0.0
+    return len(answer_stems & stems(context)) / len(answer_stems)
+
+
+class ModelCascade:
+    """Маршрутизация между малой быстрой моделью и основной qwen3:8b.
+
+    Один поиск (MMR с оценками) используется для обоих путей. Малая модель отвечает
+    только на короткие поисковые вопросы с высокой релевантностью лучшего фрагмента;
+    ответ, не прошедший проверку опоры на контекст, перегенерируется основной моделью.
+    С таблицами индекса (table_store=...) точные вопросы о параметрах отвечаются
+    строкой таблицы, со словарем терминов (terms_index=...) вопросы "что такое ..." -
+    дословным определением; оба ответа - без поиска и LLM (см. table_store.py, terms_index.py).
+    С кэшем ответов (answer_cache=..., см. answer_cache.py) сгенерированные ответы
+    сохраняются, и повторный вопрос по той же версии индекса отдается из кэша.
+    """
+
+    def __init__(self, vectorstore, mode="rag", table_store=None, terms_index=None, answer_cache=None, **kwargs):
+        self.answer_cache = answer_cache if mode != "tt" else None
+        # Ответы без LLM: маршрут и источник, проверяются по порядку
+        self.fast_paths = [] if mode == "tt" else [
+            (route, source)
+            for route, source in (("definition", terms_index), ("table", table_store), ("cache", answer_cache))
+            if source is not None
+        ]
+        routing = dict(ROUTING_DEFAULTS)
+        routing.update({key: kwargs.pop(key) for key in list(kwargs) if key in ROUTING_DEFAULTS})
+        self.routing = routing
+        self.mode = mode
+        self.vectorstore = vectorstore
+        self.settings, _, self.formatter = get_mode_settings(mode, **kwargs)
+        self.small_chain = create_generation_chain(mode, **dict(kwargs, model=routing["small_model"]))
+        self.large_chain = create_generation_chain(mode, **dict(kwargs, model=routing["large_model"]))
+        self.stats = RoutingStats()
+        self._log_lock = threading.Lock()
+
+    def retrieve(self, question):
+        """Документы и релевантность (0..1) за один поиск; с калибровкой - с динамическим k"""
+        embedding = self.vectorstore.embeddings.embed_query(question)
+        k = self.settings["k"]
+        docs_and_scores = scored_search(self.vectorstore, embedding, self.settings, k)
+        return select_context(docs_and_scores, self.settings, k)
+
+    def _inputs(self, question, docs_and_scores):
+        """(вход генерации, контекст, релевантность лучшего фрагмента)"""
+        context = self.formatter([doc for doc, _ in docs_and_scores])
+        top_relevance = max((score for _, score in docs_and_scores), default=0.0)
+        return {"context": context, "question": question}, context, top_relevance
+
+    def is_simple(self, question, top_relevance):
+        if self.mode == "tt":
+            return False
+        lowered = question.lower()
+        if any(marker in lowered for marker in COMPLEX_QUESTION_MARKERS):
+            return False
+        if len(question.split()) > self.routing["max_question_words"]:
+            return False
+        return top_relevance >= self.min_relevance
+
+    @property
+    def min_relevance(self):
+        """Порог уверенного поиска: откалиброванный порог индекса (calibration.json) или min_relevance.
+
+        Релевантность L2 ненормированных эмбеддингов зависит от корпуса и модели, поэтому
+        фиксированный порог - только запасной вариант для индекса без калибровки.
+        """
+        threshold = (self.settings.get("calibration") or {}).get("threshold")
+        return threshold if threshold is not None else self.routing["min_relevance"]
+
+    def invoke(self, question, retrieved=None):
+        return "".join(self.stream(question, retrieved))
+
+    def stream(self, question, retrieved=None):
+        """Ответ по частям: основная модель отдает токены по мере генерации.
+
+        Ответ малой модели проверяется на опору на контекст целиком, поэтому
+        отдается одним куском. retrieved - уже найденное retrieve() (например,
+        при автоматическом выборе режима), тогда поиск не повторяется.
+        """
+        # Прогрев кэша (cache_warmer.py) уступает запросам пользователей
+        with ACTIVITY.request():
+            yield from self._stream(question, retrieved)
+
+    def _stream(self, question, retrieved):
+        started = time.perf_counter()
+        for route, source in self.fast_paths:
+            answer = source.answer(question, self.settings.get("metadata_filter"))
+            if answer is not None:
+                yield answer
+                latency = time.perf_counter() - started
+                self.stats.record(route, latency)
+                self._log_decision(question, route, 0.0, None, latency)
+                return
+        docs_and_scores = self.retrieve(question) if retrieved is None else retrieved
+        inputs, context, top_relevance = self._inputs(question, docs_and_scores)
+
+        route = "large"
+        grounding = None
+        if self.is_simple(question, top_relevance):
+            answer = self.small_chain.invoke(inputs)
+            grounding = _grounding_score(answer, context)
+            if grounding >= self.routing["min_grounding"] and "Информация отсутствует" not in answer:
+                route = "small"
+            else:
+                route = "escalated"
+        if route == "small":
+            yield answer
+        else:
+            pieces = []
+            for piece in self.large_chain.stream(inputs):
+                pieces.append(piece)
+                yield piece
+            answer = "".join(pieces)
+        if self.answer_cache is not None:
+            self.answer_cache.put(question, answer)
+
+        latency = time.perf_counter() - started
+        self.stats.record(route, latency)
+        self._log_decision(question, route, top_relevance, grounding, latency)
+
+    def precompute(self, question, should_stop):
+        """Ответ основной модели в кэш заранее (без учета в статистике маршрутизации).
+
+        Генерация прерывается, как только should_stop() вернет True; возвращает
+        True, если ответ сохранен.
+        """
+        if self.answer_cache is None or self.answer_cache.contains(question):
+            return False
+        if any(source.answer(question, self.settings.get("metadata_filter")) is not None
+               for route, source in self.fast_paths if route != "cache"):
+            # На такой вопрос и так отвечается без LLM
+            return False
+        inputs, _, _ = self._inputs(question, self.retrieve(question))
+        pieces = []
+        for piece in self.large_chain.stream(inputs):
+            if should_stop():
+                return False
+            pieces.append(piece)
+        self.answer_cache.put(question, "".join(pieces), source="warm")
+        return True
+
+    def _log_decision(self, question, route, top_relevance, grounding, latency):
+        logging.info(
+            f"Routing - Mode: {self.mode} - Route: {route} - Top relevance: {top_relevance:.3f} - "
+            f"Grounding: {grounding if grounding is None else round(grounding, 3)} - Latency: {latency:.2f}s - "
+            f"Question: {question}"
+        )
+        if not self.routing["log_path"]:
+            return
+        record = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "mode": self.mode,
+            "question": question,
+            "route": route,
+            "top_relevance": round(top_relevance, 4),
+            "grounding": grounding if grounding is None else round(grounding, 4),
+            "latency": round(latency, 3),
+            "stats": self.stats.snapshot(),
+        }
+        with self._log_lock:
+            with open(self.routing["log_path"], "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def create_routed_chain(vectorstore, mode="rag", **kwargs):
+    """Создает цепочку с каскадом моделей (см. ModelCascade); для ТТ всегда основная модель"""
+    if mode == "tt":
+        skipped = set(ROUTING_DEFAULTS) | {"table_store", "terms_index", "answer_cache"}
+        return create_tt_chain(vectorstore, **{k: v for k, v in kwargs.items() if k not in skipped})
+    return ModelCascade(vectorstore, mode=mode, **kwargs)
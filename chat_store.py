@@ -0,0 +1,325 @@
+"""Хранилище истории чатов в SQLite.
+
+Заменяет перезапись chat_history.json целиком: каждое сообщение добавляется
+отдельной строкой, сообщения чата загружаются только при его открытии,
+а режим WAL позволяет нескольким сессиям Streamlit писать одновременно.
+При первом запуске существующий chat_history.json импортируется один раз.
+"""
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+
+DEFAULT_DB_PATH = "chat_history.db"
+LEGACY_JSON_PATH = "chat_history.json"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_chats_updated_at ON chats(updated_at);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id TEXT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id, id);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Полнотекстовый индекс по заголовкам и сообщениям (external content FTS5).
+# unicode61 приводит кириллицу к нижнему регистру, ё заменяется на е при индексации
+# (remove_diacritics действует только на латиницу); префиксные индексы ускоряют
+# запросы вида "трансформат*" после стемминга.
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    content, content='messages', content_rowid='id',
+    tokenize="unicode61 remove_diacritics 2", prefix='2 3 4'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS chats_fts USING fts5(
+    title, content='chats', content_rowid='rowid',
+    tokenize="unicode61 remove_diacritics 2", prefix='2 3 4'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, content) VALUES (new.id, fold_yo(new.content));
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, fold_yo(old.content));
+END;
+CREATE TRIGGER IF NOT EXISTS chats_fts_insert AFTER INSERT ON chats BEGIN
+    INSERT INTO chats_fts(rowid, title) VALUES (new.rowid, fold_yo(new.title));
+END;
+CREATE TRIGGER IF NOT EXISTS chats_fts_update AFTER UPDATE OF title ON chats BEGIN
+    INSERT INTO chats_fts(chats_fts, rowid, title) VALUES ('delete', old.rowid, fold_yo(old.title));
+    INSERT INTO chats_fts(rowid, title) VALUES (new.rowid, fold_yo(new.title));
+END;
+CREATE TRIGGER IF NOT EXISTS chats_fts_delete AFTER DELETE ON chats BEGIN
+    INSERT INTO chats_fts(chats_fts, rowid, title) VALUES ('delete', old.rowid, fold_yo(old.title));
+END;
+"""
+
+# Окончания для облегченного стемминга русских слов в поисковых запросах
+RUSSIAN_ENDINGS = sorted([
+    "иями", "ями", "ами", "ией", "ием", "иях", "ого", "его", "ому", "ему", "ыми", "ими",
+    "ая", "яя", "ое", "ее", "ые", "ие", "ый", "ий", "ой", "ом", "ем", "ам", "ям", "ах", "ях",
+    "ов", "ев", "ей", "ию", "ия", "ие", "ии", "ть", "ся", "сь",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+], key=len, reverse=True)
+
+
+def fold_yo(text):
+    """ё -> е, чтобы "емкость" и "ёмкость" совпадали в индексе"""
+    return text.replace("ё", "е").replace("Ё", "Е") if text else text
+
+
+def stem_russian(word):
+    """Отсекает типовое окончание, чтобы искать все словоформы по префиксу"""
+    for ending in RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def build_fts_query(text):
+    """Преобразует пользовательский ввод в запрос FTS5: все слова, каждое по префиксу основы"""
+    terms = []
+    for word in re.findall(r"\w+", fold_yo(text.lower())):
+        stem = stem_russian(word)
+        terms.append(f'"{stem}"*')
+    return " ".join(terms)
+
+
+class ChatStore:
+    """Потокобезопасное хранилище чатов: одно соединение SQLite на поток"""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, legacy_json_path=LEGACY_JSON_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+        conn = self._connection()
+        conn.executescript(SCHEMA)
+        fts_exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+        ).fetchone()
+        conn.executescript(FTS_SCHEMA)
+        if not fts_exists:
+            # База создана до появления полнотекстового индекса - строим его один раз
+            with self._transaction() as conn:
+                conn.execute("INSERT INTO messages_fts(rowid, content) SELECT id, fold_yo(content) FROM messages")
+                conn.execute("INSERT INTO chats_fts(rowid, title) SELECT rowid, fold_yo(title) FROM chats")
+        if legacy_json_path:
+            self.migrate_from_json(legacy_json_path)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.create_function("fold_yo", 1, fold_yo, deterministic=True)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        return _Transaction(self._connection())
+
+    # --- миграция ---
+
+    def migrate_from_json(self, json_path):
+        """Однократный импорт chat_history.json; файл переименовывается в *.migrated"""
+        if not os.path.exists(json_path) or self.get_setting("migrated_from_json"):
+            return 0
+        try:
+            with open(json_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            logging.error(f"Chat history migration failed to read {json_path}: {e}")
+            return 0
+
+        chats = data.get("chats", {})
+        with self._transaction() as conn:
+            # Другая сессия могла успеть выполнить миграцию
+            if conn.execute("SELECT 1 FROM settings WHERE key = 'migrated_from_json'").fetchone():
+                return 0
+            for chat_id, chat in chats.items():
+                now = datetime.now().isoformat()
+                conn.execute(
+                    "INSERT OR IGNORE INTO chats (id, title, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                    (chat_id, chat.get("title", "Новый чат"), chat.get("created_at", now), chat.get("updated_at", now)),
+                )
+                conn.executemany(
+                    "INSERT INTO messages (chat_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                    [
+                        (chat_id, m["role"], m["content"], m.get("created_at", chat.get("updated_at", now)))
+                        for m in chat.get("messages", [])
+                    ],
+                )
+            if data.get("current_chat_id"):
+                self._set_setting(conn, "current_chat_id", data["current_chat_id"])
+            self._set_setting(conn, "migrated_from_json", datetime.now().isoformat())
+        try:
+            os.replace(json_path, json_path + ".migrated")
+        except OSError as e:
+            logging.warning(f"Could not rename migrated chat history {json_path}: {e}")
+        logging.info(f"Migrated {len(chats)} chats from {json_path} to {self.db_path}")
+        return len(chats)
+
+    # --- настройки ---
+
+    @staticmethod
+    def _set_setting(conn, key, value):
+        conn.execute(
+            "INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+
+    def get_setting(self, key, default=None):
+        row = self._connection().execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else default
+
+    def set_setting(self, key, value):
+        with self._transaction() as conn:
+            self._set_setting(conn, key, value)
+
+    # --- чаты ---
+
+    def create_chat(self, title="Новый чат"):
+        """Создает пустой чат и возвращает его id"""
+        now = datetime.now()
+        chat_id = f"chat_{now.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO chats (id, title, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                (chat_id, title, now.isoformat(), now.isoformat()),
+            )
+        return chat_id
+
+    def get_chat(self, chat_id):
+        row = self._connection().execute(
+            "SELECT id, title, created_at, updated_at FROM chats WHERE id = ?", (chat_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def list_chats(self, limit=None, offset=0):
+        """Метаданные чатов (без сообщений), новые сверху"""
+        sql = "SELECT id, title, created_at, updated_at FROM chats ORDER BY updated_at DESC"
+        params = ()
+        if limit is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params = (limit, offset)
+        return [dict(row) for row in self._connection().execute(sql, params)]
+
+    def search_chats(self, query, limit=50, offset=0):
+        """Полнотекстовый поиск по заголовкам и сообщениям, постранично по релевантности.
+
+        Возвращает метаданные чатов с фрагментом найденного текста в поле snippet.
+        """
+        fts_query = build_fts_query(query)
+        if not fts_query:
+            return []
+        # bm25 отрицателен: меньше - лучше; совпадения в заголовке поднимаются выше
+        sql = """
+            WITH hits AS (
+                SELECT m.chat_id AS chat_id,
+                       bm25(messages_fts) AS rank,
+                       snippet(messages_fts, 0, '«', '»', '…', 12) AS snippet
+                FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+                WHERE messages_fts MATCH ?
+                UNION ALL
+                SELECT c.id, bm25(chats_fts) * 2, c.title
+                FROM chats_fts JOIN chats c ON c.rowid = chats_fts.rowid
+                WHERE chats_fts MATCH ?
+            )
+            SELECT c.id, c.title, c.created_at, c.updated_at, MIN(h.rank) AS rank, h.snippet
+            FROM hits h JOIN chats c ON c.id = h.chat_id
+            GROUP BY c.id
+            ORDER BY rank, c.updated_at DESC
+            LIMIT ? OFFSET ?
+        """
+        try:
+            rows = self._connection().execute(sql, (fts_query, fts_query, limit, offset))
+            return [dict(row) for row in rows]
+        except sqlite3.OperationalError as e:
+            logging.warning(f"Chat search failed for query {query!r}: {e}")
+            return []
+
+    def count_chats(self):
+        return self._connection().execute("SELECT COUNT(*) FROM chats").fetchone()[0]
+
+    def update_title(self, chat_id, title):
+        with self._transaction() as conn:
+            conn.execute("UPDATE chats SET title = ? WHERE id = ?", (title, chat_id))
+
+    def delete_chat(self, chat_id):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+
+    def clear(self):
+        """Удаляет все чаты и сообщения"""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM messages")
+            conn.execute("DELETE FROM chats")
+
+    # --- сообщения ---
+
+    def get_messages(self, chat_id):
+        rows = self._connection().execute(
+            "SELECT id, role, content, created_at FROM messages WHERE chat_id = ? ORDER BY id", (chat_id,)
+        )
+        return [dict(row) for row in rows]
+
+    def append_message(self, chat_id, role, content):
+        """Добавляет сообщение в чат и возвращает запись сообщения"""
+        now = datetime.now().isoformat()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO messages (chat_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                (chat_id, role, content, now),
+            )
+            conn.execute("UPDATE chats SET updated_at = ? WHERE id = ?", (now, chat_id))
+        return {"id": cursor.lastrowid, "role": role, "content": content, "created_at": now}
+
+    def recent_questions(self, limit=5000):
+        """Последние вопросы пользователей во всех чатах, новые первыми (для прогрева кэша ответов)"""
+        rows = self._connection().execute(
+            "SELECT content FROM messages WHERE role = 'user' ORDER BY id DESC LIMIT ?", (limit,)
+        )
+        return [row[0] for row in rows]
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK: писатель сразу берет блокировку WAL"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
+        return False
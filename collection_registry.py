@@ -0,0 +1,264 @@
+"""Реестр коллекций документов с загрузкой индексов по требованию.
+
+Коллекция - папка документов, индекс и модель эмбеддингов. Нормативная (normative)
+и ТТ (tt) описаны по умолчанию, новые коллекции добавляются в collections.json без
+изменения кода:
+
+    {"collections": [
+        {"name": "relay", "title": "Релейная защита", "docs_dir": "files_relay",
+         "index_dir": "./faiss_index_relay",
+         "embedding_model": "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"},
+        {"name": "gost_7746", "title": "ГОСТ 7746-2015", "base": "normative",
+         "filter": {"filename": ["ГОСТ 7746-2015.pdf"]}}
+    ]}
+
+Коллекция с base не строит свой индекс: она ищет в индексе базовой коллекции только
+среди фрагментов, метаданные которых подходят под filter (IDSelector внутри FAISS,
+см. retrievers.faiss_search). Индексы коллекций с docs_dir собираются и обновляются
+index_manager.py так же, как нормативный.
+
+CollectionCache загружает индекс коллекции при первом обращении и выгружает давно
+не использованные индексы, когда их суммарный размер превышает бюджет памяти.
+Индексы снимка IndexManager (нормативный и ТТ) используются без повторной загрузки.
+С процессом поиска (RETRIEVAL_WORKER) индексы коллекций загружает он, а здесь
+остаются только прокси (retrieval_worker.RetrievalClient.open_collection).
+"""
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+REGISTRY_FILE = "collections.json"
+MEMORY_BUDGET_ENV = "COLLECTIONS_MEMORY_MB"
+MEMORY_BUDGET_MB = 2048
+
+# Коллекции, индексы которых держит снимок IndexManager (загружаются сразу)
+DEFAULT_COLLECTIONS = {
+    "normative": {"title": "Нормативные документы", "docs_dir": "files", "index_dir": "./faiss_index",
+                  "calibrate": True},
+    "tt": {"title": "Документы ТТ", "docs_dir": "files_TT", "index_dir": "./faiss_index_tt", "calibrate": False},
+}
+COLLECTION_DEFAULTS = {
+    "title": None,
+    "docs_dir": None,
+    "index_dir": None,
+    "embedding_model": None,   # None - модель процесса (как у нормативного индекса)
+    "calibrate": False,
+    "base": None,
+    "filter": None,
+}
+
+LoadedIndex = namedtuple("LoadedIndex", ["name", "index_dir", "vectorstore", "parent_store", "calibration", "size"])
+
+
+def _normalize(name, entry):
+    config = dict(COLLECTION_DEFAULTS)
+    config.update(entry)
+    config["name"] = name
+    config["title"] = config["title"] or name
+    if config["filter"] is not None and not isinstance(config["filter"], dict):
+        raise ValueError(f"Коллекция {name}: filter должен быть объектом {{поле: значение или список}}")
+    if not config["base"] and not config["index_dir"]:
+        raise ValueError(f"Коллекция {name}: нужен index_dir или base")
+    return config
+
+
+def load_registry(path=REGISTRY_FILE):
+    """{имя: описание коллекции}: коллекции по умолчанию и collections.json"""
+    entries = {name: dict(config) for name, config in DEFAULT_COLLECTIONS.items()}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        for entry in data.get("collections", []):
+            if "name" not in entry:
+                raise ValueError(f"{path}: у коллекции нет name")
+            entries[entry["name"]] = dict(entries.get(entry["name"], {}), **entry)
+    registry = {name: _normalize(name, entry) for name, entry in entries.items()}
+    for config in registry.values():
+        base = config["base"]
+        if base and (base not in registry or registry[base]["base"]):
+            raise ValueError(f"Коллекция {config['name']}: базовая коллекция {base} не найдена или сама ссылается на другую")
+    return registry
+
+
+def index_owner(registry, name):
+    """Коллекция, которой принадлежит индекс (сама коллекция или ее base)"""
+    if name not in registry:
+        raise KeyError(f"Коллекция {name} не найдена")
+    config = registry[name]
+    return registry[config["base"]] if config["base"] else config
+
+
+def indexed_collections(registry=None):
+    """Коллекции со своими документами и индексом - их собирает и обновляет index_manager.py"""
+    registry = registry if registry is not None else load_registry()
+    return {name: config for name, config in registry.items() if config["docs_dir"] and not config["base"]}
+
+
+def index_footprint(index_dir):
+    """Оценка памяти индекса в байтах: файлы FAISS и docstore (у шардированного - всех частей)"""
+    total = 0
+    for root, dirs, files in os.walk(index_dir):
+        total += sum(os.path.getsize(os.path.join(root, file)) for file in files
+                     if file in ("index.faiss", "index.pkl"))
+    return total
+
+
+def load_collection_resources(config, index):
+    """Цепочка RAG коллекции поверх загруженного индекса (loader по умолчанию для CollectionCache)"""
+    from answer_cache import index_cache
+    from chain_factory import create_routed_chain
+    from table_store import TableStore
+    from terms_index import TermsIndex
+
+    return {
+        "collection": config,
+        "vectorstore": index.vectorstore,
+        "parent_store": index.parent_store,
+        "qa_chain": create_routed_chain(index.vectorstore, mode="rag", calibration=index.calibration,
+                                        parent_store=index.parent_store, metadata_filter=config["filter"],
+                                        table_store=TableStore.open(index.index_dir),
+                                        terms_index=TermsIndex.open(index.index_dir),
+                                        answer_cache=index_cache(config["name"], index.index_dir)),
+    }
+
+
+class CollectionCache:
+    """Коллекции, загружаемые при первом обращении, с вытеснением по давности использования.
+
+    loader(config, index) строит ресурсы коллекции (цепочки) поверх LoadedIndex;
+    несколько коллекций с общим base делят один загруженный индекс. После публикации
+    новой версии индекса коллекции (index_manager.py) она загружается при следующем
+    обращении, а старая версия выгружается.
+    """
+
+    def __init__(self, embeddings, loader=load_collection_resources, registry=None, index_manager=None,
+                 memory_budget_mb=None):
+        self.embeddings = embeddings
+        self.loader = loader
+        self.registry = registry if registry is not None else load_registry()
+        self.index_manager = index_manager
+        if memory_budget_mb is None:
+            memory_budget_mb = float(os.environ.get(MEMORY_BUDGET_ENV, MEMORY_BUDGET_MB))
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._load_locks = {}           # имя коллекции индекса -> блокировка его загрузки
+        self._indexes = OrderedDict()   # папка версии индекса -> LoadedIndex, давно использованные первыми
+        self._resources = {}            # имя коллекции -> (папка версии индекса, ресурсы)
+        self._model_embeddings = {}
+        self._model_lock = threading.Lock()
+        self._stats = {"hits": 0, "loads": 0, "evictions": 0}
+
+    def titles(self):
+        """{имя: заголовок} коллекций для выбора в интерфейсе"""
+        return {name: config["title"] for name, config in self.registry.items()}
+
+    def get(self, name):
+        """Ресурсы коллекции (см. load_collection_resources); загружает индекс при необходимости"""
+        from index_manager import current_index_dir
+
+        config = self.registry.get(name)
+        if config is None:
+            raise KeyError(f"Коллекция {name} не найдена")
+        owner = index_owner(self.registry, name)
+        index_dir = current_index_dir(owner["index_dir"])
+        with self._lock:
+            resources = self._cached(name, index_dir)
+            if resources is not None:
+                return resources
+            load_lock = self._load_locks.setdefault(owner["name"], threading.Lock())
+        # Загрузка идет под блокировкой своей коллекции: запросы к другим коллекциям ее не ждут
+        with load_lock:
+            with self._lock:
+                resources = self._cached(name, index_dir)
+                if resources is not None:
+                    return resources
+                index = self._snapshot_index(owner["name"], index_dir) or self._indexes.get(index_dir)
+            if index is None:
+                index = self._load_index(owner, index_dir)
+            resources = self.loader(config, index)
+            with self._lock:
+                # Индекс мог быть вытеснен, пока строилась цепочка (индексы снимка и
+                # процесса поиска не вытесняются)
+                if index_dir in self._indexes or index.size == 0:
+                    self._resources[name] = (index_dir, resources)
+            return resources
+
+    def _cached(self, name, index_dir):
+        """Ресурсы коллекции для этой версии индекса, если они уже построены (под self._lock)"""
+        cached = self._resources.get(name)
+        if cached is None or cached[0] != index_dir:
+            return None
+        self._stats["hits"] += 1
+        if index_dir in self._indexes:
+            self._indexes.move_to_end(index_dir)
+        return cached[1]
+
+    def _snapshot_index(self, name, index_dir):
+        """Индекс из снимка IndexManager, если там та же версия (не занимает бюджет кэша)"""
+        if self.index_manager is None:
+            return None
+        snapshot = self.index_manager.current()
+        indexes = snapshot.resources.get("indexes", {})
+        if name not in indexes or snapshot.index_dirs.get(name) != index_dir:
+            return None
+        vectorstore, parent_store, calibration = indexes[name]
+        return LoadedIndex(name, index_dir, vectorstore, parent_store, calibration, 0)
+
+    def _embeddings_for(self, model_name):
+        if not model_name or model_name == getattr(self.embeddings, "model_name", None):
+            return self.embeddings
+        with self._model_lock:
+            if model_name not in self._model_embeddings:
+                from embedding_service import BatchingEmbeddings
+                from embeddings_backend import create_embeddings
+                self._model_embeddings[model_name] = BatchingEmbeddings(create_embeddings(model_name))
+            return self._model_embeddings[model_name]
+
+    def _load_index(self, owner, index_dir):
+        """Загружает версию индекса коллекции (под блокировкой загрузки коллекции)"""
+        from retrieval_worker import RemoteEmbeddings
+        from retrievers import load_calibration
+        from sharded_index import has_index, load_index
+
+        if not has_index(index_dir):
+            raise FileNotFoundError(f"Индекс коллекции {owner['name']} не найден: {index_dir}. "
+                                    f"Соберите его: python index_manager.py --index {owner['name']}")
+        if isinstance(self.embeddings, RemoteEmbeddings):
+            # Индекс загружает процесс поиска; прокси не занимают бюджет памяти этого процесса
+            vectorstore, parent_store, calibration = self.embeddings.client.open_collection(owner["name"])
+            with self._lock:
+                self._stats["loads"] += 1
+            return LoadedIndex(owner["name"], index_dir, vectorstore, parent_store, calibration, 0)
+        size = index_footprint(index_dir)
+        with self._lock:
+            # Предыдущая версия этого индекса больше не нужна
+            for stale_dir, stale in list(self._indexes.items()):
+                if stale.name == owner["name"]:
+                    self._evict(stale_dir)
+            while self._indexes and sum(index.size for index in self._indexes.values()) + size > self.memory_budget:
+                self._evict(next(iter(self._indexes)))
+        embeddings = self._embeddings_for(owner["embedding_model"])
+        vectorstore, parent_store = load_index(index_dir, embeddings)
+        index = LoadedIndex(owner["name"], index_dir, vectorstore, parent_store,
+                            load_calibration(index_dir, embeddings), size)
+        with self._lock:
+            self._indexes[index_dir] = index
+            self._stats["loads"] += 1
+        logging.info(f"Collection index loaded - {owner['name']} - {index_dir} - {size / 1024 / 1024:.1f} MB")
+        return index
+
+    def _evict(self, index_dir):
+        # Запросы, уже получившие цепочку, дорабатывают на ней; память освобождается после них
+        index = self._indexes.pop(index_dir)
+        for name in [name for name, (cached_dir, _) in self._resources.items() if cached_dir == index_dir]:
+            del self._resources[name]
+        self._stats["evictions"] += 1
+        logging.info(f"Collection index evicted - {index.name} - {index_dir}")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, resident={index.name: round(index.size / 1024 / 1024, 1)
+                                               for index in self._indexes.values()},
+                        budget_mb=round(self.memory_budget / 1024 / 1024, 1))
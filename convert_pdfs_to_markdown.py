@@ -0,0 +1,325 @@
+"""Конвертация PDF в Markdown по страницам: таблицы, формулы, заголовки.
+
+Каждая страница преобразуется отдельно: таблицы (fitz find_tables) выводятся
+Markdown-таблицами, строки с формулами - с сохранением индексов и степеней
+и исправлением символов из шрифтов Symbol, крупные и нумерованные жирные
+строки - заголовками. Колонтитулы (блоки в верхнем и нижнем полях страницы,
+повторяющиеся на большинстве страниц документа), номера страниц и стандартные
+преамбулы ГОСТ удаляются. Страницы конвертируются в пуле процессов, результат
+кэшируется по хэшу содержимого страницы, поэтому при повторной индексации
+неизмененные страницы не обрабатываются заново.
+
+Используется при индексации в main.py; отдельно:
+    python convert_pdfs_to_markdown.py input_directory [output_directory]
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import os
+import re
+import sys
+import time
+from collections import Counter
+
+import fitz
+
+# Версия преобразования входит в ключ кэша: при изменении алгоритма кэш пересчитывается
+CONVERTER_VERSION = "3"
+MARKDOWN_CACHE_DIR = "./markdown_cache"
+PAGE_SEPARATOR = "\n\n"
+
+# Символы из Private Use Area шрифтов Symbol/Wingdings, в которые превращаются знаки формул
+FORMULA_FIXES = {
+    "\uf02b": "+", "\uf02d": "−", "\uf03d": "=", "\uf03c": "<", "\uf03e": ">",
+    "\uf0a3": "≤", "\uf0b3": "≥", "\uf0b1": "±", "\uf0b4": "×", "\uf0b8": "÷", "\uf0d7": "·",
+    "\uf0b0": "°", "\uf0a5": "∞", "\uf0bb": "≈", "\uf0b9": "≠", "\uf0d6": "√", "\uf0e5": "∑",
+    "\uf0f2": "∫", "\uf0b6": "∂", "\uf0c4": "⊗", "\uf0ae": "→",
+    "\uf061": "α", "\uf062": "β", "\uf067": "γ", "\uf064": "δ", "\uf065": "ε", "\uf068": "η",
+    "\uf071": "θ", "\uf06c": "λ", "\uf06d": "μ", "\uf070": "π", "\uf072": "ρ", "\uf073": "σ",
+    "\uf074": "τ", "\uf06a": "φ", "\uf079": "ψ", "\uf077": "ω", "\uf044": "Δ", "\uf057": "Ω",
+    "\uf046": "Φ", "\uf053": "Σ",
+    "\ufb01": "fi", "\ufb02": "fl",
+}
+FORMULA_CHARS = set("=≤≥±×÷·√∑∫∂≈≠∞^") | set("αβγδεηθλμπρστφψωΔΩΦΣ")
+# Индексы и степени - простым текстом (промпты запрещают модели LaTeX): Unicode, если все
+# символы есть в надстрочном/подстрочном виде, иначе I_ном и 10^(n+1)
+SUPERSCRIPTS = str.maketrans("0123456789+-−=()ni", "⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁻⁼⁽⁾ⁿⁱ")
+SUBSCRIPTS = str.maketrans("0123456789+-−=()aehijklmnoprstuvx", "₀₁₂₃₄₅₆₇₈₉₊₋₋₌₍₎ₐₑₕᵢⱼₖₗₘₙₒₚᵣₛₜᵤᵥₓ")
+MATH_FONT_MARKERS = ("symbol", "math", "mt extra", "euclid")
+
+HEADING_NUMBER = re.compile(r"^\d+(\.\d+)*\.?\s+\S")
+
+# Колонтитулы: доля высоты страницы сверху и снизу и доля страниц, на которых блок повторяется
+MARGIN_RATIO = 0.08
+REPEAT_RATIO = 0.5
+MIN_REPEAT_PAGES = 3
+PAGE_NUMBER = re.compile(r"^(стр(аница)?\.?\s*)?([\dIVXLC]+|-\s*\d+\s*-)(\s*(из|/)\s*\d+)?$", re.IGNORECASE)
+# Стандартные преамбулы, повторяющиеся во всех ГОСТ и изданиях
+BOILERPLATE_PATTERNS = [
+    re.compile(r"^издание официальное$", re.IGNORECASE),
+    re.compile(r"не может быть полностью или частично воспроизведен", re.IGNORECASE),
+    re.compile(r"^перепечатка воспрещена$", re.IGNORECASE),
+]
+
+# Флаги шрифта в fitz: бит 0 - надстрочный, бит 4 - жирный
+SUPERSCRIPT_FLAG = 1
+BOLD_FLAG = 16
+
+
+def fix_formula_symbols(text):
+    """Заменяет поврежденные символы формул на Unicode"""
+    return text.translate(str.maketrans(FORMULA_FIXES))
+
+
+def _block_signature(text):
+    """Нормализованный текст блока: без регистра, пробелов и конкретных чисел"""
+    text = text.lower().replace("ё", "е")
+    text = re.sub(r"\d+", "#", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def _in_margin(bbox, page_rect):
+    band = page_rect.height * MARGIN_RATIO
+    return bbox[3] <= page_rect.y0 + band or bbox[1] >= page_rect.y1 - band
+
+
+def find_running_blocks(doc):
+    """Подписи блоков полей страницы, повторяющихся на большинстве страниц (колонтитулы)"""
+    counts = {}
+    for page in doc:
+        signatures = {
+            _block_signature(block[4])
+            for block in page.get_text("blocks", flags=fitz.TEXTFLAGS_TEXT)
+            if block[6] == 0 and _in_margin(block[:4], page.rect)
+        }
+        for signature in signatures - {""}:
+            counts[signature] = counts.get(signature, 0) + 1
+    min_pages = max(MIN_REPEAT_PAGES, doc.page_count * REPEAT_RATIO)
+    return frozenset(signature for signature, count in counts.items() if count >= min_pages)
+
+
+def is_boilerplate(text, bbox, page_rect, running_blocks=frozenset()):
+    """Колонтитул, номер страницы или стандартная преамбула"""
+    stripped = " ".join(text.split())
+    if _in_margin(bbox, page_rect) and (
+            _block_signature(stripped) in running_blocks or PAGE_NUMBER.match(stripped)):
+        return True
+    return any(pattern.search(stripped) for pattern in BOILERPLATE_PATTERNS)
+
+
+def page_hash(page, running_blocks=frozenset()):
+    """Хэш содержимого страницы: потоки команд, шрифты, размеры, колонтитулы документа и версия конвертера"""
+    digest = hashlib.sha256(CONVERTER_VERSION.encode())
+    digest.update("\n".join(sorted(running_blocks)).encode())
+    digest.update(str(tuple(page.rect)).encode())
+    digest.update(page.read_contents())
+    digest.update(str([font[1:] for font in page.get_fonts()]).encode())
+    # Текст может находиться во вложенных формах (XObject), а не в потоке страницы
+    for xref, *_ in page.get_xobjects():
+        digest.update(page.parent.xref_stream(xref) or b"")
+    return digest.hexdigest()
+
+
+def _cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], f"{key}.md")
+
+
+def _read_cache(cache_dir, key):
+    path = _cache_path(cache_dir, key)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def _write_cache(cache_dir, key, markdown):
+    path = _cache_path(cache_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(markdown)
+    os.replace(tmp_path, path)
+
+
+def _inside(bbox, rects):
+    x0, y0, x1, y1 = bbox
+    cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+    return any(r.x0 <= cx <= r.x1 and r.y0 <= cy <= r.y1 for r in rects)
+
+
+def _script_text(text, table, marker):
+    """Индекс или степень простым текстом: Unicode-символы или marker с текстом (в скобках, если длинный)"""
+    if all(ord(ch) in table for ch in text):
+        return text.translate(table)
+    return f"{marker}{text}" if len(text) == 1 or text.isalpha() else f"{marker}({text})"
+
+
+def _span_text(span, line_size, baseline):
+    """(текст фрагмента, индекс или степень ли это)"""
+    text = fix_formula_symbols(span["text"])
+    if not text.strip():
+        return text, False
+    small = span["size"] < line_size * 0.8
+    if span["flags"] & SUPERSCRIPT_FLAG or (small and span["origin"][1] < baseline - 1):
+        return _script_text(text.strip(), SUPERSCRIPTS, "^"), True
+    if small and span["origin"][1] > baseline + 1:
+        return _script_text(text.strip(), SUBSCRIPTS, "_"), True
+    return text, False
+
+
+def _line_to_markdown(line, body_size):
+    spans = [span for span in line["spans"] if span["text"]]
+    if not spans:
+        return ""
+    line_size = max(span["size"] for span in spans)
+    # Базовая линия - у самого крупного фрагмента строки
+    baseline = max(spans, key=lambda span: span["size"])["origin"][1]
+    parts = [_span_text(span, line_size, baseline) for span in spans]
+    text = "".join(part for part, _ in parts).strip()
+    if not text:
+        return ""
+
+    math_font = any(marker in span["font"].lower() for span in spans for marker in MATH_FONT_MARKERS)
+    formula_chars = sum(ch in FORMULA_CHARS for ch in text)
+    if math_font or any(scripted for _, scripted in parts) or formula_chars >= 2:
+        # Строка с формулой - как есть, без разметки заголовков
+        return text
+
+    bold = all(span["flags"] & BOLD_FLAG for span in spans)
+    if line_size >= body_size * 1.2 and len(text) < 150:
+        return f"## {text}"
+    if bold and HEADING_NUMBER.match(text) and len(text) < 150:
+        return f"### {text}"
+    return text
+
+
+def page_to_markdown(page, running_blocks=frozenset()):
+    """Markdown одной страницы: текстовые блоки и таблицы в порядке чтения, без колонтитулов"""
+    items = []
+    table_rects = []
+    try:
+        tables = page.find_tables()
+    except Exception:
+        tables = []
+    for table in tables:
+        markdown = table.to_markdown(clean=False).strip()
+        if markdown:
+            rect = fitz.Rect(table.bbox)
+            table_rects.append(rect)
+            items.append((rect.y0, rect.x0, fix_formula_symbols(markdown)))
+
+    blocks = []
+    for block in page.get_text("dict", flags=fitz.TEXTFLAGS_TEXT)["blocks"]:
+        if block.get("type") != 0 or _inside(block["bbox"], table_rects):
+            continue
+        block_text = "\n".join("".join(span["text"] for span in line["spans"]) for line in block["lines"])
+        if not is_boilerplate(block_text, block["bbox"], page.rect, running_blocks):
+            blocks.append(block)
+
+    # Основной размер шрифта - тот, которым набрано больше всего символов
+    chars_by_size = Counter()
+    for block in blocks:
+        for line in block["lines"]:
+            for span in line["spans"]:
+                chars_by_size[round(span["size"], 1)] += len(span["text"].strip())
+    body_size = chars_by_size.most_common(1)[0][0] if chars_by_size else 10.0
+
+    for block in blocks:
+        lines = [_line_to_markdown(line, body_size) for line in block["lines"]]
+        lines = [line for line in lines if line]
+        if lines:
+            items.append((block["bbox"][1], block["bbox"][0], "\n".join(lines)))
+
+    items.sort(key=lambda item: (round(item[0]), item[1]))
+    return "\n\n".join(text for _, _, text in items)
+
+
+# Открытые документы в процессе пула, чтобы не открывать PDF на каждую страницу
+_open_documents = {}
+
+
+def _convert_page(pdf_path, page_number, running_blocks):
+    doc = _open_documents.get(pdf_path)
+    if doc is None:
+        doc = _open_documents[pdf_path] = fitz.open(pdf_path)
+    return page_to_markdown(doc[page_number], running_blocks)
+
+
+def convert_pdfs(pdf_paths, workers=None, cache_dir=MARKDOWN_CACHE_DIR, use_cache=True):
+    """Конвертирует PDF в Markdown по страницам: {путь: [markdown страницы, ...]}"""
+    started = time.perf_counter()
+    results, keys, pending = {}, {}, []
+    for pdf_path in pdf_paths:
+        try:
+            with fitz.open(pdf_path) as doc:
+                results[pdf_path] = [None] * doc.page_count
+                running_blocks = find_running_blocks(doc)
+                for page in doc:
+                    key = page_hash(page, running_blocks)
+                    keys[(pdf_path, page.number)] = key
+                    cached = _read_cache(cache_dir, key) if use_cache else None
+                    if cached is None:
+                        pending.append((pdf_path, page.number, running_blocks))
+                    else:
+                        results[pdf_path][page.number] = cached
+        except Exception as e:
+            print(f"Ошибка при чтении {pdf_path}: {e}")
+            results.pop(pdf_path, None)
+
+    if pending:
+        workers = workers or os.cpu_count() or 1
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(pending))) as executor:
+            futures = {executor.submit(_convert_page, *item): item for item in pending}
+            for future in concurrent.futures.as_completed(futures):
+                pdf_path, page_number, _ = futures[future]
+                try:
+                    markdown = future.result()
+                except Exception as e:
+                    print(f"Ошибка конвертации {pdf_path}, стр. {page_number + 1}: {e}")
+                    markdown = ""
+                else:
+                    _write_cache(cache_dir, keys[(pdf_path, page_number)], markdown)
+                if pdf_path in results:
+                    results[pdf_path][page_number] = markdown
+
+    total = sum(len(pages) for pages in results.values())
+    print(f"Конвертация в Markdown: страниц {total}, из кэша {total - len(pending)}, "
+          f"обработано {len(pending)} за {time.perf_counter() - started:.1f} с")
+    return results
+
+
+def convert_pdf_to_markdown(pdf_path, **kwargs):
+    """Markdown всего документа"""
+    return PAGE_SEPARATOR.join(convert_pdfs([pdf_path], **kwargs).get(pdf_path, []))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Конвертация PDF в Markdown")
+    parser.add_argument("input_directory")
+    parser.add_argument("output_directory", nargs="?")
+    parser.add_argument("--workers", type=int, default=None, help="число процессов (по умолчанию - число ядер)")
+    parser.add_argument("--no-cache", action="store_true", help="конвертировать все страницы заново")
+    args = parser.parse_args()
+
+    output_directory = args.output_directory or args.input_directory
+    pdf_paths = [
+        os.path.join(root, name)
+        for root, _, names in os.walk(args.input_directory)
+        for name in names if name.lower().endswith(".pdf")
+    ]
+    if not pdf_paths:
+        print("PDF файлы не найдены")
+        sys.exit(1)
+
+    results = convert_pdfs(pdf_paths, workers=args.workers, use_cache=not args.no_cache)
+    for pdf_path, pages in results.items():
+        relative = os.path.relpath(pdf_path, args.input_directory)
+        md_path = os.path.join(output_directory, os.path.splitext(relative)[0] + ".md")
+        os.makedirs(os.path.dirname(md_path) or ".", exist_ok=True)
+        with open(md_path, "w", encoding="utf-8") as f:
+            f.write(PAGE_SEPARATOR.join(pages))
+        print(f"Сохранен {md_path}")
+
+
+if __name__ == "__main__":
+    main()
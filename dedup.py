@@ -0,0 +1,130 @@
+"""Удаление почти одинаковых фрагментов перед индексацией (MinHash + LSH).
+
+Несколько редакций одного стандарта и перекрытие чанков дают в индексе много
+почти совпадающих фрагментов: они вытесняют полезные результаты MMR и занимают
+память. Для каждого фрагмента строится MinHash по словесным шинглам, кандидаты
+в дубликаты находятся через LSH по полосам сигнатуры и проверяются по оценке
+сходства Жаккара. Из группы дубликатов остается самый длинный фрагмент, а имена
+файлов остальных сохраняются в его метаданных (duplicate_sources).
+"""
+import logging
+import re
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+DEDUP_DEFAULTS = {
+    "shingle_size": 5,     # слов в шингле
+    "num_perm": 128,       # длина сигнатуры MinHash
+    "bands": 16,           # полос LSH (по num_perm / bands строк)
+    "threshold": 0.85,     # минимальное сходство Жаккара для дубликата
+    "seed": 1
+}
+
+_MERSENNE_PRIME = (1 << 31) - 1
+
+
+def _shingles(text, size):
+    words = re.findall(r"\w+", text.lower().replace("ё", "е"))
+    if len(words) < size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def minhash_signatures(texts, shingle_size=5, num_perm=128, seed=1):
+    """Сигнатуры MinHash (len(texts), num_perm) по словесным шинглам"""
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    signatures = np.full((len(texts), num_perm), _MERSENNE_PRIME, dtype=np.uint64)
+    for row, text in enumerate(texts):
+        shingles = _shingles(text, shingle_size)
+        if not shingles:
+            continue
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) % _MERSENNE_PRIME for s in shingles),
+                             dtype=np.uint64, count=len(shingles))
+        # (a * x + b) mod p для всех перестановок сразу; произведение < 2^62
+        signatures[row] = ((np.outer(hashes, a) + b) % _MERSENNE_PRIME).min(axis=0)
+    return signatures
+
+
+def find_duplicate_groups(texts, **kwargs):
+    """Группы индексов почти одинаковых текстов (только группы из 2 и более)"""
+    params = dict(DEDUP_DEFAULTS)
+    params.update(kwargs)
+    signatures = minhash_signatures(texts, params["shingle_size"], params["num_perm"], params["seed"])
+    rows = params["num_perm"] // params["bands"]
+
+    parent = list(range(len(texts)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    checked = set()
+    for band in range(params["bands"]):
+        buckets = defaultdict(list)
+        for index, band_values in enumerate(signatures[:, band * rows:(band + 1) * rows]):
+            buckets[band_values.tobytes()].append(index)
+        for members in buckets.values():
+            for i, first in enumerate(members):
+                for second in members[i + 1:]:
+                    if (first, second) in checked or find(first) == find(second):
+                        continue
+                    checked.add((first, second))
+                    similarity = np.mean(signatures[first] == signatures[second])
+                    if similarity >= params["threshold"]:
+                        parent[find(second)] = find(first)
+
+    groups = defaultdict(list)
+    for index in range(len(texts)):
+        groups[find(index)].append(index)
+    return [members for members in groups.values() if len(members) > 1]
+
+
+def deduplicate_chunks(chunks, metadatas, **kwargs):
+    """Удаляет почти одинаковые фрагменты; возвращает (chunks, metadatas, отчет)"""
+    groups = find_duplicate_groups(chunks, **kwargs)
+    removed = set()
+    metadatas = [dict(metadata) for metadata in metadatas]
+    for members in groups:
+        keep = max(members, key=lambda index: len(chunks[index]))
+        sources = {metadatas[index].get("filename") for index in members if index != keep}
+        sources.discard(metadatas[keep].get("filename"))
+        if sources:
+            metadatas[keep]["duplicate_sources"] = sorted(s for s in sources if s)
+        removed.update(index for index in members if index != keep)
+
+    kept = [index for index in range(len(chunks)) if index not in removed]
+    report = {
+        "chunks_before": len(chunks),
+        "chunks_after": len(kept),
+        "removed": len(removed),
+        "groups": len(groups),
+        "chars_before": sum(len(chunk) for chunk in chunks),
+        "chars_after": sum(len(chunks[index]) for index in kept),
+    }
+    return [chunks[index] for index in kept], [metadatas[index] for index in kept], report
+
+
+def print_dedup_report(report, dimension=None, unit="фрагментов", removed_vectors=None):
+    """Печатает и пишет в лог, сколько места в индексе сэкономлено
+
+    unit - что дедуплицировалось (в родительном падеже); removed_vectors - сколько
+    векторов индекса не пришлось строить (по умолчанию по одному на удаленный фрагмент).
+    """
+    saved_share = report["removed"] / report["chunks_before"] if report["chunks_before"] else 0.0
+    message = (f"Дедупликация: {unit} {report['chunks_before']} -> {report['chunks_after']} "
+               f"(удалено {report['removed']} в {report['groups']} группах, {saved_share:.1%}), "
+               f"текста {report['chars_before']} -> {report['chars_after']} символов")
+    if dimension:
+        if removed_vectors is None:
+            removed_vectors = report["removed"]
+        # Векторы float32 в FAISS плюс текст в docstore
+        saved_bytes = removed_vectors * dimension * 4 + (report["chars_before"] - report["chars_after"]) * 2
+        message += f", индекс меньше примерно на {saved_bytes / 1024 / 1024:.1f} МБ"
+    print(message)
+    logging.info(f"Ingest dedup - {report}")
@@ -0,0 +1,142 @@
+"""Индекс документов для двухуровневого поиска (сначала документы, затем их фрагменты).
+
+При плоском поиске каждый запрос сравнивается со всеми фрагментами корпуса, и с
+ростом files/ до сотен стандартов растет и время поиска, и доля кандидатов MMR из
+посторонних документов. Поэтому при построении индекса (main.create_vectorstore)
+для каждого документа считается центроид - нормированное среднее векторов его
+фрагментов, - и сохраняется в documents.npz рядом с индексом FAISS вместе с номером
+документа каждого фрагмента.
+
+Запрос сначала сравнивается с центроидами (сотни векторов вместо сотен тысяч) и
+выбирает top_documents документов, затем FAISS ищет только среди их фрагментов:
+номера фрагментов документа идут подряд, поэтому каждый документ ищется в FAISS
+через IDSelectorRange (сравниваются только векторы диапазона), и стоимость поиска
+почти не зависит от размера корпуса. В шардированном индексе документы выбираются
+внутри каждой части.
+Пока документов в индексе не больше top_documents, поиск остается плоским.
+
+Выбор документов по центроидам может пропустить ближайшие фрагменты (на больших
+корпусах top_documents=8 находит 86-90% ближайших плоского поиска), поэтому по
+умолчанию двухуровневый поиск выключен. Калибровка индекса (retrievers.calibrate)
+включает его с наименьшим top_documents, при котором размеченные вопросы не теряют
+полноту; явная настройка top_documents режима важнее калибровки.
+"""
+import os
+
+import numpy as np
+
+DOCUMENT_INDEX_FILE = "documents.npz"
+TOP_DOCUMENTS = None                 # без калибровки и настройки режима - плоский поиск
+TOP_DOCUMENTS_GRID = (4, 8, 16, 32, 64)  # значения, которые проверяет калибровка
+# Больше непрерывных диапазонов - один поиск с IDSelectorBatch вместо поиска по каждому
+MAX_RANGE_SELECTORS = 16
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def build_document_index(vectorstore, index_dir):
+    """Считает центроиды документов по фрагментам индекса и сохраняет их; возвращает DocumentIndex"""
+    ntotal = vectorstore.index.ntotal
+    chunk_docs = np.full(ntotal, -1, dtype=np.int64)
+    for i, _id in vectorstore.index_to_docstore_id.items():
+        chunk_docs[i] = vectorstore.docstore.search(_id).metadata.get("doc_id", -1)
+    if ntotal == 0 or (chunk_docs < 0).any():
+        # Индекс без номеров документов (старый формат) - только плоский поиск
+        return None
+    vectors = _normalize(vectorstore.index.reconstruct_n(0, ntotal))
+    doc_ids = np.unique(chunk_docs)
+    positions = np.searchsorted(doc_ids, chunk_docs)
+    sums = np.zeros((len(doc_ids), vectors.shape[1]), dtype=np.float32)
+    np.add.at(sums, positions, vectors)
+    centroids = _normalize(sums).astype(np.float32)
+    os.makedirs(index_dir, exist_ok=True)
+    np.savez(os.path.join(index_dir, DOCUMENT_INDEX_FILE), centroids=centroids, chunk_docs=positions)
+    return DocumentIndex(centroids, positions)
+
+
+class DocumentIndex:
+    """Центроиды документов и номера их фрагментов в индексе FAISS"""
+
+    def __init__(self, centroids, chunk_docs):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.chunk_docs = np.asarray(chunk_docs, dtype=np.int64)
+        order = np.argsort(self.chunk_docs, kind="stable")
+        bounds = np.searchsorted(self.chunk_docs[order], np.arange(len(self.centroids) + 1))
+        self._chunks = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+
+    @classmethod
+    def open(cls, index_dir):
+        """Индекс документов папки или None, если индекс построен без него"""
+        path = os.path.join(index_dir, DOCUMENT_INDEX_FILE)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return cls(data["centroids"], data["chunk_docs"])
+
+    @property
+    def size(self):
+        return len(self.centroids)
+
+    def documents_of(self, chunk_ids):
+        """Номера документов, которым принадлежат фрагменты"""
+        return np.unique(self.chunk_docs[chunk_ids])
+
+    def top_documents(self, queries, n, allowed=None):
+        """(число запросов, n) номеров документов с ближайшими центроидами; allowed - допустимые документы"""
+        similarity = _normalize(np.asarray(queries, dtype=np.float32)) @ self.centroids.T
+        if allowed is not None:
+            mask = np.full(self.size, -np.inf, dtype=np.float32)
+            mask[allowed] = 0.0
+            similarity = similarity + mask
+            n = min(n, len(allowed))
+        n = min(n, self.size)
+        if n == 0:
+            return np.zeros((len(similarity), 0), dtype=np.int64)
+        return np.argpartition(-similarity, n - 1, axis=1)[:, :n]
+
+    def chunk_ids(self, documents):
+        """Отсортированные номера фрагментов документов в индексе FAISS"""
+        if len(documents) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(np.concatenate([self._chunks[doc] for doc in documents]))
+
+
+def search_chunks(index, query, k, ids):
+    """(оценки, номера) k ближайших к запросу (1, d) только среди фрагментов ids (отсортированы)
+
+    Каждый непрерывный диапазон номеров ищется отдельно с IDSelectorRange: для плоского
+    индекса FAISS тогда сравнивает запрос только с векторами диапазона, а не проверяет
+    принадлежность каждого вектора индекса. Слишком раздробленный набор ищется одним
+    запросом с IDSelectorBatch.
+    """
+    import faiss
+
+    scores = np.zeros(k, dtype=np.float32)
+    indices = np.full(k, -1, dtype=np.int64)
+    if len(ids) == 0:
+        return scores, indices
+    breaks = np.flatnonzero(np.diff(ids) != 1) + 1
+    starts = ids[np.concatenate(([0], breaks))]
+    ends = ids[np.concatenate((breaks - 1, [len(ids) - 1]))] + 1
+    if len(starts) > MAX_RANGE_SELECTORS:
+        selector = faiss.IDSelectorBatch(ids.astype(np.int64))
+        found_scores, found_indices = index.search(query, k, params=faiss.SearchParameters(sel=selector))
+        return found_scores[0], found_indices[0]
+    found_scores, found_indices = [], []
+    for run_start, run_end in zip(starts, ends):
+        selector = faiss.IDSelectorRange(int(run_start), int(run_end))
+        run_scores, run_indices = index.search(query, min(k, int(run_end - run_start)),
+                                               params=faiss.SearchParameters(sel=selector))
+        found_scores.append(run_scores[0])
+        found_indices.append(run_indices[0])
+    found_scores, found_indices = np.concatenate(found_scores), np.concatenate(found_indices)
+    valid = found_indices != -1
+    found_scores, found_indices = found_scores[valid], found_indices[valid]
+    # Для скалярного произведения лучше большие оценки, для L2 - меньшие
+    order = np.argsort(-found_scores if index.metric_type == faiss.METRIC_INNER_PRODUCT else found_scores,
+                       kind="stable")[:k]
+    scores[:len(order)], indices[:len(order)] = found_scores[order], found_indices[order]
+    return scores, indices
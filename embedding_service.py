@@ -0,0 +1,127 @@
+"""Сервис кодирования запросов с микропакетированием.
+
+Одновременные сессии кодируют вопросы по одному, а на CPU один проход модели
+по пачке заметно дешевле N одиночных. BatchingEmbeddings оборачивает любую
+модель эмбеддингов LangChain: embed_query ставит текст в очередь, фоновый поток
+собирает запросы в течение max_wait_ms (или до max_batch штук), кодирует их
+одним вызовом embed_documents и раздает результаты ожидающим вызовам.
+embed_documents (индексация, пачки разделов ТТ) передается модели напрямую.
+"""
+import logging
+import queue
+import statistics
+import threading
+import time
+from collections import Counter, deque
+
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_MAX_BATCH = 32
+DEFAULT_MAX_WAIT_MS = 5.0
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class _PendingQuery:
+    __slots__ = ("text", "enqueued", "done", "vector", "error")
+
+    def __init__(self, text):
+        self.text = text
+        self.enqueued = time.perf_counter()
+        self.done = threading.Event()
+        self.vector = None
+        self.error = None
+
+
+class BatchingEmbeddings(Embeddings):
+    """Эмбеддинги с объединением одновременных embed_query в один проход модели"""
+
+    def __init__(self, base, max_batch=DEFAULT_MAX_BATCH, max_wait_ms=DEFAULT_MAX_WAIT_MS,
+                 report_every=500, history=10000):
+        self.base = base
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.report_every = report_every
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._waits = deque(maxlen=history)
+        self._encode_times = deque(maxlen=history)
+        self._batches = 0
+        self._thread = threading.Thread(target=self._collector, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    @property
+    def model_name(self):
+        return getattr(self.base, "model_name", None)
+
+    def embed_documents(self, texts):
+        return self.base.embed_documents(texts)
+
+    def embed_query(self, text):
+        pending = _PendingQuery(text)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.vector
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = batch[0].enqueued + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _collector(self):
+        while True:
+            batch = self._collect_batch()
+            started = time.perf_counter()
+            try:
+                vectors = self.base.embed_documents([pending.text for pending in batch])
+                for pending, vector in zip(batch, vectors):
+                    pending.vector = vector
+            except Exception as e:
+                logging.error(f"Query embedding batch error ({len(batch)} queries): {e}")
+                for pending in batch:
+                    pending.error = e
+            finally:
+                for pending in batch:
+                    pending.done.set()
+            self._record(batch, started, time.perf_counter())
+
+    def _record(self, batch, started, finished):
+        with self._stats_lock:
+            self._batches += 1
+            self._batch_sizes[len(batch)] += 1
+            self._waits.extend(started - pending.enqueued for pending in batch)
+            self._encode_times.append(finished - started)
+            should_report = self.report_every and self._batches % self.report_every == 0
+        if should_report:
+            logging.info(f"Query embedding batching - {self.stats()}")
+
+    def stats(self):
+        """Размеры пачек и добавленная ожиданием задержка (мс)"""
+        with self._stats_lock:
+            requests = sum(size * count for size, count in self._batch_sizes.items())
+            waits_ms = [wait * 1000 for wait in self._waits]
+            encode_ms = [seconds * 1000 for seconds in self._encode_times]
+            return {
+                "batches": self._batches,
+                "queries": requests,
+                "avg_batch": round(requests / self._batches, 2) if self._batches else 0.0,
+                "max_batch": max(self._batch_sizes, default=0),
+                "batch_sizes": dict(sorted(self._batch_sizes.items())),
+                "added_wait_ms_p50": round(_percentile(waits_ms, 50), 2),
+                "added_wait_ms_p95": round(_percentile(waits_ms, 95), 2),
+                "encode_ms_avg": round(statistics.mean(encode_ms), 2) if encode_ms else 0.0,
+            }
@@ -0,0 +1,259 @@
+"""Выбор бэкенда эмбеддингов: PyTorch (HuggingFaceEmbeddings) или ONNX Runtime на CPU.
+
+Бэкенд задается переменной окружения EMBEDDINGS_BACKEND:
+    torch     - HuggingFaceEmbeddings (по умолчанию)
+    onnx      - модель, экспортированная в ONNX (float32)
+    onnx-int8 - то же с динамическим квантованием весов в int8
+
+Экспорт выполняется один раз (нужны optimum и torch) и сохраняется в
+./onnx_models/<модель>[-int8]; для работы экспортированной модели достаточно
+onnxruntime и tokenizers. Пулинг и нормализация берутся из конфигурации
+sentence-transformers модели, поэтому векторы совместимы с существующими индексами.
+
+Проверка отклонения от float модели и сравнение скорости:
+    python embeddings_backend.py --model sentence-transformers/paraphrase-multilingual-mpnet-base-v2 --compare
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import time
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+BACKEND_ENV = "EMBEDDINGS_BACKEND"
+ONNX_MODELS_DIR = "./onnx_models"
+ONNX_BATCH_SIZE = 32
+# Минимальная косинусная близость к float модели, ниже которой квантование считается рискованным
+DRIFT_WARNING_COSINE = 0.98
+
+SAMPLE_TEXTS = [
+    "Трансформатор тока должен выдерживать кратковременный ток термической стойкости.",
+    "Класс точности вторичной обмотки для измерений 0,5S, для защиты 5P или 10P.",
+    "Испытание электрической прочности изоляции проводят одноминутным напряжением.",
+    "Коэффициент безопасности приборов определяется при номинальной вторичной нагрузке.",
+    "Маркировка выводов первичной обмотки Л1 и Л2, вторичной - И1 и И2.",
+    "Характеристику намагничивания снимают со стороны вторичной обмотки.",
+    "Упаковка должна обеспечивать сохранность изделия при транспортировании.",
+    "Приемо-сдаточные испытания проводят для каждого трансформатора.",
+    "Номинальный вторичный ток 1 А или 5 А.",
+    "Точка насыщения определяется по увеличению тока намагничивания на 50% при росте напряжения на 10%.",
+    "The current transformer shall withstand the rated short-time thermal current.",
+    "Паспорт изделия содержит номинальные параметры и результаты испытаний.",
+]
+
+
+def _onnx_dir(model_name, quantize):
+    return os.path.join(ONNX_MODELS_DIR, model_name.replace("/", "__") + ("-int8" if quantize else ""))
+
+
+def _sentence_transformers_config(model_name):
+    """Пулинг, нормализация и максимальная длина из конфигурации sentence-transformers"""
+    from huggingface_hub import hf_hub_download
+
+    config = {"pooling": "mean", "normalize": False, "max_seq_length": 512}
+    try:
+        with open(hf_hub_download(model_name, "modules.json"), encoding="utf-8") as f:
+            modules = json.load(f)
+    except Exception:
+        # Обычная модель transformers без конфигурации sentence-transformers
+        return config
+    config["normalize"] = any(m.get("type", "").endswith("Normalize") for m in modules)
+    pooling_path = next((m["path"] for m in modules if m.get("type", "").endswith("Pooling")), None)
+    if pooling_path:
+        with open(hf_hub_download(model_name, f"{pooling_path}/config.json"), encoding="utf-8") as f:
+            pooling = json.load(f)
+        if pooling.get("pooling_mode_cls_token"):
+            config["pooling"] = "cls"
+        elif pooling.get("pooling_mode_max_tokens"):
+            config["pooling"] = "max"
+    try:
+        with open(hf_hub_download(model_name, "sentence_bert_config.json"), encoding="utf-8") as f:
+            config["max_seq_length"] = json.load(f).get("max_seq_length", config["max_seq_length"])
+    except Exception:
+        pass
+    return config
+
+
+def export_onnx(model_name, quantize=False):
+    """Экспортирует модель в ONNX (и квантует в int8), возвращает папку модели"""
+    target = _onnx_dir(model_name, quantize)
+    if os.path.exists(os.path.join(target, "model.onnx")):
+        return target
+    try:
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+    except ImportError as e:
+        raise ImportError("Для экспорта в ONNX установите optimum[onnxruntime]: pip install optimum[onnxruntime]") from e
+
+    print(f"Экспорт {model_name} в ONNX...")
+    float_dir = _onnx_dir(model_name, False)
+    if not os.path.exists(os.path.join(float_dir, "model.onnx")):
+        ORTModelForFeatureExtraction.from_pretrained(model_name, export=True).save_pretrained(float_dir)
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(float_dir)
+        with open(os.path.join(float_dir, "sentence_config.json"), "w", encoding="utf-8") as f:
+            json.dump(_sentence_transformers_config(model_name), f, indent=2)
+    if not quantize:
+        return float_dir
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    print("Квантование весов в int8...")
+    os.makedirs(target, exist_ok=True)
+    for name in os.listdir(float_dir):
+        if name != "model.onnx":
+            path = os.path.join(float_dir, name)
+            if os.path.isfile(path):
+                with open(path, "rb") as src, open(os.path.join(target, name), "wb") as dst:
+                    dst.write(src.read())
+    quantize_dynamic(os.path.join(float_dir, "model.onnx"), os.path.join(target, "model.onnx"),
+                     weight_type=QuantType.QInt8)
+    return target
+
+
+class OnnxEmbeddings(Embeddings):
+    """Эмбеддинги sentence-transformers модели через ONNX Runtime на CPU"""
+
+    def __init__(self, model_name, quantize=False, batch_size=ONNX_BATCH_SIZE, threads=None):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        self.model_name = model_name
+        self.quantize = quantize
+        self.batch_size = batch_size
+        model_dir = export_onnx(model_name, quantize)
+        with open(os.path.join(model_dir, "sentence_config.json"), encoding="utf-8") as f:
+            self.config = json.load(f)
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.config["max_seq_length"])
+        self.tokenizer.enable_padding()
+
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(os.path.join(model_dir, "model.onnx"), options,
+                                            providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def _encode(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+        hidden = self.session.run(None, feeds)[0]
+
+        mask = attention_mask[..., None].astype(np.float32)
+        if self.config["pooling"] == "cls":
+            vectors = hidden[:, 0]
+        elif self.config["pooling"] == "max":
+            vectors = np.where(mask > 0, hidden, -1e9).max(axis=1)
+        else:
+            vectors = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        if self.config["normalize"]:
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors
+
+    def embed_documents(self, texts):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self._encode(texts[start:start + self.batch_size]).tolist())
+        return vectors
+
+    def embed_query(self, text):
+        return self._encode([text])[0].tolist()
+
+
+def create_embeddings(model_name, backend=None):
+    """Эмбеддинги выбранного бэкенда (аргумент или EMBEDDINGS_BACKEND); при ошибке ONNX - PyTorch"""
+    backend = (backend or os.environ.get(BACKEND_ENV, "torch")).lower()
+    if backend in ("onnx", "onnx-int8"):
+        try:
+            return OnnxEmbeddings(model_name, quantize=backend == "onnx-int8")
+        except Exception as e:
+            logging.error(f"ONNX embeddings backend unavailable for {model_name}: {e}")
+            print(f"Warning: ONNX бэкенд эмбеддингов недоступен ({e}), используется PyTorch")
+    elif backend != "torch":
+        raise ValueError(f"Неизвестный бэкенд эмбеддингов: {backend}")
+    from langchain_huggingface import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(model_name=model_name)
+
+
+def _throughput(embeddings, texts, repeats):
+    embeddings.embed_documents(texts[:2])  # прогрев
+    started = time.perf_counter()
+    for _ in range(repeats):
+        vectors = embeddings.embed_documents(texts)
+    documents_per_second = len(texts) * repeats / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for text in texts:
+        embeddings.embed_query(text)
+    query_ms = (time.perf_counter() - started) / len(texts) * 1000
+    return np.array(vectors, dtype=np.float32), documents_per_second, query_ms
+
+
+def _cosine(a, b):
+    return (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+
+
+def _neighbour_overlap(reference, candidate, k=3):
+    """Доля совпадающих ближайших соседей (без самого текста) между двумя наборами векторов"""
+    def neighbours(vectors):
+        normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        similarity = normalized @ normalized.T
+        np.fill_diagonal(similarity, -np.inf)
+        return np.argsort(-similarity, axis=1)[:, :k]
+    return statistics.mean(
+        len(set(a) & set(b)) / k for a, b in zip(neighbours(reference), neighbours(candidate))
+    )
+
+
+def compare_backends(model_name, texts, repeats=3, backends=("onnx", "onnx-int8")):
+    """Отклонение ONNX векторов от float модели PyTorch и сравнение скорости"""
+    print(f"Модель: {model_name}, текстов: {len(texts)}, повторов: {repeats}")
+    reference, reference_dps, reference_query_ms = _throughput(create_embeddings(model_name, "torch"), texts, repeats)
+    print(f"{'бэкенд':<10} {'док/с':>8} {'запрос, мс':>11} {'cos мин':>8} {'cos сред':>9} {'соседи':>7}")
+    print(f"{'torch':<10} {reference_dps:>8.1f} {reference_query_ms:>11.1f} {1.0:>8.4f} {1.0:>9.4f} {1.0:>7.0%}")
+    report = {"torch": {"docs_per_second": reference_dps, "query_ms": reference_query_ms}}
+    for backend in backends:
+        vectors, dps, query_ms = _throughput(OnnxEmbeddings(model_name, quantize=backend == "onnx-int8"), texts, repeats)
+        cosine = _cosine(reference, vectors)
+        overlap = _neighbour_overlap(reference, vectors)
+        print(f"{backend:<10} {dps:>8.1f} {query_ms:>11.1f} {cosine.min():>8.4f} {cosine.mean():>9.4f} {overlap:>7.0%}")
+        report[backend] = {"docs_per_second": dps, "query_ms": query_ms,
+                           "cosine_min": float(cosine.min()), "cosine_mean": float(cosine.mean()),
+                           "neighbour_overlap": overlap}
+        if cosine.min() < DRIFT_WARNING_COSINE:
+            print(f"  ВНИМАНИЕ: {backend} отклоняется от float модели (cos < {DRIFT_WARNING_COSINE}), "
+                  f"индекс лучше перестроить тем же бэкендом")
+    logging.info(f"Embeddings backend comparison - Model: {model_name} - {json.dumps(report)}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ONNX бэкенд эмбеддингов: экспорт и проверка отклонения")
+    parser.add_argument("--model", default="sentence-transformers/paraphrase-multilingual-mpnet-base-v2")
+    parser.add_argument("--export", action="store_true", help="только экспортировать (float и int8)")
+    parser.add_argument("--compare", action="store_true", help="сравнить с PyTorch моделью")
+    parser.add_argument("--texts", help="файл с текстами для сравнения (по одному в строке)")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.export or not args.compare:
+        print(f"float32: {export_onnx(args.model, quantize=False)}")
+        print(f"int8: {export_onnx(args.model, quantize=True)}")
+    if args.compare:
+        texts = SAMPLE_TEXTS
+        if args.texts:
+            with open(args.texts, encoding="utf-8") as f:
+                texts = [line.strip() for line in f if line.strip()]
+        compare_backends(args.model, texts, repeats=args.repeats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+"""Локальная заглушка Ollama HTTP API для нагрузочного тестирования.
+
+Реализует /api/generate, /api/chat, /api/tags, /api/version и /api/show
+с настраиваемой скоростью генерации токенов, распределением задержки
+до первого токена, потоковой выдачей и инъекцией отказов.
+
+Запуск:
+    python fake_ollama.py --port 11435 --token-rate 25 --latency lognormal:0.8:0.4
+    set OLLAMA_HOST=http://127.0.0.1:11435   # и запускать app.py / main.py как обычно
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Словарь для генерации правдоподобного русскоязычного ответа
+FILLER_WORDS = [
+    "трансформатор", "тока", "согласно", "пункту", "требования", "к", "характеристикам",
+    "намагничивания", "определяются", "в", "соответствии", "с", "ГОСТ", "Р", "58669-2019",
+    "вторичная", "нагрузка", "коэффициент", "насыщения", "испытания", "проводят", "при",
+    "номинальной", "частоте", "раздел", "4.2.3", "класс", "точности", "5P", "10P",
+]
+
+
+class FakeOllamaConfig:
+    """Параметры поведения заглушки"""
+
+    def __init__(self, token_rate=30.0, latency="fixed:0.2", max_tokens=200,
+                 fail_rate=0.0, drop_rate=0.0, hang_rate=0.0, hang_seconds=300.0,
+                 parallel=1, models=("qwen3:8b",), seed=None):
+        self.token_rate = token_rate
+        self.latency = latency
+        self.max_tokens = max_tokens
+        self.fail_rate = fail_rate
+        self.drop_rate = drop_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.parallel = parallel
+        self.models = list(models)
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+
+    def sample_latency(self):
+        """Задержка до первого токена (сек) по заданному распределению.
+
+        Форматы: fixed:S, uniform:A:B, normal:MU:SIGMA, lognormal:MU:SIGMA, exp:MEAN
+        """
+        kind, *params = self.latency.split(":")
+        params = [float(p) for p in params]
+        with self.random_lock:
+            if kind == "fixed":
+                value = params[0]
+            elif kind == "uniform":
+                value = self.random.uniform(params[0], params[1])
+            elif kind == "normal":
+                value = self.random.gauss(params[0], params[1])
+            elif kind == "lognormal":
+                value = self.random.lognormvariate(params[0], params[1])
+            elif kind == "exp":
+                value = self.random.expovariate(1.0 / params[0])
+            else:
+                raise ValueError(f"Неизвестное распределение задержки: {self.latency}")
+        return max(0.0, value)
+
+    def roll(self, probability):
+        with self.random_lock:
+            return self.random.random() < probability
+
+    def randint(self, a, b):
+        with self.random_lock:
+            return self.random.randint(a, b)
+
+    def tokens(self, count):
+        with self.random_lock:
+            return [self.random.choice(FILLER_WORDS) for _ in range(count)]
+
+
+class FakeOllamaStats:
+    """Счетчики обработанных запросов"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failed = 0
+        self.dropped = 0
+        self.hung = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.tokens = 0
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "hung": self.hung,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "tokens": self.tokens,
+            }
+
+
+def _now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeOllama/0.1"
+
+    def log_message(self, format, *args):
+        logging.debug("fake_ollama: " + format, *args)
+
+    # --- вспомогательные методы ---
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b"{}"
+        try:
+            return json.loads(body or b"{}")
+        except json.JSONDecodeError:
+            return {}
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_chunk(self, payload):
+        data = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_chunks(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    # --- маршруты ---
+
+    def do_GET(self):
+        config = self.server.config
+        if self.path == "/api/tags":
+            models = [{"name": m, "model": m, "modified_at": _now_iso(), "size": 0} for m in config.models]
+            self._send_json(200, {"models": models})
+        elif self.path == "/api/version":
+            self._send_json(200, {"version": "0.0.0-fake"})
+        elif self.path == "/stats":
+            self._send_json(200, self.server.stats.snapshot())
+        elif self.path in ("/", "/api"):
+            self._send_json(200, {"status": "Ollama is running"})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        request = self._read_json()
+        if self.path == "/api/generate":
+            self._generate(request, chat=False)
+        elif self.path == "/api/chat":
+            self._generate(request, chat=True)
+        elif self.path == "/api/show":
+            self._send_json(200, {"modelfile": "", "parameters": "", "template": "",
+                                  "details": {"family": "fake"}, "capabilities": ["completion"]})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def _generate(self, request, chat):
+        config = self.server.config
+        stats = self.server.stats
+        model = request.get("model", config.models[0])
+        stream = request.get("stream", True)
+        options = request.get("options") or {}
+        num_predict = options.get("num_predict") or config.max_tokens
+        if num_predict is None or num_predict < 0:
+            num_predict = config.max_tokens
+        num_predict = min(num_predict, config.max_tokens)
+
+        with stats.lock:
+            stats.requests += 1
+
+        if config.roll(config.fail_rate):
+            with stats.lock:
+                stats.failed += 1
+            self._send_json(500, {"error": "injected failure"})
+            return
+
+        # Ollama обрабатывает ограниченное число запросов одновременно (OLLAMA_NUM_PARALLEL)
+        with self.server.slots:
+            with stats.lock:
+                stats.in_flight += 1
+                stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+            try:
+                self._run_generation(model, stream, chat, num_predict)
+            except (BrokenPipeError, ConnectionResetError):
+                logging.debug("fake_ollama: клиент закрыл соединение")
+            finally:
+                with stats.lock:
+                    stats.in_flight -= 1
+
+    def _run_generation(self, model, stream, chat, num_predict):
+        config = self.server.config
+        stats = self.server.stats
+        started = time.perf_counter()
+
+        if config.roll(config.hang_rate):
+            with stats.lock:
+                stats.hung += 1
+            time.sleep(config.hang_seconds)
+
+        time.sleep(config.sample_latency())
+        tokens = config.tokens(num_predict)
+        drop_at = None
+        if config.roll(config.drop_rate):
+            drop_at = config.randint(0, max(0, len(tokens) - 1))
+        interval = 1.0 / config.token_rate if config.token_rate > 0 else 0.0
+
+        def piece(text, done):
+            payload = {"model": model, "created_at": _now_iso(), "done": done}
+            if chat:
+                payload["message"] = {"role": "assistant", "content": text}
+            else:
+                payload["response"] = text
+            return payload
+
+        def final_payload(text=""):
+            payload = piece(text, True)
+            elapsed_ns = int((time.perf_counter() - started) * 1e9)
+            payload.update({
+                "done_reason": "stop",
+                "total_duration": elapsed_ns,
+                "load_duration": 0,
+                "prompt_eval_count": 0,
+                "prompt_eval_duration": 0,
+                "eval_count": len(tokens),
+                "eval_duration": elapsed_ns,
+            })
+            return payload
+
+        if not stream:
+            time.sleep(interval * len(tokens))
+            if drop_at is not None:
+                with stats.lock:
+                    stats.dropped += 1
+                self.close_connection = True
+                return
+            with stats.lock:
+                stats.tokens += len(tokens)
+            self._send_json(200, final_payload(" ".join(tokens)))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, token in enumerate(tokens):
+            if drop_at is not None and i == drop_at:
+                # Обрыв соединения посреди потока
+                with stats.lock:
+                    stats.dropped += 1
+                self.close_connection = True
+                return
+            time.sleep(interval)
+            self._send_chunk(piece(token + " ", False))
+            with stats.lock:
+                stats.tokens += 1
+        self._send_chunk(final_payload())
+        self._end_chunks()
+
+
+def create_server(host="127.0.0.1", port=11435, config=None):
+    """Создает (но не запускает) HTTP-сервер заглушки"""
+    server = ThreadingHTTPServer((host, port), FakeOllamaHandler)
+    server.daemon_threads = True
+    server.config = config or FakeOllamaConfig()
+    server.stats = FakeOllamaStats()
+    server.slots = threading.BoundedSemaphore(max(1, server.config.parallel))
+    return server
+
+
+def start_in_background(host="127.0.0.1", port=11435, config=None):
+    """Запускает заглушку в фоновом потоке и возвращает сервер"""
+    server = create_server(host, port, config)
+    thread = threading.Thread(target=server.serve_forever, name="fake-ollama", daemon=True)
+    thread.start()
+    return server
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Заглушка Ollama для нагрузочного тестирования")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--token-rate", type=float, default=30.0, help="токенов в секунду на запрос")
+    parser.add_argument("--latency", default="fixed:0.2",
+                        help="задержка до первого токена: fixed:S | uniform:A:B | normal:MU:SIGMA | lognormal:MU:SIGMA | exp:MEAN")
+    parser.add_argument("--max-tokens", type=int, default=200, help="длина ответа в токенах")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="доля запросов с HTTP 500")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="доля запросов с обрывом соединения")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="доля зависающих запросов")
+    parser.add_argument("--hang-seconds", type=float, default=300.0)
+    parser.add_argument("--parallel", type=int, default=1, help="аналог OLLAMA_NUM_PARALLEL")
+    parser.add_argument("--models", default="qwen3:8b", help="список моделей через запятую")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser
+
+
+def config_from_args(args):
+    return FakeOllamaConfig(
+        token_rate=args.token_rate, latency=args.latency, max_tokens=args.max_tokens,
+        fail_rate=args.fail_rate, drop_rate=args.drop_rate, hang_rate=args.hang_rate,
+        hang_seconds=args.hang_seconds, parallel=args.parallel,
+        models=[m.strip() for m in args.models.split(",") if m.strip()], seed=args.seed,
+    )
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    server = create_server(args.host, args.port, config_from_args(args))
+    print(f"Заглушка Ollama запущена на http://{args.host}:{args.port}")
+    print(f"Для приложения: OLLAMA_HOST=http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Статистика: {server.stats.snapshot()}")
+
+
+if __name__ == "__main__":
+    main()
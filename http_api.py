@@ -0,0 +1,539 @@
+"""HTTP API без интерфейса: поиск, ответ RAG и генерация ТТ для других инструментов.
+
+Легкий сервер на asyncio (только стандартная библиотека) поверх тех же цепочек,
+что и веб-интерфейс (IndexManager с горячей заменой версий индексов):
+
+    GET  /health                                     состояние и версия индексов, кэш ответов
+    POST /search  {"question": "...", "k": 5}        найденные фрагменты с релевантностью, без LLM
+    POST /answer  {"question": "...", "stream": true}  ответ RAG (каскад моделей)
+    POST /tt      {"question": "...", "stream": true}  технические требования по разделам
+
+При "stream": true (или заголовке Accept: text/event-stream) ответ идет
+событиями SSE: /answer - события token по мере генерации, /tt - события section
+по мере готовности разделов, в конце - done (или error). /search и /answer
+принимают "collection": "<имя>" - поиск по коллекции из collections.json
+(см. collection_registry.py) вместо нормативного индекса. Каждый запрос получает
+id (из заголовка X-Request-Id или новый), он возвращается в заголовке, в теле
+и в логе. Число одновременных запросов ограничено отдельно для поиска, ответов
+и ТТ; запрос, не дождавшийся места за queue_timeout, получает 503 с Retry-After.
+Соединения HTTP/1.1 держатся открытыми (keep-alive), потоковые ответы идут
+с chunked-кодированием, поэтому соединение можно использовать повторно.
+В простое частые вопросы заранее отвечаются в кэш ответов (cache_warmer.py).
+
+Запуск (с заглушкой Ollama для нагрузочного теста):
+    python http_api.py --port 8080 --fake-ollama
+    python load_test.py --url http://127.0.0.1:8080 --users 16 --mode mixed
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from functools import partial
+from http import HTTPStatus
+
+from answer_cache import ACTIVITY, shared_cache
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+MAX_BODY_BYTES = 64 * 1024
+MAX_HEADER_BYTES = 16 * 1024
+KEEPALIVE_TIMEOUT = 15.0
+REQUEST_TIMEOUT = 240.0
+QUEUE_TIMEOUT = 30.0
+
+# Одновременных запросов по видам: поиск дешев, ответы и ТТ упираются в LLM
+DEFAULT_LIMITS = {"search": 16, "answer": 4, "tt": 2}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+
+class Request:
+    __slots__ = ("method", "path", "version", "headers", "body", "request_id")
+
+    def __init__(self, method, path, version, headers, body):
+        self.method = method
+        self.path = path.split("?", 1)[0]
+        self.version = version
+        self.headers = headers
+        self.body = body
+        self.request_id = headers.get("x-request-id") or uuid.uuid4().hex
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    def json(self):
+        try:
+            payload = json.loads(self.body or b"{}")
+        except (ValueError, UnicodeDecodeError):
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Тело запроса должно быть JSON")
+        if not isinstance(payload, dict):
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Тело запроса должно быть объектом JSON")
+        return payload
+
+    def question(self):
+        payload = self.json()
+        question = payload.get("question")
+        if not isinstance(question, str) or not question.strip():
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Поле question обязательно")
+        return question.strip(), payload
+
+    def wants_stream(self, payload):
+        return bool(payload.get("stream")) or "text/event-stream" in self.headers.get("accept", "")
+
+
+async def read_request(reader):
+    """Следующий запрос соединения или None, если клиент закрыл соединение"""
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if e.partial.strip():
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Неполный запрос")
+        return None
+    except asyncio.LimitOverrunError:
+        raise HttpError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, "Слишком большие заголовки")
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, path, version = lines[0].split(" ", 2)
+    except ValueError:
+        raise HttpError(HTTPStatus.BAD_REQUEST, "Неверная строка запроса")
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise HttpError(HTTPStatus.LENGTH_REQUIRED, "Нужен Content-Length")
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise HttpError(HTTPStatus.BAD_REQUEST, "Неверный Content-Length")
+    if length > MAX_BODY_BYTES:
+        raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"Тело запроса больше {MAX_BODY_BYTES} байт")
+    body = await reader.readexactly(length) if length else b""
+    return Request(method.upper(), path, version.strip(), headers, body)
+
+
+def _status_line(status):
+    status = HTTPStatus(status)
+    return f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+
+
+def _headers_block(headers):
+    return "".join(f"{name}: {value}\r\n" for name, value in headers.items()) + "\r\n"
+
+
+def _connection_headers(keep_alive):
+    if keep_alive:
+        return {"Connection": "keep-alive", "Keep-Alive": f"timeout={int(KEEPALIVE_TIMEOUT)}"}
+    return {"Connection": "close"}
+
+
+async def write_json(writer, status, payload, request_id, keep_alive, extra_headers=None):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    headers = {
+        "Content-Type": "application/json; charset=utf-8",
+        "Content-Length": str(len(body)),
+        "X-Request-Id": request_id,
+    }
+    headers.update(_connection_headers(keep_alive))
+    headers.update(extra_headers or {})
+    writer.write((_status_line(status) + _headers_block(headers)).encode("latin-1") + body)
+    await writer.drain()
+
+
+class EventStream:
+    """Ответ SSE с chunked-кодированием (соединение остается пригодным для следующего запроса)"""
+
+    def __init__(self, writer, request_id, keep_alive):
+        self.writer = writer
+        self.request_id = request_id
+        self.keep_alive = keep_alive
+
+    async def start(self):
+        headers = {
+            "Content-Type": "text/event-stream; charset=utf-8",
+            "Cache-Control": "no-cache",
+            "Transfer-Encoding": "chunked",
+            "X-Request-Id": self.request_id,
+        }
+        headers.update(_connection_headers(self.keep_alive))
+        self.writer.write((_status_line(HTTPStatus.OK) + _headers_block(headers)).encode("latin-1"))
+        await self.writer.drain()
+
+    async def send(self, event, data):
+        data = dict(data, request_id=self.request_id)
+        chunk = f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+        self.writer.write(f"{len(chunk):X}\r\n".encode("ascii") + chunk + b"\r\n")
+        await self.writer.drain()
+
+    async def finish(self):
+        self.writer.write(b"0\r\n\r\n")
+        await self.writer.drain()
+
+
+class ApiServer:
+    """Маршруты API поверх снимка цепочек IndexManager"""
+
+    def __init__(self, index_manager, limits=None, queue_timeout=QUEUE_TIMEOUT, request_timeout=REQUEST_TIMEOUT,
+                 collections=None, warmer=None):
+        self.index_manager = index_manager
+        # Прогрев кэша ответов (cache_warmer.CacheWarmer) - только для /health
+        self.warmer = warmer
+        # Коллекции реестра (collection_registry.CollectionCache) для поля collection запросов
+        self.collections = collections
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        self.queue_timeout = queue_timeout
+        self.request_timeout = request_timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=sum(self.limits.values()), thread_name_prefix="api-request")
+        self._semaphores = {}
+        self._in_flight = {kind: 0 for kind in self.limits}
+        self._served = 0
+        self.routes = {
+            ("GET", "/health"): self.health,
+            ("POST", "/search"): self.search,
+            ("POST", "/answer"): self.answer,
+            ("POST", "/tt"): self.tt,
+        }
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_request(reader), KEEPALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    return
+                except HttpError as e:
+                    await write_json(writer, e.status, {"error": e.message}, uuid.uuid4().hex, False)
+                    return
+                if request is None:
+                    return
+                keep_alive = await self.dispatch(request, writer)
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, request, writer):
+        """Обрабатывает запрос; возвращает, можно ли продолжать соединение"""
+        started = time.perf_counter()
+        status = HTTPStatus.OK
+        keep_alive = request.keep_alive
+        handler = self.routes.get((request.method, request.path))
+        try:
+            if handler is None:
+                known_path = any(path == request.path for _, path in self.routes)
+                raise HttpError(HTTPStatus.METHOD_NOT_ALLOWED if known_path else HTTPStatus.NOT_FOUND,
+                                f"{request.method} {request.path} не поддерживается")
+            status = await handler(request, writer) or HTTPStatus.OK
+        except HttpError as e:
+            status = e.status
+            await write_json(writer, e.status, {"error": e.message, "request_id": request.request_id},
+                             request.request_id, keep_alive, e.headers)
+        except (ConnectionError, asyncio.CancelledError):
+            status, keep_alive = 499, False
+            raise
+        except Exception as e:
+            logging.error(f"API error - {request.request_id} - {request.path}: {e}")
+            status = HTTPStatus.INTERNAL_SERVER_ERROR
+            await write_json(writer, status, {"error": str(e), "request_id": request.request_id},
+                             request.request_id, keep_alive)
+        finally:
+            self._served += 1
+            logging.info(f"API request - {request.request_id} - {request.method} {request.path} - "
+                         f"{int(status)} - {time.perf_counter() - started:.2f}s")
+        return keep_alive
+
+    def _semaphore(self, kind):
+        # Семафоры создаются в цикле событий сервера
+        if kind not in self._semaphores:
+            self._semaphores[kind] = asyncio.Semaphore(self.limits[kind])
+        return self._semaphores[kind]
+
+    async def _acquire(self, kind):
+        """Занимает слот запроса kind; возвращает список его задач в пуле потоков для _release"""
+        try:
+            await asyncio.wait_for(self._semaphore(kind).acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE,
+                            f"Превышено число одновременных запросов ({kind}), попробуйте позже",
+                            {"Retry-After": str(int(self.queue_timeout))})
+        self._in_flight[kind] += 1
+        return []
+
+    def _release(self, kind, running=()):
+        """Освобождает слот, когда закончатся задачи запроса в пуле потоков.
+
+        Поток пула нельзя прервать: после таймаута ответ уходит сразу, а слот остается
+        занятым до конца задачи, иначе повторные 504 заняли бы весь пул потоков.
+        """
+        pending = [future for future in running if not future.done()]
+        if pending:
+            asyncio.gather(*pending, return_exceptions=True).add_done_callback(lambda _: self._release(kind))
+            return
+        self._in_flight[kind] -= 1
+        self._semaphore(kind).release()
+
+    async def _run(self, running, function, *args):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, function, *args)
+        running.append(future)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.request_timeout)
+        except asyncio.TimeoutError:
+            raise HttpError(HTTPStatus.GATEWAY_TIMEOUT, "Превышено время ожидания ответа")
+
+    async def _collect(self, running, make_iterator):
+        """Все элементы генератора цепочки; по таймауту генерация останавливается"""
+        try:
+            return [item async for item in self._iterate(running, make_iterator)]
+        except asyncio.TimeoutError:
+            raise HttpError(HTTPStatus.GATEWAY_TIMEOUT, "Превышено время ожидания ответа")
+
+    async def _iterate(self, running, make_iterator):
+        """Синхронный генератор цепочки в пуле потоков -> асинхронная итерация.
+
+        Если клиент отключился, генератор закрывается (LLM перестает генерировать).
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        stopped = threading.Event()
+        done = object()
+
+        def produce():
+            iterator = make_iterator()
+            try:
+                for item in iterator:
+                    if stopped.is_set():
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, item)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                close = getattr(iterator, "close", None)
+                if close:
+                    close()
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+
+        running.append(asyncio.wrap_future(self.executor.submit(produce)))
+        deadline = loop.time() + self.request_timeout
+        try:
+            while True:
+                item = await asyncio.wait_for(queue.get(), max(deadline - loop.time(), 0))
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stopped.set()
+
+    async def _stream(self, request, writer, events, finish):
+        """Отдает события SSE; ошибки после начала ответа передаются событием error"""
+        stream = EventStream(writer, request.request_id, request.keep_alive)
+        await stream.start()
+        try:
+            async for event, data in events:
+                await stream.send(event, data)
+            await stream.send("done", finish())
+        except (ConnectionError, asyncio.CancelledError):
+            raise
+        except asyncio.TimeoutError:
+            await stream.send("error", {"error": "Превышено время ожидания ответа"})
+        except Exception as e:
+            logging.error(f"API stream error - {request.request_id} - {request.path}: {e}")
+            await stream.send("error", {"error": str(e)})
+        finally:
+            # Останавливает генерацию и при отключении клиента
+            await events.aclose()
+        await stream.finish()
+
+    async def _qa_chain(self, running, payload):
+        """Цепочка RAG запроса: нормативная из снимка или коллекции из поля collection"""
+        name = payload.get("collection") or "normative"
+        if name == "normative":
+            return self.index_manager.current().resources["qa_chain"]
+        if self.collections is None or name == "tt" or name not in self.collections.registry:
+            raise HttpError(HTTPStatus.NOT_FOUND, f"Коллекция {name} не найдена")
+        # Индекс коллекции загружается при первом запросе к ней
+        return (await self._run(running, self.collections.get, name))["qa_chain"]
+
+    async def health(self, request, writer):
+        snapshot = self.index_manager.current()
+        cache = shared_cache()
+        await write_json(writer, HTTPStatus.OK, {
+            "status": "ok",
+            "version": snapshot.version,
+            "in_flight": dict(self._in_flight),
+            "limits": self.limits,
+            "served": self._served,
+            "collections": self.collections.stats() if self.collections else None,
+            "answer_cache": cache.stats() if cache else None,
+            "cache_warmer": self.warmer.stats() if self.warmer else None,
+        }, request.request_id, request.keep_alive)
+
+    async def search(self, request, writer):
+        question, payload = request.question()
+        running = await self._acquire("search")
+        try:
+            qa_chain = await self._qa_chain(running, payload)
+            with ACTIVITY.request():
+                docs_and_scores = await self._run(running, qa_chain.retrieve, question)
+        finally:
+            self._release("search", running)
+        k = payload.get("k")
+        if isinstance(k, int) and k > 0:
+            docs_and_scores = docs_and_scores[:k]
+        await write_json(writer, HTTPStatus.OK, {
+            "request_id": request.request_id,
+            "results": [
+                {"content": doc.page_content, "metadata": doc.metadata, "relevance": round(float(score), 4)}
+                for doc, score in docs_and_scores
+            ],
+        }, request.request_id, request.keep_alive)
+
+    async def answer(self, request, writer):
+        question, payload = request.question()
+        running = await self._acquire("answer")
+        try:
+            # Снимок берется один раз: запрос доработает на своей версии индекса
+            qa_chain = await self._qa_chain(running, payload)
+            started = time.perf_counter()
+            if not request.wants_stream(payload):
+                # Ответ собирается из потока, чтобы по таймауту остановить генерацию
+                answer = "".join(await self._collect(running, partial(qa_chain.stream, question)))
+                await write_json(writer, HTTPStatus.OK, {
+                    "request_id": request.request_id,
+                    "answer": answer,
+                    "elapsed": round(time.perf_counter() - started, 3),
+                }, request.request_id, request.keep_alive)
+                return
+
+            async def tokens():
+                async for piece in self._iterate(running, partial(qa_chain.stream, question)):
+                    yield "token", {"text": piece}
+
+            await self._stream(request, writer, tokens(),
+                               lambda: {"elapsed": round(time.perf_counter() - started, 3)})
+        finally:
+            self._release("answer", running)
+
+    async def tt(self, request, writer):
+        question, payload = request.question()
+        running = await self._acquire("tt")
+        try:
+            tt_chain = self.index_manager.current().resources["tt_chain"]
+            started = time.perf_counter()
+            if not request.wants_stream(payload):
+                texts = {index: text for index, _, text in
+                         await self._collect(running, partial(tt_chain.stream_sections, question))}
+                await write_json(writer, HTTPStatus.OK, {
+                    "request_id": request.request_id,
+                    "sections": [
+                        {"index": index, "heading": heading, "text": texts.get(index)}
+                        for index, (heading, _) in enumerate(tt_chain.sections)
+                    ],
+                    "text": tt_chain.assemble(texts),
+                    "elapsed": round(time.perf_counter() - started, 3),
+                }, request.request_id, request.keep_alive)
+                return
+
+            texts = {}
+            stream_sections = partial(tt_chain.stream_sections, question)
+
+            async def sections():
+                async for index, heading, text in self._iterate(running, stream_sections):
+                    texts[index] = text
+                    yield "section", {"index": index, "heading": heading, "text": text}
+
+            await self._stream(request, writer, sections(), lambda: {
+                "text": tt_chain.assemble(texts),
+                "elapsed": round(time.perf_counter() - started, 3),
+            })
+        finally:
+            self._release("tt", running)
+
+
+async def serve(api, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    server = await asyncio.start_server(api.handle_connection, host, port, limit=MAX_HEADER_BYTES)
+    print(f"HTTP API слушает http://{host}:{port}")
+    logging.info(f"HTTP API started - {host}:{port} - limits {api.limits}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP API поиска, ответов RAG и генерации ТТ")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--search-limit", type=int, default=DEFAULT_LIMITS["search"],
+                        help="одновременных запросов /search")
+    parser.add_argument("--answer-limit", type=int, default=DEFAULT_LIMITS["answer"],
+                        help="одновременных запросов /answer")
+    parser.add_argument("--tt-limit", type=int, default=DEFAULT_LIMITS["tt"], help="одновременных запросов /tt")
+    parser.add_argument("--queue-timeout", type=float, default=QUEUE_TIMEOUT,
+                        help="сколько запрос ждет места, прежде чем получить 503, с")
+    parser.add_argument("--ollama-host", help="адрес Ollama (по умолчанию OLLAMA_HOST или локальный)")
+    parser.add_argument("--fake-ollama", action="store_true", help="поднять заглушку Ollama в этом процессе")
+    parser.add_argument("--fake-port", type=int, default=11435)
+    parser.add_argument("--token-rate", type=float, default=30.0)
+    parser.add_argument("--latency", default="fixed:0.2")
+    parser.add_argument("--max-tokens", type=int, default=200)
+    parser.add_argument("--parallel", type=int, default=4, help="OLLAMA_NUM_PARALLEL заглушки")
+    args = parser.parse_args()
+
+    logging.basicConfig(filename='activity.log', level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.fake_ollama:
+        from fake_ollama import FakeOllamaConfig, start_in_background
+        config = FakeOllamaConfig(token_rate=args.token_rate, latency=args.latency,
+                                  max_tokens=args.max_tokens, parallel=args.parallel)
+        start_in_background(port=args.fake_port, config=config)
+        os.environ["OLLAMA_HOST"] = f"http://127.0.0.1:{args.fake_port}"
+    elif args.ollama_host:
+        os.environ["OLLAMA_HOST"] = args.ollama_host
+
+    # Клиенты Ollama читают OLLAMA_HOST при создании, поэтому цепочки строим после настройки окружения
+    from cache_warmer import CacheWarmer
+    from collection_registry import CollectionCache
+    from index_manager import IndexManager, current_index_dir, load_chain_resources
+    from retrieval_worker import create_query_embeddings, worker_address
+
+    if not worker_address() and not os.path.exists(current_index_dir("./faiss_index")):
+        raise SystemExit("Индекс нормативных документов не найден. Сначала запустите main.py для создания индексов.")
+    embeddings = create_query_embeddings()
+    index_manager = IndexManager(partial(load_chain_resources, embeddings),
+                                 watch_corpus=not worker_address()).start()
+    print(f"Индексы загружены: {index_manager.current().version}")
+    api = ApiServer(index_manager, limits={"search": args.search_limit, "answer": args.answer_limit,
+                                           "tt": args.tt_limit}, queue_timeout=args.queue_timeout,
+                    collections=CollectionCache(embeddings, index_manager=index_manager),
+                    warmer=CacheWarmer(index_manager).start())
+    try:
+        asyncio.run(serve(api, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,395 @@
+"""Версионные индексы с фоновой пересборкой и горячей заменой.
+
+Пересборка индекса на месте опасна: читатели могут увидеть наполовину записанные
+index.faiss/index.pkl, а app.py до перезапуска сессий продолжает отвечать по
+старым объектам FAISS. Поэтому новая версия индекса строится в отдельную папку
+<index_dir>.versions/<версия>/, а после полной записи указатель <index_dir>.current
+атомарно (os.replace) переключается на нее. Папка <index_dir> без указателя
+остается рабочей версией по умолчанию.
+
+IndexManager держит в процессе снимок текущей версии (векторные хранилища и
+цепочки). Фоновый поток опрашивает files/ и files_TT/, при изменении документов
+собирает новую версию и подменяет снимок; запросы, уже взявшие старый снимок,
+дорабатывают на нем. Наблюдателей может быть несколько (процессы Streamlit,
+http_api.py), поэтому сборка идет под межпроцессной блокировкой файла
+<index_dir>.versions/build.lock: версию по новым документам собирает один
+процесс, остальные подхватывают опубликованную.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from collection_registry import DEFAULT_COLLECTIONS, indexed_collections
+from retrievers import calibrate_index
+
+VERSIONS_SUFFIX = ".versions"
+POINTER_SUFFIX = ".current"
+CORPUS_FILE = "corpus.json"
+BUILD_LOCK_FILE = "build.lock"
+DOCUMENT_EXTENSIONS = (".pdf", ".txt")
+KEEP_VERSIONS = 3
+POLL_INTERVAL = 30.0
+SETTLE_POLLS = 2
+
+# Индексы снимка: папка документов, папка индекса, нужна ли калибровка динамического k.
+# Остальные коллекции реестра (collection_registry.py) загружаются по требованию.
+INDEXES = DEFAULT_COLLECTIONS
+
+IndexSnapshot = namedtuple("IndexSnapshot", ["version", "index_dirs", "resources"])
+
+
+def open_indexes(embeddings, index_dirs):
+    """{имя индекса: (хранилище, хранилище разделов, калибровка)}: в процессе поиска или локально"""
+    from retrieval_worker import RemoteEmbeddings
+    from retrievers import load_calibration
+    from sharded_index import load_index
+
+    if isinstance(embeddings, RemoteEmbeddings):
+        return embeddings.client.open_indexes()
+    indexes = {}
+    for name, index_dir in index_dirs.items():
+        if os.path.exists(index_dir):
+            vectorstore, parent_store = load_index(index_dir, embeddings)
+            indexes[name] = (vectorstore, parent_store, load_calibration(index_dir, embeddings))
+    return indexes
+
+
+def load_chain_resources(embeddings, index_dirs):
+    """Хранилища и цепочки одной версии индексов (loader для IndexManager в app.py и http_api.py)"""
+    from answer_cache import index_cache
+    from chain_factory import create_routed_chain
+    from table_store import TableStore
+    from terms_index import TermsIndex
+    from tt_engine import MERGE_NORMATIVE_ENV, SectionedTTEngine
+
+    indexes = open_indexes(embeddings, index_dirs)
+    vectorstore, parent_store, calibration = indexes["normative"]
+    tt_vectorstore, tt_parent_store, _ = indexes.get("tt") or indexes["normative"]  # fallback
+    return {
+        "indexes": indexes,
+        "vectorstore": vectorstore,
+        "tt_vectorstore": tt_vectorstore,
+        "qa_chain": create_routed_chain(vectorstore, mode="rag", calibration=calibration, parent_store=parent_store,
+                                        table_store=TableStore.open(index_dirs["normative"]),
+                                        terms_index=TermsIndex.open(index_dirs["normative"]),
+                                        answer_cache=index_cache("normative", index_dirs["normative"])),
+        "tt_chain": SectionedTTEngine(
+            tt_vectorstore, parent_store=tt_parent_store,
+            # Контекст ТТ из обоих корпусов - по желанию (TT_MERGE_NORMATIVE=1)
+            merge_vectorstore=vectorstore if os.environ.get(MERGE_NORMATIVE_ENV) == "1" else None,
+            merge_parent_store=parent_store,
+        ),
+    }
+
+
+def versions_dir(index_dir):
+    return index_dir.rstrip("/\\") + VERSIONS_SUFFIX
+
+
+def pointer_path(index_dir):
+    return index_dir.rstrip("/\\") + POINTER_SUFFIX
+
+
+def read_pointer(index_dir):
+    """Имя опубликованной версии или None"""
+    try:
+        with open(pointer_path(index_dir), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def current_index_dir(index_dir):
+    """Папка опубликованной версии индекса (или сам index_dir, если версий нет)"""
+    version = read_pointer(index_dir)
+    if version:
+        version_dir = os.path.join(versions_dir(index_dir), version)
+        if os.path.isdir(version_dir):
+            return version_dir
+    return index_dir
+
+
+def publish_version(index_dir, version):
+    """Атомарно переключает указатель на версию"""
+    path = pointer_path(index_dir)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def prune_versions(index_dir, keep=KEEP_VERSIONS):
+    """Удаляет старые версии, оставляя текущую и keep - 1 предыдущих.
+
+    Версии новее текущей (еще строятся) не трогаются.
+    """
+    current = read_pointer(index_dir)
+    root = versions_dir(index_dir)
+    if not current or not os.path.isdir(root):
+        return
+    older = sorted(name for name in os.listdir(root)
+                   if name < current and os.path.isdir(os.path.join(root, name)))
+    for name in older[:max(len(older) - (keep - 1), 0)]:
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def _lock_file(f, blocking):
+    if os.name == "nt":
+        import msvcrt
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+                time.sleep(1.0)
+    import fcntl
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        return True
+    except BlockingIOError:
+        return False
+
+
+def _unlock_file(f):
+    if os.name == "nt":
+        import msvcrt
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def build_lock(index_dir, blocking=False):
+    """Межпроцессная блокировка сборки версий индекса; дает True, если блокировка взята.
+
+    Блокировку держит ОС, поэтому она снимается и при аварийном завершении процесса.
+    """
+    root = versions_dir(index_dir)
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, BUILD_LOCK_FILE), "a+") as f:
+        acquired = _lock_file(f, blocking)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                _unlock_file(f)
+
+
+def corpus_fingerprint(docs_dir):
+    """Хэш списка документов (путь, размер, время изменения)"""
+    entries = []
+    for root, dirs, files in os.walk(docs_dir):
+        for file in files:
+            if file.lower().endswith(DOCUMENT_EXTENSIONS):
+                path = os.path.join(root, file)
+                stat = os.stat(path)
+                entries.append(f"{os.path.relpath(path, docs_dir)}|{stat.st_size}|{stat.st_mtime_ns}")
+    return hashlib.sha1("\n".join(sorted(entries)).encode("utf-8")).hexdigest()
+
+
+def read_corpus_fingerprint(index_dir):
+    """Отпечаток документов, по которым построена версия (None для индекса без версий)"""
+    try:
+        with open(os.path.join(index_dir, CORPUS_FILE), "r", encoding="utf-8") as f:
+            return json.load(f).get("fingerprint")
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def build_index_version(docs_dir, index_dir, calibrate=False, fingerprint=None, embedding_model=None):
+    """Строит новую версию индекса в отдельной папке и публикует ее; возвращает папку версии"""
+    # main импортирует тяжелые модули цепочек, поэтому импорт отложен
+    from main import create_vectorstore, load_documents_from_directory
+    from sharded_index import build_sharded_index, is_sharded, read_manifest
+
+    fingerprint = fingerprint or corpus_fingerprint(docs_dir)
+    documents = load_documents_from_directory(docs_dir)
+    if not documents:
+        logging.warning(f"Index build skipped - no documents in {docs_dir}")
+        return None
+    base_version = f"v{time.strftime('%Y%m%d-%H%M%S')}-{fingerprint[:8]}"
+    version, attempt = base_version, 1
+    while os.path.exists(os.path.join(versions_dir(index_dir), version)):
+        attempt += 1
+        version = f"{base_version}-{attempt}"
+    version_dir = os.path.join(versions_dir(index_dir), version)
+    started = time.perf_counter()
+    current_dir = current_index_dir(index_dir)
+    if is_sharded(current_dir):
+        # Новая версия делится на части так же, как текущая
+        manifest = read_manifest(current_dir)
+        build_sharded_index(documents, version_dir, manifest["num_shards"], manifest["strategy"],
+                            calibrate=calibrate, embedding_model=embedding_model)
+    else:
+        vectorstore = create_vectorstore(documents, version_dir, embedding_model)
+        vectorstore.save_local(version_dir)
+        if calibrate:
+            calibrate_index(version_dir, vectorstore)
+    with open(os.path.join(version_dir, CORPUS_FILE), "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": fingerprint, "docs_dir": docs_dir, "documents": len(documents),
+                   "built_at": time.strftime("%Y-%m-%d %H:%M:%S")}, f, ensure_ascii=False, indent=2)
+    # Указатель переключается только после полной записи версии
+    publish_version(index_dir, version)
+    prune_versions(index_dir)
+    logging.info(f"Index version published - {index_dir} - {version} - "
+                 f"{len(documents)} documents in {time.perf_counter() - started:.1f}s")
+    return version_dir
+
+
+class IndexManager:
+    """Снимок текущих версий индексов процесса и фоновая пересборка при изменении документов.
+
+    loader(index_dirs) получает {имя индекса: папка версии} и возвращает ресурсы
+    снимка (хранилища, цепочки). current() всегда отдает готовый снимок: новая
+    версия загружается полностью и только затем подменяет ссылку. Пересобираются
+    индексы всех коллекций реестра (watched), а в снимок попадают только indexes.
+    """
+
+    def __init__(self, loader, indexes=None, poll_interval=POLL_INTERVAL, settle_polls=SETTLE_POLLS,
+                 watch_corpus=True, watched=None):
+        self.loader = loader
+        self.indexes = indexes or INDEXES
+        if watched is None:
+            watched = indexed_collections() if indexes is None else self.indexes
+        self.watched = watched
+        self.poll_interval = poll_interval
+        self.settle_polls = settle_polls
+        # False - только подхватывать версии, собранные другим процессом (процессом поиска)
+        self.watch_corpus = watch_corpus
+        self._snapshot = None
+        self._load_lock = threading.Lock()
+        self._baseline = {}
+        self._pending = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def index_dirs(self):
+        return {name: current_index_dir(config["index_dir"]) for name, config in self.indexes.items()}
+
+    def current(self):
+        snapshot = self._snapshot
+        return snapshot if snapshot is not None else self.refresh()
+
+    def refresh(self):
+        """Загружает опубликованные версии, если они отличаются от текущего снимка"""
+        with self._load_lock:
+            index_dirs = self.index_dirs()
+            version = ";".join(f"{name}={os.path.basename(path)}" for name, path in sorted(index_dirs.items()))
+            if self._snapshot is not None and self._snapshot.version == version:
+                return self._snapshot
+            snapshot = IndexSnapshot(version, index_dirs, self.loader(index_dirs))
+            self._snapshot = snapshot
+            logging.info(f"Index snapshot loaded - {version}")
+            return snapshot
+
+    def check_corpus(self):
+        """Пересобирает индексы, документы которых изменились и не меняются settle_polls опросов подряд.
+
+        Возвращает True, если опубликована хотя бы одна новая версия.
+        """
+        published = False
+        for name, config in self.watched.items():
+            if not os.path.isdir(config["docs_dir"]):
+                continue
+            fingerprint = corpus_fingerprint(config["docs_dir"])
+            if name not in self._baseline:
+                # Для индекса без версий считаем, что он построен по текущим документам
+                self._baseline[name] = read_corpus_fingerprint(current_index_dir(config["index_dir"])) or fingerprint
+            if fingerprint == self._baseline[name]:
+                self._pending.pop(name, None)
+                continue
+            previous, polls = self._pending.get(name, (None, 0))
+            polls = polls + 1 if fingerprint == previous else 1
+            self._pending[name] = (fingerprint, polls)
+            if polls < self.settle_polls:
+                # Файлы могут еще копироваться
+                continue
+            with build_lock(config["index_dir"]) as acquired:
+                if not acquired:
+                    # Собирает другой процесс - после публикации версия будет подхвачена при следующем опросе
+                    logging.info(f"Index build in progress in another process - {config['index_dir']}")
+                    continue
+                if read_corpus_fingerprint(current_index_dir(config["index_dir"])) == fingerprint:
+                    # Версию по этим документам уже опубликовал другой процесс
+                    logging.info(f"Corpus change already indexed - {config['index_dir']}")
+                    published = True
+                else:
+                    logging.info(f"Corpus change detected - {config['docs_dir']} - rebuilding {config['index_dir']}")
+                    try:
+                        published |= build_index_version(config["docs_dir"], config["index_dir"],
+                                                         calibrate=config["calibrate"], fingerprint=fingerprint,
+                                                         embedding_model=config.get("embedding_model")) is not None
+                    except Exception as e:
+                        logging.error(f"Index rebuild error - {config['index_dir']}: {e}")
+            # После ошибки повторная сборка - только при следующем изменении документов
+            self._baseline[name] = fingerprint
+            self._pending.pop(name, None)
+        return published
+
+    def start(self):
+        """Запускает фоновый опрос папок документов и опубликованных версий"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name="index-watcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                if self.watch_corpus:
+                    self.check_corpus()
+                # Подхватываются и версии, собранные другим процессом (python index_manager.py)
+                if self._snapshot is not None:
+                    self.refresh()
+            except Exception as e:
+                logging.error(f"Index watcher error: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сборка новой версии индексов с атомарной публикацией")
+    collections = indexed_collections()
+    parser.add_argument("--index", choices=sorted(collections), action="append",
+                        help="какой индекс собрать (по умолчанию все коллекции реестра)")
+    parser.add_argument("--force", action="store_true",
+                        help="собрать, даже если документы не изменились")
+    args = parser.parse_args()
+
+    for name in args.index or sorted(collections):
+        config = collections[name]
+        if not os.path.isdir(config["docs_dir"]):
+            print(f"Папка {config['docs_dir']} не найдена, индекс {name} пропущен")
+            continue
+        fingerprint = corpus_fingerprint(config["docs_dir"])
+        with build_lock(config["index_dir"], blocking=True):
+            # Под блокировкой: версию могла только что опубликовать запущенная программа
+            if not args.force and fingerprint == read_corpus_fingerprint(current_index_dir(config["index_dir"])):
+                print(f"Документы индекса {name} не изменились")
+                continue
+            version_dir = build_index_version(config["docs_dir"], config["index_dir"],
+                                              calibrate=config["calibrate"], fingerprint=fingerprint,
+                                              embedding_model=config["embedding_model"])
+        if version_dir:
+            print(f"Опубликована версия {version_dir}")
+        else:
+            print(f"Документы для индекса {name} не найдены")
+
+
+if __name__ == "__main__":
+    main()
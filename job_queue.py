@@ -0,0 +1,305 @@
+"""Долговременные фоновые задачи (генерация ТТ), переживающие перезапуск скрипта и обновление страницы.
+
+Задачи хранятся в SQLite (jobs.db): статус, прогресс, промежуточный и итоговый
+результат. Рабочие потоки живут в процессе сервера, а не в скрипте Streamlit,
+поэтому закрытая вкладка не прерывает генерацию.
+
+Задачу выполняет один процесс: при захвате в нее записывается владелец (хост,
+pid и метка запуска), и владелец периодически обновляет heartbeat. Задачи
+владельца, который завершился или давно не обновлял heartbeat (процесс упал или
+перезапущен), возвращаются в очередь; задачи живых процессов (второй процесс
+Streamlit, HTTP API) не трогаются. Ожидающие задачи, которые долго никто не
+взял (поставивший их процесс завершился), подхватывает любой живой процесс.
+"""
+import json
+import logging
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+DEFAULT_DB_PATH = "jobs.db"
+
+# Статусы задач
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+ERROR = "error"
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+HEARTBEAT_INTERVAL = 10.0  # как часто владелец отмечает свои выполняемые задачи, с
+STALE_AFTER = 60.0         # задача без heartbeat дольше этого считается брошенной, с
+HANDLER_TIMEOUT = 300.0    # сколько ждать регистрации обработчика, прежде чем считать задачу ошибочной, с
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    chat_id TEXT,
+    prompt TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    partial TEXT,
+    result TEXT,
+    error TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    owner TEXT,
+    heartbeat REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_chat_id ON jobs(chat_id, created_at);
+"""
+
+
+class JobLostError(Exception):
+    """Задачу забрал другой процесс (heartbeat этого процесса устарел)"""
+
+
+def _owner_alive(owner):
+    """False, если процесс-владелец задачи на этом хосте точно завершился"""
+    host, pid, _ = owner.rsplit(":", 2)
+    if host != socket.gethostname() or os.name == "nt":
+        # На Windows os.kill(pid, 0) завершает процесс - остается только heartbeat
+        return True
+    pid = int(pid)
+    if pid == os.getpid():
+        # Тот же pid, но другая метка запуска - прежний экземпляр процесса (например, в контейнере)
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobManager:
+    """Очередь задач с рабочими потоками и хранением состояния в SQLite"""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, workers=1, heartbeat_interval=HEARTBEAT_INTERVAL,
+                 stale_after=STALE_AFTER, handler_timeout=HANDLER_TIMEOUT):
+        self.db_path = db_path
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self.handler_timeout = handler_timeout
+        self._local = threading.local()
+        self._handlers = {}
+        self._handlers_changed = threading.Condition()
+        self._queue = queue.Queue()
+        # id в локальной очереди: периодический подхват не ставит задачу повторно
+        self._enqueued = set()
+        self._enqueued_lock = threading.Lock()
+        conn = self._connection()
+        conn.executescript(SCHEMA)
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for column, column_type in (("owner", "TEXT"), ("heartbeat", "REAL")):
+            if column not in columns:
+                # jobs.db, созданная до учета владельцев
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+        self._recover()
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        self._threads.append(threading.Thread(target=self._monitor, name="job-heartbeat", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def _enqueue(self, job_id):
+        with self._enqueued_lock:
+            if job_id in self._enqueued:
+                return
+            self._enqueued.add(job_id)
+        self._queue.put(job_id)
+
+    def _recover(self):
+        """Ставит в очередь ожидающие задачи и задачи, брошенные завершившимися процессами"""
+        self._requeue_orphans()
+        self._requeue_waiting()
+
+    def _requeue_orphans(self):
+        """Возвращает в очередь выполняемые задачи мертвых владельцев; возвращает их id"""
+        conn = self._connection()
+        stale_before = time.time() - self.stale_after
+        requeued = set()
+        for row in conn.execute("SELECT id, owner, heartbeat FROM jobs WHERE status = ?", (RUNNING,)).fetchall():
+            if row["owner"] == self.owner:
+                continue
+            if row["owner"] and _owner_alive(row["owner"]) and (row["heartbeat"] or 0) >= stale_before:
+                continue
+            # Условие на владельца и heartbeat: задачу возвращает в очередь только один процесс
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, owner = NULL, updated_at = ? "
+                "WHERE id = ? AND status = ? AND owner IS ? AND heartbeat IS ?",
+                (QUEUED, datetime.now().isoformat(), row["id"], RUNNING, row["owner"], row["heartbeat"]),
+            )
+            if cursor.rowcount == 1:
+                requeued.add(row["id"])
+                self._enqueue(row["id"])
+        if requeued:
+            logging.info(f"Requeued {len(requeued)} background jobs of stopped processes")
+        return requeued
+
+    def _requeue_waiting(self, older_than=None):
+        """Ставит в локальную очередь ожидающие задачи из базы, в том числе поставленные другими процессами
+
+        Захват задачи атомарен (_claim), поэтому задача, попавшая в очереди
+        нескольких процессов, все равно выполняется один раз.
+        """
+        sql = "SELECT id FROM jobs WHERE status = ?"
+        params = [QUEUED]
+        if older_than is not None:
+            sql += " AND updated_at < ?"
+            params.append(datetime.fromtimestamp(time.time() - older_than).isoformat())
+        for row in self._connection().execute(sql + " ORDER BY created_at", params).fetchall():
+            self._enqueue(row["id"])
+
+    def _monitor(self):
+        """Heartbeat своих задач и подхват задач процессов, остановившихся во время работы"""
+        while True:
+            time.sleep(self.heartbeat_interval)
+            try:
+                self._connection().execute(
+                    "UPDATE jobs SET heartbeat = ? WHERE owner = ? AND status = ?", (time.time(), self.owner, RUNNING))
+                self._requeue_orphans()
+                # Задачи, поставленные процессом, который завершился до их выполнения
+                self._requeue_waiting(older_than=self.stale_after)
+            except Exception as e:
+                logging.error(f"Job heartbeat error: {e}")
+
+    def register_handler(self, kind, handler):
+        """handler(job, report) -> str; report(progress, partial) сохраняет промежуточное состояние"""
+        with self._handlers_changed:
+            self._handlers[kind] = handler
+            self._handlers_changed.notify_all()
+
+    def submit(self, kind, prompt, chat_id=None):
+        """Ставит задачу в очередь и возвращает ее id"""
+        job_id = uuid.uuid4().hex
+        now = datetime.now().isoformat()
+        self._connection().execute(
+            "INSERT INTO jobs (id, kind, chat_id, prompt, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, kind, chat_id, prompt, QUEUED, now, now),
+        )
+        self._enqueue(job_id)
+        logging.info(f"Job {job_id} ({kind}) submitted")
+        return job_id
+
+    def get(self, job_id):
+        row = self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["partial"] = json.loads(job["partial"]) if job["partial"] else None
+        return job
+
+    def list_jobs(self, chat_id=None, statuses=None, limit=20):
+        sql = "SELECT id FROM jobs WHERE 1 = 1"
+        params = []
+        if chat_id is not None:
+            sql += " AND chat_id = ?"
+            params.append(chat_id)
+        if statuses:
+            sql += f" AND status IN ({', '.join('?' for _ in statuses)})"
+            params.extend(statuses)
+        sql += " ORDER BY created_at DESC LIMIT ?"
+        params.append(limit)
+        return [self.get(row["id"]) for row in self._connection().execute(sql, params).fetchall()]
+
+    def queue_position(self, job_id):
+        """Сколько задач в очереди стоит перед данной"""
+        job = self.get(job_id)
+        if job is None or job["status"] != QUEUED:
+            return 0
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?) AND created_at < ?",
+            (QUEUED, RUNNING, job["created_at"]),
+        ).fetchone()[0]
+
+    def _update(self, job_id, **fields):
+        """Обновляет задачу этого процесса; JobLostError, если ее уже забрал другой процесс"""
+        fields["updated_at"] = datetime.now().isoformat()
+        fields["heartbeat"] = time.time()
+        if "partial" in fields and fields["partial"] is not None:
+            fields["partial"] = json.dumps(fields["partial"], ensure_ascii=False)
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        cursor = self._connection().execute(
+            f"UPDATE jobs SET {assignments} WHERE id = ? AND owner = ?", (*fields.values(), job_id, self.owner)
+        )
+        if cursor.rowcount != 1:
+            raise JobLostError(f"Job {job_id} was taken over by another process")
+
+    def _claim(self, job_id):
+        cursor = self._connection().execute(
+            "UPDATE jobs SET status = ?, owner = ?, heartbeat = ?, updated_at = ? WHERE id = ? AND status = ?",
+            (RUNNING, self.owner, time.time(), datetime.now().isoformat(), job_id, QUEUED),
+        )
+        return cursor.rowcount == 1
+
+    def _handler_for(self, kind):
+        """Обработчик задач kind или None, если он не зарегистрирован за handler_timeout"""
+        with self._handlers_changed:
+            # Обработчик регистрирует первая сессия, загрузившая индексы
+            self._handlers_changed.wait_for(lambda: kind in self._handlers, timeout=self.handler_timeout)
+            return self._handlers.get(kind)
+
+    def _run(self, job_id):
+        job = self.get(job_id)
+        if job is None or job["status"] != QUEUED:
+            return
+        handler = self._handler_for(job["kind"])
+        if not self._claim(job_id):
+            return
+
+        def report(progress, partial=None, _job_id=job_id):
+            self._update(_job_id, progress=progress, partial=partial)
+
+        try:
+            if handler is None:
+                raise RuntimeError(f"Нет обработчика для задач типа {job['kind']}")
+            result = handler(job, report)
+            self._update(job_id, status=DONE, progress=1.0, result=result)
+            logging.info(f"Job {job_id} ({job['kind']}) finished")
+        except JobLostError as e:
+            logging.warning(f"{e}; result discarded")
+        except Exception as e:
+            logging.error(f"Job {job_id} ({job['kind']}) failed: {e}")
+            try:
+                self._update(job_id, status=ERROR, error=str(e))
+            except JobLostError as lost:
+                logging.warning(f"{lost}; error discarded")
+
+    def _worker(self):
+        while True:
+            job_id = self._queue.get()
+            with self._enqueued_lock:
+                self._enqueued.discard(job_id)
+            try:
+                self._run(job_id)
+            except Exception as e:
+                # Ошибка базы или другой сбой одной задачи не должен останавливать очередь
+                logging.error(f"Job {job_id} worker error: {e}")
+                try:
+                    # Захваченная задача иначе осталась бы выполняемой под живым heartbeat
+                    self._update(job_id, status=ERROR, error=str(e))
+                except Exception:
+                    pass
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,344 @@
+"""Генератор нагрузки: N одновременных пользователей через тот же путь, что и app.py.
+
+Каждый виртуальный пользователь работает в своем потоке (как скрипт Streamlit)
+и вызывает process_search_request_async / process_tt_request_async, то есть
+проходит через общий REQUEST_EXECUTOR. Параллельно снимаются размеры очереди
+пула, чтобы видеть потолок пропускной способности и момент начала очередей.
+
+Пример (с локальной заглушкой вместо Ollama):
+    python load_test.py --users 8 --requests 5 --mode mixed --fake-ollama --token-rate 20
+
+С --url нагрузка идет на HTTP API (http_api.py): у каждого пользователя одно
+keep-alive соединение, с --stream дополнительно меряется время до первого токена.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import statistics
+import threading
+import time
+
+DEFAULT_QUESTIONS = [
+    "Как определить точку насыщения трансформатора тока?",
+    "Расскажи о методах расчета коэффициента насыщения",
+    "Какие требования к вторичной нагрузке?",
+    "Что такое характеристика намагничивания?",
+]
+DEFAULT_TT_REQUESTS = [
+    "Создай ТТ на трансформатор тока 10кВ",
+    "Сгенерируй технические требования на трансформатор тока 110 кВ для РЗА",
+]
+ERROR_PREFIXES = ("Ошибка", "Превышено время ожидания")
+
+
+def load_questions(path):
+    """Загружает вопросы из JSONL ({"question": ..., "mode": ...}) или текстового файла"""
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                record = json.loads(line)
+                questions.append((record.get("mode", "search"), record["question"]))
+            else:
+                questions.append(("search", line))
+    return questions
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class QueueMonitor(threading.Thread):
+    """Периодически снимает глубину очереди и число занятых потоков REQUEST_EXECUTOR"""
+
+    def __init__(self, executor, interval=0.1):
+        super().__init__(name="queue-monitor", daemon=True)
+        self.executor = executor
+        self.interval = interval
+        self.samples = []
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.samples.append((time.perf_counter(), self.executor._work_queue.qsize()))
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+
+def build_chains(index_dir, tt_index_dir, embed_batching=True, embed_max_batch=32, embed_max_wait_ms=5.0):
+    """Загружает индексы и цепочки так же, как app.py"""
+    from langchain_community.vectorstores import FAISS
+    from chain_factory import create_rag_chain, create_tt_chain
+    from embedding_service import BatchingEmbeddings
+    from embeddings_backend import create_embeddings
+    from parent_store import ParentStore
+    from index_manager import current_index_dir
+    from retrieval_worker import RetrievalClient, worker_address
+
+    if worker_address():
+        # Общий процесс поиска: здесь только тонкий клиент
+        indexes = RetrievalClient().open_indexes()
+        vectorstore, parent_store, _ = indexes["normative"]
+        tt_vectorstore, tt_parent_store, _ = indexes.get("tt") or indexes["normative"]
+        return (create_rag_chain(vectorstore, parent_store=parent_store),
+                create_tt_chain(tt_vectorstore, parent_store=tt_parent_store), vectorstore.embeddings)
+
+    embeddings = create_embeddings("sentence-transformers/paraphrase-multilingual-mpnet-base-v2")
+    if embed_batching:
+        embeddings = BatchingEmbeddings(embeddings, max_batch=embed_max_batch, max_wait_ms=embed_max_wait_ms)
+    index_dir, tt_index_dir = current_index_dir(index_dir), current_index_dir(tt_index_dir)
+    if not os.path.exists(index_dir):
+        raise SystemExit("Индекс нормативных документов не найден. Сначала запустите main.py для создания индексов.")
+    vectorstore = FAISS.load_local(index_dir, embeddings, allow_dangerous_deserialization=True)
+    if os.path.exists(tt_index_dir):
+        tt_vectorstore = FAISS.load_local(tt_index_dir, embeddings, allow_dangerous_deserialization=True)
+        tt_parent_store = ParentStore.open(tt_index_dir)
+    else:
+        tt_vectorstore = vectorstore
+        tt_parent_store = ParentStore.open(index_dir)
+    return (create_rag_chain(vectorstore, parent_store=ParentStore.open(index_dir)),
+            create_tt_chain(tt_vectorstore, parent_store=tt_parent_store), embeddings)
+
+
+def run_user(user_id, args, plan, qa_chain, tt_chain, results, results_lock, start_barrier):
+    from async_handlers import process_search_request_async, process_tt_request_async
+
+    rnd = random.Random(args.seed + user_id if args.seed is not None else None)
+    start_barrier.wait()
+    for _ in range(args.requests):
+        mode, question = rnd.choice(plan)
+        started = time.perf_counter()
+        if mode == "tt":
+            response = process_tt_request_async(tt_chain, question)
+        else:
+            response = process_search_request_async(qa_chain, question)
+        elapsed = time.perf_counter() - started
+        with results_lock:
+            results.append({
+                "user": user_id,
+                "mode": mode,
+                "latency": elapsed,
+                "ok": not str(response).startswith(ERROR_PREFIXES),
+                "timeout": str(response).startswith("Превышено время ожидания"),
+                "chars": len(str(response)),
+            })
+        if args.think_time > 0:
+            time.sleep(rnd.expovariate(1.0 / args.think_time))
+
+
+def http_request(connection, path, question, stream):
+    """POST в HTTP API: (ok, timeout, символов ответа, время до первого события SSE или None)"""
+    started = time.perf_counter()
+    body = json.dumps({"question": question, "stream": stream}, ensure_ascii=False).encode("utf-8")
+    connection.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+    response = connection.getresponse()
+    if not stream or response.status != 200:
+        payload = json.loads(response.read() or b"{}")
+        text = payload.get("answer") or payload.get("text") or payload.get("error", "")
+        return response.status == 200, response.status == 504, len(text), None
+    first_event, chars, ok, timeout = None, 0, False, False
+    event = None
+    while True:
+        line = response.readline()
+        if not line:
+            break
+        line = line.decode("utf-8").rstrip("\n")
+        if line.startswith("event: "):
+            event = line[len("event: "):]
+        elif line.startswith("data: "):
+            data = json.loads(line[len("data: "):])
+            if first_event is None:
+                first_event = time.perf_counter() - started
+            if event in ("token", "section"):
+                chars += len(data.get("text", ""))
+            elif event == "done":
+                ok = True
+            elif event == "error":
+                timeout = "времени ожидания" in data.get("error", "")
+    return ok, timeout, chars, first_event
+
+
+def run_http_user(user_id, args, plan, results, results_lock, start_barrier):
+    from urllib.parse import urlsplit
+
+    url = urlsplit(args.url)
+    rnd = random.Random(args.seed + user_id if args.seed is not None else None)
+    connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=300)
+    start_barrier.wait()
+    for _ in range(args.requests):
+        mode, question = rnd.choice(plan)
+        path = "/tt" if mode == "tt" else "/answer"
+        started = time.perf_counter()
+        try:
+            ok, timeout, chars, first_event = http_request(connection, path, question, args.stream)
+        except (http.client.HTTPException, OSError):
+            # Сервер мог закрыть keep-alive соединение - одна повторная попытка на новом
+            connection.close()
+            try:
+                ok, timeout, chars, first_event = http_request(connection, path, question, args.stream)
+            except (http.client.HTTPException, OSError):
+                ok, timeout, chars, first_event = False, False, 0, None
+        elapsed = time.perf_counter() - started
+        with results_lock:
+            results.append({
+                "user": user_id,
+                "mode": mode,
+                "latency": elapsed,
+                "ok": ok,
+                "timeout": timeout,
+                "chars": chars,
+                "first_event": first_event,
+            })
+        if args.think_time > 0:
+            time.sleep(rnd.expovariate(1.0 / args.think_time))
+    connection.close()
+
+
+def summarize(results, wall_time, queue_samples):
+    print("\n=== Результаты нагрузочного теста ===")
+    print(f"Запросов: {len(results)} за {wall_time:.1f} с "
+          f"({len(results) / wall_time if wall_time else 0:.2f} запр/с)")
+    for mode in sorted({r["mode"] for r in results}):
+        subset = [r for r in results if r["mode"] == mode]
+        latencies = [r["latency"] for r in subset if r["ok"]]
+        errors = sum(1 for r in subset if not r["ok"])
+        timeouts = sum(1 for r in subset if r["timeout"])
+        print(f"[{mode}] всего={len(subset)} ошибок={errors} таймаутов={timeouts}")
+        if latencies:
+            print(f"  латентность, с: p50={percentile(latencies, 50):.2f} "
+                  f"p95={percentile(latencies, 95):.2f} p99={percentile(latencies, 99):.2f} "
+                  f"среднее={statistics.mean(latencies):.2f} max={max(latencies):.2f}")
+        first_events = [r["first_event"] for r in subset if r.get("first_event") is not None]
+        if first_events:
+            print(f"  до первого события SSE, с: p50={percentile(first_events, 50):.2f} "
+                  f"p95={percentile(first_events, 95):.2f}")
+    if queue_samples:
+        depths = [depth for _, depth in queue_samples]
+        busy = sum(1 for d in depths if d > 0) / len(depths)
+        print(f"Очередь REQUEST_EXECUTOR: max={max(depths)} среднее={statistics.mean(depths):.2f} "
+              f"доля времени с очередью={busy:.0%}")
+
+
+def build_plan(args):
+    if args.questions:
+        plan = load_questions(args.questions)
+        if args.mode != "mixed":
+            plan = [(args.mode, q) for _, q in plan]
+    elif args.mode == "search":
+        plan = [("search", q) for q in DEFAULT_QUESTIONS]
+    elif args.mode == "tt":
+        plan = [("tt", q) for q in DEFAULT_TT_REQUESTS]
+    else:
+        plan = [("search", q) for q in DEFAULT_QUESTIONS] + [("tt", q) for q in DEFAULT_TT_REQUESTS]
+    return plan
+
+
+def run_http_load(args):
+    """Нагрузка на HTTP API: цепочки и заглушка Ollama - в процессе сервера"""
+    plan = build_plan(args)
+    results = []
+    results_lock = threading.Lock()
+    start_barrier = threading.Barrier(args.users + 1)
+    users = [
+        threading.Thread(target=run_http_user, name=f"user-{i}",
+                         args=(i, args, plan, results, results_lock, start_barrier))
+        for i in range(args.users)
+    ]
+    for user in users:
+        user.start()
+    started = time.perf_counter()
+    start_barrier.wait()
+    for user in users:
+        user.join()
+    summarize(results, time.perf_counter() - started, [])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест цепочек поиска и генерации ТТ")
+    parser.add_argument("--users", type=int, default=4, help="число одновременных пользователей")
+    parser.add_argument("--requests", type=int, default=3, help="запросов на пользователя")
+    parser.add_argument("--mode", choices=["search", "tt", "mixed"], default="search")
+    parser.add_argument("--questions", help="файл с вопросами (JSONL или по одному в строке)")
+    parser.add_argument("--think-time", type=float, default=0.0, help="средняя пауза между запросами, с")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--index", default="./faiss_index")
+    parser.add_argument("--tt-index", default="./faiss_index_tt")
+    parser.add_argument("--ollama-host", help="адрес Ollama (по умолчанию OLLAMA_HOST или локальный)")
+    parser.add_argument("--fake-ollama", action="store_true", help="поднять заглушку Ollama в этом процессе")
+    parser.add_argument("--fake-port", type=int, default=11435)
+    parser.add_argument("--token-rate", type=float, default=30.0)
+    parser.add_argument("--latency", default="fixed:0.2")
+    parser.add_argument("--max-tokens", type=int, default=200)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--parallel", type=int, default=1, help="OLLAMA_NUM_PARALLEL заглушки")
+    parser.add_argument("--no-embed-batching", action="store_true", help="кодировать запросы по одному")
+    parser.add_argument("--embed-max-batch", type=int, default=32, help="максимальная пачка кодирования запросов")
+    parser.add_argument("--embed-max-wait-ms", type=float, default=5.0, help="ожидание сбора пачки, мс")
+    parser.add_argument("--url", help="нагружать HTTP API (http_api.py) по этому адресу вместо цепочек в процессе")
+    parser.add_argument("--stream", action="store_true", help="с --url: запросы с потоковой выдачей SSE")
+    args = parser.parse_args()
+
+    fake_server = None
+    if args.url:
+        run_http_load(args)
+        return
+    if args.fake_ollama:
+        from fake_ollama import FakeOllamaConfig, start_in_background
+        config = FakeOllamaConfig(token_rate=args.token_rate, latency=args.latency,
+                                  max_tokens=args.max_tokens, fail_rate=args.fail_rate,
+                                  parallel=args.parallel, seed=args.seed)
+        fake_server = start_in_background(port=args.fake_port, config=config)
+        os.environ["OLLAMA_HOST"] = f"http://127.0.0.1:{args.fake_port}"
+    elif args.ollama_host:
+        os.environ["OLLAMA_HOST"] = args.ollama_host
+
+    # Клиенты Ollama читают OLLAMA_HOST при создании, поэтому цепочки строим после настройки окружения
+    qa_chain, tt_chain, embeddings = build_chains(args.index, args.tt_index, not args.no_embed_batching,
+                                                  args.embed_max_batch, args.embed_max_wait_ms)
+
+    plan = build_plan(args)
+
+    from async_handlers import REQUEST_EXECUTOR
+
+    results = []
+    results_lock = threading.Lock()
+    start_barrier = threading.Barrier(args.users + 1)
+    users = [
+        threading.Thread(target=run_user, name=f"user-{i}",
+                         args=(i, args, plan, qa_chain, tt_chain, results, results_lock, start_barrier))
+        for i in range(args.users)
+    ]
+    for user in users:
+        user.start()
+
+    monitor = QueueMonitor(REQUEST_EXECUTOR)
+    monitor.start()
+    started = time.perf_counter()
+    start_barrier.wait()
+    for user in users:
+        user.join()
+    wall_time = time.perf_counter() - started
+    monitor.stop()
+
+    summarize(results, wall_time, monitor.samples)
+    if hasattr(embeddings, "stats"):
+        print(f"Микропакеты кодирования запросов: {embeddings.stats()}")
+    if fake_server is not None:
+        print(f"Заглушка Ollama: {fake_server.stats.snapshot()}")
+        fake_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,33 @@
 import os
+import sys
+import argparse
 import logging
-import fitz
 import re
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
+from embeddings_backend import create_embeddings
 from search_handler import setup_search_chain, handle_search_mode
 from tt_handler import setup_tt_chain, handle_tt_mode
+from batch_mode import run_batch
+from convert_pdfs_to_markdown import PAGE_SEPARATOR, convert_pdfs
+from dedup import deduplicate_chunks, print_dedup_report
+from document_index import build_document_index
+from index_manager import current_index_dir
+from parent_store import ParentStore, page_at
+from retrieval_worker import RetrievalClient, worker_address
+from retrievers import CALIBRATION_MODE, DEFAULT_CALIBRATION_QUESTIONS, calibrate_index, load_calibration
+from sharded_index import SHARD_STRATEGIES, build_sharded_index, is_sharded, load_index, open_parent_store
+from table_store import TableStore
+from terms_index import TermsIndex
 
 logging.basicConfig(filename='activity.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Parent sections go into the prompt, child chunks are embedded and searched
+PARENT_CHUNK_SIZE = 1500
+PARENT_CHUNK_OVERLAP = 300
+CHILD_CHUNK_SIZE = 400
+CHILD_CHUNK_OVERLAP = 80
+
 
 def extract_section_references(text):
     """Extract GOST section references from text chunk"""
@@ -46,30 +64,32 @@ def extract_section_references(text):
 def load_documents_from_directory(directory_path):
     documents = []
 
+    # PDF конвертируются в Markdown по страницам в пуле процессов (с кэшем по хэшу страницы)
+    pdf_paths = [
+        os.path.join(root, file)
+        for root, dirs, files in os.walk(directory_path)
+        for file in files if file.endswith('.pdf')
+    ]
+    if pdf_paths:
+        for pdf_path, pages in convert_pdfs(pdf_paths).items():
+            file = os.path.basename(pdf_path)
+            documents.append({
+                'content': PAGE_SEPARATOR.join(pages),
+                'page_offsets': page_offsets_for(pages),
+                'metadata': {'source': pdf_path, 'filename': file, 'format': 'markdown'}
+            })
+            print(f"Загружен PDF файл: {file}")
+
     for root, dirs, files in os.walk(directory_path):
         for file in files:
-            if file.endswith('.pdf'):
-                pdf_path = os.path.join(root, file)
-                try:
-                    doc = fitz.open(pdf_path)
-                    text = ""
-                    for page in doc:
-                        text += page.get_text()
-                    documents.append({
-                        'content': text,
-                        'metadata': {'source': pdf_path, 'filename': file, 'format': 'pdf'}
-                    })
-                    doc.close()
-                    print(f"Загружен PDF файл: {file}")
-                except Exception as e:
-                    print(f"Ошибка при загрузке {pdf_path}: {e}")
-            elif file.endswith('.txt'):
+            if file.endswith('.txt'):
                 txt_path = os.path.join(root, file)
                 try:
                     with open(txt_path, 'r', encoding='utf-8') as f:
                         text = f.read()
                     documents.append({
                         'content': text,
+                        'page_offsets': [0],
                         'metadata': {'source': txt_path, 'filename': file, 'format': 'text'}
                     })
                     print(f"Загружен текстовый файл: {file}")
@@ -79,67 +99,180 @@ def load_documents_from_directory(directory_path):
     return documents
 
 
-def create_vectorstore(documents):
+def page_offsets_for(pages):
+    """Character offsets of page starts in the joined document text"""
+    offsets, position = [], 0
+    for page in pages:
+        offsets.append(position)
+        position += len(page) + len(PAGE_SEPARATOR)
+    return offsets
+
+
+def create_text_splitter(chunk_size=PARENT_CHUNK_SIZE, chunk_overlap=PARENT_CHUNK_OVERLAP):
+    """Splitter for Markdown from convert_pdfs_to_markdown (and plain text)"""
     # Use separators optimized for GOST standards with section preservation
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1500,
-        chunk_overlap=300,
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        is_separator_regex=True,
         separators=[
+            r"\n#{1,3} ",               # Markdown headings
             r"\n\d+\.\d+\.\d+\.?\s",  # GOST subsections like 4.2.3.
             r"\n\d+\.\d+\.?\s",       # GOST sections like 4.2.
             r"\n\d+\.?\s",            # GOST main sections like 4.
-            "\n\n",                  # Paragraphs
-            "\n",                    # Lines
-            ". ",                    # Sentences
+            r"\n\n",                  # Paragraphs (tables are kept whole)
+            r"\n(?!\|)",               # Lines, but not between table rows
+            r"\. ",                    # Sentences
             " ",                     # Words
             ""                       # Characters
         ]
     )
-    texts = [doc['content'] for doc in documents]
-    metadatas = [doc['metadata'] for doc in documents]
+
+
+def split_with_offsets(text_splitter, text, start=0, end=None):
+    """Split text[start:end] and return (start, end) spans of the chunks in text"""
+    spans = []
+    search_from = 0
+    segment = text[start:end]
+    for chunk in text_splitter.split_text(segment):
+        position = segment.find(chunk, search_from)
+        if position == -1:
+            continue
+        spans.append((start + position, start + position + len(chunk)))
+        search_from = position + 1
+    return spans
+
+
+def attach_orphan_headings(spans, text):
+    """A chunk consisting only of Markdown headings is merged into the next chunk"""
+    merged = []
+    heading_start = None
+    for start, end in spans:
+        lines = [line for line in text[start:end].splitlines() if line.strip()]
+        if lines and all(line.startswith('#') for line in lines):
+            if heading_start is None:
+                heading_start = start
+            continue
+        merged.append((start if heading_start is None else heading_start, end))
+        heading_start = None
+    if heading_start is not None:
+        merged.append((heading_start, spans[-1][1]))
+    return merged
+
+
+def create_index_embeddings(embedding_model=None):
+    """Embeddings for building an index: the collection's model from the registry or the default one"""
+    if embedding_model:
+        return create_embeddings(embedding_model)
     # Try different embeddings model for Python 3.14 compatibility
     try:
-        embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+        return create_embeddings("sentence-transformers/all-MiniLM-L6-v2")
     except Exception as e:
         print(f"Warning: Could not load preferred embeddings model: {e}")
         print("Falling back to basic embeddings...")
         # Fallback to a more basic model
-        embeddings = HuggingFaceEmbeddings(model_name="distilbert-base-uncased")
+        return create_embeddings("distilbert-base-uncased")
+
+
+def create_vectorstore(documents, index_dir, embedding_model=None):
+    """Index child chunks in FAISS; parent sections and document text go to the parent store"""
+    parent_splitter = create_text_splitter()
+    child_splitter = create_text_splitter(CHILD_CHUNK_SIZE, CHILD_CHUNK_OVERLAP)
+    embeddings = create_index_embeddings(embedding_model)
+    parent_store = ParentStore.create(index_dir)
+    # Tables go to a structured store for exact lookups without the LLM
+    table_store = TableStore.create(index_dir)
+    table_count = 0
+    # Definitions from "Термины и определения" sections are quoted without the LLM
+    terms_index = TermsIndex.create(index_dir)
+    parent_texts = []
+    parent_metadatas = []
+    for doc_id, document in enumerate(documents):
+        text = document['content']
+        parent_store.add_document(doc_id, document['metadata'], text, document.get('page_offsets', [0]))
+        table_count += table_store.add_document(document['metadata'], text, document.get('page_offsets', [0]))
+        terms_index.add_document(document['metadata'], text, document.get('page_offsets', [0]))
+        for start, end in attach_orphan_headings(split_with_offsets(parent_splitter, text), text):
+            parent_metadata = document['metadata'].copy()
+            parent_metadata.update({'doc_id': doc_id, 'start': start, 'end': end})
+            parent_texts.append(text[start:end])
+            parent_metadatas.append(parent_metadata)
+    # Near-duplicate sections (editions of one standard, overlaps) are dropped before embedding
+    section_metadatas = parent_metadatas
+    parent_texts, parent_metadatas, dedup_report = deduplicate_chunks(parent_texts, parent_metadatas)
+    kept_sections = {(metadata['doc_id'], metadata['start']) for metadata in parent_metadatas}
+    # Vectors saved by dedup are the child chunks of the removed sections
+    removed_children = 0
+    for metadata in section_metadatas:
+        if (metadata['doc_id'], metadata['start']) not in kept_sections:
+            text = documents[metadata['doc_id']]['content']
+            removed_children += len(attach_orphan_headings(
+                split_with_offsets(child_splitter, text, metadata['start'], metadata['end']), text))
+
     all_chunks = []
     all_metadatas = []
-    for i, text in enumerate(texts):
-        chunks = text_splitter.split_text(text)
-        for chunk in chunks:
-            # Extract section references for this chunk
-            sections = extract_section_references(chunk)
-            chunk_metadata = metadatas[i].copy()
-            chunk_metadata['sections'] = sections
+    for parent_id, (parent_text, parent_metadata) in enumerate(zip(parent_texts, parent_metadatas)):
+        doc_id, start, end = parent_metadata.pop('doc_id'), parent_metadata.pop('start'), parent_metadata.pop('end')
+        text = documents[doc_id]['content']
+        page_offsets = documents[doc_id].get('page_offsets', [0])
+        extra = {'duplicate_sources': parent_metadata['duplicate_sources']} if 'duplicate_sources' in parent_metadata else None
+        parent_store.add_parent(parent_id, doc_id, start, end, page_at(page_offsets, start),
+                                page_at(page_offsets, end - 1), extract_section_references(parent_text), extra)
+        # Small child chunks match the question more precisely; the prompt gets their parent section
+        for child_start, child_end in attach_orphan_headings(split_with_offsets(child_splitter, text, start, end), text):
+            chunk = text[child_start:child_end]
+            chunk_metadata = parent_metadata.copy()
+            chunk_metadata.update({
+                'sections': extract_section_references(chunk),
+                'doc_id': doc_id,
+                'parent_id': parent_id,
+                'start': child_start,
+                'end': child_end,
+                'page': page_at(page_offsets, child_start),
+            })
             all_chunks.append(chunk)
             all_metadatas.append(chunk_metadata)
+    parent_store.commit()
+    table_store.commit()
+    terms_index.save()
     vectorstore = FAISS.from_texts(texts=all_chunks, embedding=embeddings, metadatas=all_metadatas)
+    print_dedup_report(dedup_report, vectorstore.index.d, unit="разделов", removed_vectors=removed_children)
+    # Центроиды документов для двухуровневого поиска (documents.npz рядом с индексом)
+    vectorstore.document_index = build_document_index(vectorstore, index_dir)
+    print(f"Разделов: {len(parent_texts)}, дочерних фрагментов в индексе: {len(all_chunks)}, таблиц: {table_count}, "
+          f"терминов: {terms_index.size}")
     return vectorstore
 
 
-def create_indexes_only():
-    """Create indexes without starting interactive mode"""
+def create_indexes_only(shards=1, shard_by="document"):
+    """Create indexes without starting interactive mode (the normative one split into shards if shards > 1)"""
     # Нормативные документы
     docs_dir = "files"
     normative_vectorstore = None
     index_faiss = "./faiss_index/index.faiss"
     index_pkl = "./faiss_index/index.pkl"
 
-    if not (os.path.exists(index_faiss) and os.path.exists(index_pkl)):
+    if not (os.path.exists(index_faiss) and os.path.exists(index_pkl)) and not is_sharded("./faiss_index"):
         print("Создание векторного хранилища нормативных документов...")
         documents = load_documents_from_directory(docs_dir)
         if not documents:
             print("Нормативные документы не найдены!")
             return False
-        normative_vectorstore = create_vectorstore(documents)
-        normative_vectorstore.save_local("./faiss_index")
-        print(f"Обработано {len(documents)} нормативных документов")
+        if shards > 1:
+            build_sharded_index(documents, "./faiss_index", shards, shard_by, calibrate=True)
+            print(f"Обработано {len(documents)} нормативных документов, частей индекса: {shards}")
+        else:
+            normative_vectorstore = create_vectorstore(documents, "./faiss_index")
+            normative_vectorstore.save_local("./faiss_index")
+            print(f"Обработано {len(documents)} нормативных документов")
+            calibrate_index("./faiss_index", normative_vectorstore)
     else:
         print("Векторное хранилище нормативных документов уже существует.")
+    return create_tt_index()
 
+
+def create_tt_index():
+    """Create the TT index if files_TT exists and the index is missing"""
     # TT документы
     tt_docs_dir = "files_TT"
     tt_vectorstore = None
@@ -151,7 +284,7 @@ def create_indexes_only():
             print("Создание векторного хранилища ТТ документов...")
             tt_documents = load_documents_from_directory(tt_docs_dir)
             if tt_documents:
-                tt_vectorstore = create_vectorstore(tt_documents)
+                tt_vectorstore = create_vectorstore(tt_documents, "./faiss_index_tt")
                 tt_vectorstore.save_local("./faiss_index_tt")
                 print(f"Обработано {len(tt_documents)} ТТ документов")
             else:
@@ -164,40 +297,35 @@ def create_indexes_only():
     return True
 
 
-def main():
-    import sys
-
-    # Check for command line arguments
-    if len(sys.argv) > 1 and sys.argv[1] == "--create-indexes":
-        success = create_indexes_only()
-        sys.exit(0 if success else 1)
-
+def prepare_vectorstores():
+    """Load or build the normative and TT vectorstores"""
     # Нормативные документы
     docs_dir = "files"
     normative_vectorstore = None
-    if not os.path.exists("./faiss_index"):
+    if not os.path.exists(current_index_dir("./faiss_index")):
         print("Создание векторного хранилища нормативных документов...")
         documents = load_documents_from_directory(docs_dir)
         if not documents:
             print("Нормативные документы не найдены!")
-            return
-        normative_vectorstore = create_vectorstore(documents)
+            return None, None
+        normative_vectorstore = create_vectorstore(documents, "./faiss_index")
         normative_vectorstore.save_local("./faiss_index")
         print(f"Обработано {len(documents)} нормативных документов")
+        calibrate_index("./faiss_index", normative_vectorstore)
     else:
         print("Загрузка существующего векторного хранилища нормативных документов...")
-        embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-        normative_vectorstore = FAISS.load_local("./faiss_index", embeddings, allow_dangerous_deserialization=True)
+        embeddings = create_embeddings("sentence-transformers/all-MiniLM-L6-v2")
+        normative_vectorstore, _ = load_index(current_index_dir("./faiss_index"), embeddings)
 
     # TT документы
     tt_docs_dir = "files_TT"
     tt_vectorstore = None
     if os.path.exists(tt_docs_dir):
-        if not os.path.exists("./faiss_index_tt"):
+        if not os.path.exists(current_index_dir("./faiss_index_tt")):
             print("Создание векторного хранилища ТТ документов...")
             tt_documents = load_documents_from_directory(tt_docs_dir)
             if tt_documents:
-                tt_vectorstore = create_vectorstore(tt_documents)
+                tt_vectorstore = create_vectorstore(tt_documents, "./faiss_index_tt")
                 tt_vectorstore.save_local("./faiss_index_tt")
                 print(f"Обработано {len(tt_documents)} ТТ документов")
             else:
@@ -205,15 +333,83 @@ def main():
                 tt_vectorstore = normative_vectorstore  # fallback to normative
         else:
             print("Загрузка существующего векторного хранилища ТТ документов...")
-            embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-            tt_vectorstore = FAISS.load_local("./faiss_index_tt", embeddings, allow_dangerous_deserialization=True)
+            embeddings = create_embeddings("sentence-transformers/all-MiniLM-L6-v2")
+            tt_vectorstore, _ = load_index(current_index_dir("./faiss_index_tt"), embeddings)
     else:
         print("Папка files_TT не найдена. Используем нормативные документы для ТТ.")
         tt_vectorstore = normative_vectorstore
 
+    return normative_vectorstore, tt_vectorstore
+
+
+def tt_index_dir(tt_vectorstore, normative_vectorstore):
+    """Index directory of the TT vectorstore (the normative one is used as a fallback)"""
+    index_dir = "./faiss_index" if tt_vectorstore is normative_vectorstore else "./faiss_index_tt"
+    return current_index_dir(index_dir)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="RAG-агент по нормативным документам")
+    parser.add_argument("--create-indexes", action="store_true",
+                        help="создать индексы без запуска интерактивного режима")
+    parser.add_argument("--batch", metavar="QUESTIONS_JSONL",
+                        help="пакетный режим: ответить на вопросы из JSONL файла")
+    parser.add_argument("--mode", choices=["search", "rag", "tt"], default="search",
+                        help="режим цепочки для пакетного режима")
+    parser.add_argument("--out", default="answers.jsonl",
+                        help="JSONL файл с ответами (дописывается, запуск возобновляем)")
+    parser.add_argument("--concurrency", type=int, default=2,
+                        help="число одновременных запросов к LLM в пакетном режиме")
+    parser.add_argument("--calibrate", nargs="?", const=DEFAULT_CALIBRATION_QUESTIONS, metavar="QUESTIONS_JSONL",
+                        help="откалибровать динамический k нормативного индекса по размеченным вопросам")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="с --create-indexes: разделить нормативный индекс на N частей для параллельного поиска")
+    parser.add_argument("--shard-by", choices=SHARD_STRATEGIES, default="document",
+                        help="деление на части: document - по объему документов, hash - по хэшу имени файла")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+
+    if args.create_indexes:
+        success = create_indexes_only(args.shards, args.shard_by)
+        sys.exit(0 if success else 1)
+
+    if worker_address() and not args.calibrate:
+        # Поиск и эмбеддинги - в общем процессе поиска (retrieval_worker.py)
+        indexes = RetrievalClient().open_indexes()
+        normative_vectorstore, normative_parents, normative_calibration = indexes["normative"]
+        tt_vectorstore, tt_parents, _ = indexes.get("tt") or indexes["normative"]
+    else:
+        normative_vectorstore, tt_vectorstore = prepare_vectorstores()
+        if normative_vectorstore is None:
+            return
+        normative_parents = open_parent_store(current_index_dir("./faiss_index"), normative_vectorstore)
+        tt_parents = open_parent_store(tt_index_dir(tt_vectorstore, normative_vectorstore), tt_vectorstore)
+        normative_calibration = load_calibration(current_index_dir("./faiss_index"), normative_vectorstore.embeddings)
+
+    if args.calibrate:
+        success = calibrate_index(current_index_dir("./faiss_index"), normative_vectorstore, args.calibrate) is not None
+        sys.exit(0 if success else 1)
+
+    if args.batch:
+        vectorstore = tt_vectorstore if args.mode == "tt" else normative_vectorstore
+        # Калибровка подобрана под настройки поиска своего режима (rag) и в других режимах не применяется
+        calibration = None
+        if args.mode != "tt" and normative_calibration and \
+                normative_calibration.get("mode", CALIBRATION_MODE) == args.mode:
+            calibration = normative_calibration
+        parent_store = tt_parents if args.mode == "tt" else normative_parents
+        success = run_batch(vectorstore, args.batch, args.out, mode=args.mode, concurrency=args.concurrency,
+                            calibration=calibration, parent_store=parent_store)
+        sys.exit(0 if success else 1)
+
     # Настройка цепочек через модули
-    search_chain = setup_search_chain(normative_vectorstore)
-    tt_chain = setup_tt_chain(tt_vectorstore)
+    search_chain = setup_search_chain(normative_vectorstore, normative_parents,
+                                      TableStore.open(current_index_dir("./faiss_index")),
+                                      TermsIndex.open(current_index_dir("./faiss_index")))
+    tt_chain = setup_tt_chain(tt_vectorstore, tt_parents)
 
     print("Система готова!")
     print("Выберите режим:")
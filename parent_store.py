@@ -0,0 +1,135 @@
+"""Хранилище родительских разделов для поиска small-to-big.
+
+В индекс FAISS попадают мелкие дочерние фрагменты (точнее совпадают с вопросом),
+а в контекст LLM - их родительские разделы (законченный пункт нормы). Текст
+документов (Markdown после конвертации) и границы родительских разделов хранятся
+в parents.db в папке индекса, поэтому расширение до раздела не требует повторного
+чтения PDF. В метаданных дочерних фрагментов: doc_id, parent_id, смещения start/end
+в тексте документа и номер страницы.
+"""
+import bisect
+import json
+import os
+import sqlite3
+import threading
+
+from langchain_core.documents import Document
+
+PARENT_STORE_FILE = "parents.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    doc_id INTEGER PRIMARY KEY,
+    metadata TEXT NOT NULL,
+    content TEXT NOT NULL,
+    page_offsets TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS parents (
+    parent_id INTEGER PRIMARY KEY,
+    doc_id INTEGER NOT NULL REFERENCES documents(doc_id),
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    page_start INTEGER NOT NULL,
+    page_end INTEGER NOT NULL,
+    sections TEXT NOT NULL,
+    metadata TEXT NOT NULL DEFAULT '{}'
+);
+"""
+
+
+def page_at(page_offsets, offset):
+    """Номер страницы (с 1) для смещения в тексте документа"""
+    return max(bisect.bisect_right(page_offsets, offset), 1)
+
+
+class ParentStore:
+    """Документы и границы родительских разделов в SQLite рядом с индексом"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    @classmethod
+    def open(cls, index_dir):
+        """Хранилище индекса или None, если индекс построен без дочерних фрагментов"""
+        db_path = os.path.join(index_dir, PARENT_STORE_FILE)
+        return cls(db_path) if os.path.exists(db_path) else None
+
+    @classmethod
+    def create(cls, index_dir):
+        """Новое пустое хранилище (старое удаляется)"""
+        os.makedirs(index_dir, exist_ok=True)
+        db_path = os.path.join(index_dir, PARENT_STORE_FILE)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        return cls(db_path)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def add_document(self, doc_id, metadata, content, page_offsets):
+        self._connection().execute(
+            "INSERT INTO documents (doc_id, metadata, content, page_offsets) VALUES (?, ?, ?, ?)",
+            (doc_id, json.dumps(metadata, ensure_ascii=False), content, json.dumps(page_offsets)),
+        )
+
+    def add_parent(self, parent_id, doc_id, start, end, page_start, page_end, sections, extra=None):
+        """extra - дополнительные метаданные раздела (например, duplicate_sources)"""
+        self._connection().execute(
+            "INSERT INTO parents (parent_id, doc_id, start, end, page_start, page_end, sections, metadata) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (parent_id, doc_id, start, end, page_start, page_end, json.dumps(sections),
+             json.dumps(extra or {}, ensure_ascii=False)),
+        )
+
+    def commit(self):
+        self._connection().commit()
+
+    def get_parents(self, parent_ids):
+        """Родительские разделы по id: {parent_id: Document}"""
+        if not parent_ids:
+            return {}
+        placeholders = ", ".join("?" for _ in parent_ids)
+        rows = self._connection().execute(
+            f"SELECT p.parent_id, p.start, p.end, p.page_start, p.page_end, p.sections, p.metadata, d.metadata, "
+            f"substr(d.content, p.start + 1, p.end - p.start) "
+            f"FROM parents p JOIN documents d ON d.doc_id = p.doc_id WHERE p.parent_id IN ({placeholders})",
+            list(parent_ids),
+        ).fetchall()
+        parents = {}
+        for parent_id, start, end, page_start, page_end, sections, extra, metadata, content in rows:
+            metadata = json.loads(metadata)
+            metadata.update(json.loads(extra))
+            metadata.update({
+                "parent_id": parent_id, "start": start, "end": end,
+                "page_start": page_start, "page_end": page_end, "sections": json.loads(sections),
+            })
+            parents[parent_id] = Document(page_content=content, metadata=metadata)
+        return parents
+
+    def expand(self, docs_and_scores):
+        """Заменяет дочерние фрагменты их разделами; порядок - по лучшему дочернему фрагменту.
+
+        Фрагменты без parent_id (старый индекс) возвращаются как есть.
+        """
+        parents = self.get_parents({doc.metadata["parent_id"] for doc, _ in docs_and_scores
+                                    if "parent_id" in doc.metadata})
+        expanded, seen = [], {}
+        for doc, score in docs_and_scores:
+            parent_id = doc.metadata.get("parent_id")
+            parent = parents.get(parent_id)
+            if parent is None:
+                expanded.append((doc, score))
+            elif parent_id in seen:
+                seen[parent_id].metadata["matched_children"] += 1
+            else:
+                parent.metadata["matched_children"] = 1
+                seen[parent_id] = parent
+                expanded.append((parent, score))
+        return expanded
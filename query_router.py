@@ -0,0 +1,68 @@
+"""Автоматический выбор режима (поиск или генерация ТТ) по результатам поиска в обоих индексах.
+
+Вместо проверки ключевых слов ("требования", "ТТ" в тексте вопроса) вопрос ищется
+одновременно в нормативном индексе и в индексе ТТ. Если лучший фрагмент ТТ
+релевантнее лучшего нормативного не меньше чем на margin, вопрос уходит в
+генерацию ТТ, иначе - в поиск. Префикс /tt по-прежнему явно выбирает ТТ.
+
+Поиск для ответа (в нормативном индексе или в коллекции, выбранной в интерфейсе) -
+это тот же поиск, что делает цепочка ответа (qa_chain.retrieve),
+поэтому его результат передается в цепочку и не повторяется; поиск по ТТ - один
+запрос k=1. Оба поиска идут параллельно (FAISS отпускает GIL, а одиночные вопросы
+кодируются одним микропакетом BatchingEmbeddings), так что маршрутизация не
+добавляет к ответу времени сверх одного поиска.
+"""
+import concurrent.futures
+import logging
+import time
+from collections import namedtuple
+
+from retrievers import scored_search
+
+TT_PREFIX = "/tt"
+
+ROUTER_DEFAULTS = {
+    "margin": 0.05,          # насколько фрагмент ТТ должен быть релевантнее нормативного
+    "min_tt_relevance": 0.0,  # ниже этой релевантности ТТ не выбирается
+}
+
+# Поиски маршрутизации: по два на вопрос
+ROUTER_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="route-search")
+
+RouteDecision = namedtuple("RouteDecision", ["mode", "reason", "search_relevance", "tt_relevance", "retrieved"])
+
+
+def _top_tt_relevance(tt_vectorstore, question):
+    vector = tt_vectorstore.embeddings.embed_query(question)
+    docs_and_scores = scored_search(tt_vectorstore, vector, {"search_type": "similarity"}, k=1)
+    return max((score for _, score in docs_and_scores), default=0.0)
+
+
+def route_question(question, qa_chain, tt_vectorstore, **kwargs):
+    """RouteDecision: mode "tt" или "search"; retrieved - найденное для qa_chain (None, если поиска не было)"""
+    params = dict(ROUTER_DEFAULTS)
+    params.update(kwargs)
+    if question.strip().lower().startswith(TT_PREFIX):
+        return RouteDecision("tt", "prefix", None, None, None)
+    if tt_vectorstore is None or tt_vectorstore is qa_chain.vectorstore:
+        # Отдельного индекса ТТ нет - сравнивать не с чем
+        return RouteDecision("search", "no_tt_index", None, None, None)
+
+    started = time.perf_counter()
+    search_future = ROUTER_EXECUTOR.submit(qa_chain.retrieve, question)
+    tt_future = ROUTER_EXECUTOR.submit(_top_tt_relevance, tt_vectorstore, question)
+    retrieved = search_future.result()
+    try:
+        tt_relevance = tt_future.result()
+    except Exception as e:
+        logging.error(f"Auto route TT search error: {e}")
+        tt_relevance = 0.0
+    search_relevance = max((score for _, score in retrieved), default=0.0)
+
+    if tt_relevance >= max(search_relevance + params["margin"], params["min_tt_relevance"]):
+        decision = RouteDecision("tt", "tt_evidence", search_relevance, tt_relevance, None)
+    else:
+        decision = RouteDecision("search", "search_evidence", search_relevance, tt_relevance, retrieved)
+    logging.info(f"Auto route - {decision.mode} - search relevance {search_relevance:.3f} - "
+                 f"TT relevance {tt_relevance:.3f} - {time.perf_counter() - started:.2f}s")
+    return decision
@@ -0,0 +1,557 @@
+"""Процесс поиска: одна теплая копия модели эмбеддингов и индексов на машину.
+
+Поиск и кодирование вопросов в Streamlit идут в потоке скрипта под GIL вместе с
+отрисовкой, а каждый дополнительный процесс Streamlit загружал бы свою копию
+модели и индексов. Процесс поиска держит модель (с микропакетированием
+одновременных запросов) и текущие версии индексов (IndexManager с горячей
+заменой) и обслуживает несколько процессов-клиентов через Unix-сокет
+(на Windows - через TCP на localhost).
+
+Протокол - кадры без текстовых разделителей:
+
+    op (1 байт) | длина заголовка (4 байта) | длина данных (4 байта) | заголовок JSON | данные
+
+Векторы передаются в данных как float32 (форма - в заголовке), тексты
+фрагментов и метаданные - в заголовке. Соединение держится открытым, один
+клиентский поток - одно соединение. Родительские разделы найденных фрагментов
+возвращаются в том же ответе на поиск (with_parents): версия индекса может
+смениться между двумя запросами, а разделы должны быть из той же версии, что
+и фрагменты.
+
+Коллекции реестра (collection_registry.py) процесс поиска загружает при первом
+запросе к ним (CollectionCache с бюджетом памяти) и кодирует их вопросы моделью
+коллекции; клиенты получают прокси через RetrievalClient.open_collection.
+
+Клиентская сторона: RetrievalClient и прокси RemoteEmbeddings,
+RemoteVectorStore (as_retriever, MMR для пачки запросов одним вызовом) и
+RemoteParentStore, которые подставляются в цепочки вместо локальных объектов.
+Адрес процесса поиска задается переменной окружения RETRIEVAL_WORKER:
+
+    python retrieval_worker.py                      # запуск процесса поиска
+    set RETRIEVAL_WORKER=unix:/tmp/rag_retrieval.sock
+    streamlit run app.py                            # клиенты без своей модели
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from parent_store import ParentStore
+from retrievers import (
+    batch_mmr_search_with_score, batch_similarity_search_with_score, load_calibration, relevance_score_fn,
+)
+from sharded_index import has_index, index_size, load_index
+
+RETRIEVAL_WORKER_ENV = "RETRIEVAL_WORKER"
+DEFAULT_ADDRESS = "unix:/tmp/rag_retrieval.sock" if hasattr(socket, "AF_UNIX") else "tcp:127.0.0.1:8765"
+DEFAULT_EMBEDDING_MODEL = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
+
+OP_INFO = 1
+OP_EMBED = 2
+OP_SEARCH = 3
+OP_PARENTS = 4
+OP_STATS = 5
+OP_OK = 0x80
+OP_ERROR = 0xFF
+
+_FRAME = struct.Struct("!BII")
+
+
+class RetrievalWorkerError(RuntimeError):
+    """Ошибка, которую вернул процесс поиска"""
+
+
+def worker_address():
+    """Адрес процесса поиска из RETRIEVAL_WORKER или None (поиск в своем процессе)"""
+    return os.environ.get(RETRIEVAL_WORKER_ENV) or None
+
+
+def parse_address(address):
+    """'unix:/path' -> (AF_UNIX, path); 'tcp:host:port' -> (AF_INET, (host, port))"""
+    scheme, _, rest = address.partition(":")
+    if scheme == "unix":
+        return socket.AF_UNIX, rest
+    if scheme == "tcp":
+        host, _, port = rest.rpartition(":")
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    raise ValueError(f"Неизвестный адрес процесса поиска: {address} (ожидается unix:/путь или tcp:хост:порт)")
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Соединение с процессом поиска закрыто")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_message(sock, op, header=None, payload=b""):
+    header_bytes = json.dumps(header or {}, ensure_ascii=False).encode("utf-8")
+    sock.sendall(_FRAME.pack(op, len(header_bytes), len(payload)) + header_bytes + payload)
+
+
+def recv_message(sock):
+    """(op, заголовок, данные)"""
+    op, header_size, payload_size = _FRAME.unpack(_recv_exact(sock, _FRAME.size))
+    header = json.loads(_recv_exact(sock, header_size)) if header_size else {}
+    payload = _recv_exact(sock, payload_size) if payload_size else b""
+    return op, header, payload
+
+
+def pack_vectors(vectors):
+    array = np.ascontiguousarray(vectors, dtype="<f4")
+    return {"shape": list(array.shape)}, array.tobytes()
+
+
+def unpack_vectors(header, payload):
+    return np.frombuffer(payload, dtype="<f4").reshape(header["shape"])
+
+
+def _pack_documents(docs_and_scores):
+    return [[doc.page_content, doc.metadata, float(score)] for doc, score in docs_and_scores]
+
+
+def _unpack_documents(rows):
+    return [(Document(page_content=content, metadata=metadata), score) for content, metadata, score in rows]
+
+
+# --- Процесс поиска ---
+
+class RetrievalWorker:
+    """Модель эмбеддингов и текущие версии индексов; обработчики операций протокола"""
+
+    def __init__(self, embedding_model=DEFAULT_EMBEDDING_MODEL, poll_interval=None):
+        from collection_registry import CollectionCache
+        from embedding_service import BatchingEmbeddings
+        from embeddings_backend import create_embeddings
+        from index_manager import POLL_INTERVAL, IndexManager
+
+        self.embeddings = BatchingEmbeddings(create_embeddings(embedding_model))
+        self.indexes = IndexManager(self._load, poll_interval=poll_interval or POLL_INTERVAL).start()
+        # Прочие коллекции реестра - по первому запросу, без цепочек
+        self.collections = CollectionCache(self.embeddings, loader=self._collection_index, index_manager=self.indexes)
+        self.started = time.time()
+        self._requests = 0
+        self._lock = threading.Lock()
+        self.handlers = {
+            OP_INFO: self.info,
+            OP_EMBED: self.embed,
+            OP_SEARCH: self.search,
+            OP_PARENTS: self.parents,
+            OP_STATS: self.stats,
+        }
+
+    def _load(self, index_dirs):
+        loaded = {}
+        for name, index_dir in index_dirs.items():
+            if not has_index(index_dir):
+                continue
+            vectorstore, parent_store = load_index(index_dir, self.embeddings)
+            loaded[name] = {
+                "vectorstore": vectorstore,
+                "parent_store": parent_store,
+                "calibration": load_calibration(index_dir, self.embeddings),
+            }
+            print(f"Индекс {name} загружен из {index_dir}")
+        return loaded
+
+    @staticmethod
+    def _collection_index(config, index):
+        return {"vectorstore": index.vectorstore, "parent_store": index.parent_store, "calibration": index.calibration}
+
+    def _index(self, name):
+        loaded = self.indexes.current().resources
+        if name in loaded:
+            return loaded[name]
+        if name in self.collections.registry:
+            return self.collections.get(name)
+        raise KeyError(f"Индекс {name} не загружен")
+
+    def _describe(self, index):
+        vectorstore = index["vectorstore"]
+        return {
+            "calibration": index["calibration"],
+            "has_parents": index["parent_store"] is not None,
+            "distance_strategy": getattr(vectorstore.distance_strategy, "value", vectorstore.distance_strategy),
+            "size": index_size(vectorstore),
+            "embedding_model": getattr(vectorstore.embeddings, "model_name", None),
+        }
+
+    def handle(self, op, header, payload):
+        with self._lock:
+            self._requests += 1
+        handler = self.handlers.get(op)
+        if handler is None:
+            raise ValueError(f"Неизвестная операция {op}")
+        return handler(header, payload)
+
+    def info(self, header, payload):
+        """Индексы снимка или (header["collection"]) одна коллекция реестра, загружаемая при необходимости"""
+        snapshot = self.indexes.current()
+        if header and header.get("collection"):
+            indexes = {header["collection"]: self._index(header["collection"])}
+        else:
+            indexes = snapshot.resources
+        return {
+            "version": snapshot.version,
+            "embedding_model": self.embeddings.model_name,
+            "indexes": {name: self._describe(index) for name, index in indexes.items()},
+        }, b""
+
+    def _embed(self, texts, query=False, index=None):
+        # Вопросы к коллекции со своей моделью кодируются этой моделью
+        embeddings = self._index(index)["vectorstore"].embeddings if index else self.embeddings
+        # Одиночные вопросы разных клиентов объединяются в микропакеты
+        if query and len(texts) == 1:
+            return [embeddings.embed_query(texts[0])]
+        return embeddings.embed_documents(texts)
+
+    def embed(self, header, payload):
+        return pack_vectors(self._embed(header["texts"], header.get("query", False), header.get("index")))
+
+    def search(self, header, payload):
+        index = self._index(header["index"])
+        vectorstore = index["vectorstore"]
+        if "texts" in header:
+            vectors = np.asarray(self._embed(header["texts"], True, header["index"]), dtype=np.float32)
+        else:
+            vectors = unpack_vectors(header, payload)
+        k = header.get("k", 4)
+        metadata_filter = header.get("metadata_filter")
+        top_documents = header.get("top_documents")
+        if header.get("search_type", "mmr") == "mmr":
+            results = batch_mmr_search_with_score(vectorstore, vectors, k=k,
+                                                  fetch_k=max(header.get("fetch_k", 20), k),
+                                                  lambda_mult=header.get("lambda_mult", 0.5),
+                                                  metadata_filter=metadata_filter, top_documents=top_documents)
+        else:
+            results = batch_similarity_search_with_score(vectorstore, vectors, k, metadata_filter, top_documents)
+        response = {"results": [_pack_documents(docs_and_scores) for docs_and_scores in results]}
+        if header.get("with_parents") and index["parent_store"] is not None:
+            # Разделы из того же снимка, что и фрагменты
+            parent_ids = {doc.metadata["parent_id"] for docs_and_scores in results for doc, _ in docs_and_scores
+                          if "parent_id" in doc.metadata}
+            parents = index["parent_store"].get_parents(parent_ids)
+            response["parents"] = [[parent_id, doc.page_content, doc.metadata] for parent_id, doc in parents.items()]
+        return response, b""
+
+    def parents(self, header, payload):
+        parent_store = self._index(header["index"])["parent_store"]
+        parents = parent_store.get_parents(header["ids"]) if parent_store else {}
+        return {"parents": [[parent_id, doc.page_content, doc.metadata] for parent_id, doc in parents.items()]}, b""
+
+    def stats(self, header, payload):
+        return {
+            "uptime_s": round(time.time() - self.started, 1),
+            "requests": self._requests,
+            "version": self.indexes.current().version,
+            "embedding_batching": self.embeddings.stats(),
+            "collections": self.collections.stats(),
+        }, b""
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        worker = self.server.worker
+        while True:
+            try:
+                op, header, payload = recv_message(self.request)
+            except (ConnectionError, OSError):
+                return
+            try:
+                response_header, response_payload = worker.handle(op, header, payload)
+                send_message(self.request, OP_OK, response_header, response_payload)
+            except Exception as e:
+                logging.error(f"Retrieval worker error (op {op}): {e}")
+                try:
+                    send_message(self.request, OP_ERROR, {"error": str(e)})
+                except OSError:
+                    return
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+    class _ThreadingUnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+
+def serve(address=DEFAULT_ADDRESS, embedding_model=DEFAULT_EMBEDDING_MODEL, poll_interval=None):
+    """Запускает процесс поиска (блокирует поток)"""
+    family, target = parse_address(address)
+    worker = RetrievalWorker(embedding_model, poll_interval=poll_interval)
+    # Индексы загружаются до приема соединений, чтобы первый запрос не ждал
+    worker.indexes.current()
+    if family == socket.AF_INET:
+        server = _ThreadingTCPServer(target, _RequestHandler)
+    else:
+        if os.path.exists(target):
+            os.remove(target)
+        server = _ThreadingUnixServer(target, _RequestHandler)
+    server.worker = worker
+    print(f"Процесс поиска слушает {address}")
+    logging.info(f"Retrieval worker started - {address} - {worker.indexes.current().version}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if family == socket.AF_UNIX and os.path.exists(target):
+            os.remove(target)
+
+
+# --- Клиент ---
+
+class RetrievalClient:
+    """Тонкий клиент процесса поиска; соединение на поток, переподключение при обрыве"""
+
+    def __init__(self, address=None, timeout=60):
+        self.address = address or worker_address() or DEFAULT_ADDRESS
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        family, target = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(target)
+        if family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._local.sock = sock
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+        self._local.sock = None
+
+    def call(self, op, header=None, payload=b""):
+        """Отправляет запрос и возвращает (заголовок, данные) ответа"""
+        for attempt in range(2):
+            sock = getattr(self._local, "sock", None)
+            reused = sock is not None
+            try:
+                sock = sock or self._connect()
+                send_message(sock, op, header, payload)
+                response_op, response_header, response_payload = recv_message(sock)
+                break
+            except (ConnectionError, OSError):
+                self._close()
+                # Повтор только для соединения, которое мог закрыть перезапущенный процесс поиска
+                if not reused or attempt:
+                    raise
+        if response_op == OP_ERROR:
+            raise RetrievalWorkerError(response_header.get("error", "ошибка процесса поиска"))
+        return response_header, response_payload
+
+    def info(self):
+        return self.call(OP_INFO)[0]
+
+    def stats(self):
+        return self.call(OP_STATS)[0]
+
+    def embed(self, texts, query=False, index=None):
+        header = {"texts": list(texts), "query": query}
+        if index is not None:
+            header["index"] = index
+        return unpack_vectors(*self.call(OP_EMBED, header))
+
+    def search(self, index, vectors=None, texts=None, **params):
+        """[[(Document, score FAISS), ...], ...] для пачки векторов или текстов"""
+        header = {"index": index}
+        header.update(params)
+        payload = b""
+        if texts is not None:
+            header["texts"] = list(texts)
+        else:
+            shape, payload = pack_vectors(vectors)
+            header.update(shape)
+        response = self.call(OP_SEARCH, header, payload)[0]
+        if "parents" in response:
+            parents = getattr(self._local, "parents", None)
+            if parents is None:
+                parents = self._local.parents = {}
+            parents[index] = {parent_id: (content, metadata) for parent_id, content, metadata in response["parents"]}
+        return [_unpack_documents(rows) for rows in response["results"]]
+
+    def search_parents(self, index):
+        """Разделы, полученные с последним поиском этого потока по индексу: {parent_id: (текст, метаданные)}"""
+        return (getattr(self._local, "parents", None) or {}).get(index, {})
+
+    def parents(self, index, parent_ids):
+        rows = self.call(OP_PARENTS, {"index": index, "ids": list(parent_ids)})[0]["parents"]
+        return {parent_id: Document(page_content=content, metadata=metadata) for parent_id, content, metadata in rows}
+
+    def _open(self, name, index, embeddings):
+        return (
+            RemoteVectorStore(self, name, embeddings, index["distance_strategy"], index["has_parents"]),
+            RemoteParentStore(self, name) if index["has_parents"] else None,
+            index["calibration"],
+        )
+
+    def open_indexes(self):
+        """{имя индекса: (хранилище, хранилище разделов, калибровка)} с прокси процесса поиска"""
+        info = self.info()
+        embeddings = RemoteEmbeddings(self, info["embedding_model"])
+        return {name: self._open(name, index, embeddings) for name, index in info["indexes"].items()}
+
+    def open_collection(self, name):
+        """(хранилище, хранилище разделов, калибровка) коллекции реестра; индекс загружает процесс поиска"""
+        index = self.call(OP_INFO, {"collection": name})[0]["indexes"][name]
+        # Вопросы кодируются моделью коллекции в процессе поиска
+        return self._open(name, index, RemoteEmbeddings(self, index["embedding_model"], name))
+
+
+def create_query_embeddings(model_name=DEFAULT_EMBEDDING_MODEL):
+    """Эмбеддинги вопросов процесса: через процесс поиска (RETRIEVAL_WORKER) или своя модель с микропакетами"""
+    if worker_address():
+        client = RetrievalClient()
+        return RemoteEmbeddings(client, client.info()["embedding_model"])
+    from embedding_service import BatchingEmbeddings
+    from embeddings_backend import create_embeddings
+    return BatchingEmbeddings(create_embeddings(model_name))
+
+
+class RemoteEmbeddings(Embeddings):
+    """Эмбеддинги, которые считает процесс поиска"""
+
+    def __init__(self, client, model_name=None, index=None):
+        self.client = client
+        self.model_name = model_name
+        # Индекс, моделью которого кодируются тексты (None - модель процесса поиска)
+        self.index = index
+
+    def embed_query(self, text):
+        return self.client.embed([text], query=True, index=self.index)[0].tolist()
+
+    def embed_documents(self, texts):
+        return self.client.embed(texts, index=self.index).tolist()
+
+    def stats(self):
+        """Статистика микропакетов кодирования в процессе поиска"""
+        return self.client.stats()["embedding_batching"]
+
+
+class RemoteVectorStore(VectorStore):
+    """Индекс процесса поиска с интерфейсом хранилища LangChain (только чтение)"""
+
+    def __init__(self, client, index, embeddings, distance_strategy="EUCLIDEAN_DISTANCE", with_parents=False):
+        self.client = client
+        self.index_name = index
+        self._embeddings = embeddings
+        self.distance_strategy = distance_strategy
+        # Запрашивать разделы найденных фрагментов в том же ответе (для RemoteParentStore)
+        self.with_parents = with_parents
+
+    @property
+    def embeddings(self):
+        return self._embeddings
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError("Индекс процесса поиска доступен только для чтения")
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError("Индекс процесса поиска строится main.py или index_manager.py")
+
+    def _select_relevance_score_fn(self):
+        return relevance_score_fn(self.distance_strategy)
+
+    def batch_mmr_search_with_score(self, vectors, k=4, fetch_k=20, lambda_mult=0.5, metadata_filter=None,
+                                    top_documents=None):
+        """MMR для пачки векторов одним запросом к процессу поиска"""
+        if len(vectors) == 0:
+            return []
+        return self.client.search(self.index_name, vectors, search_type="mmr", k=k,
+                                  fetch_k=fetch_k, lambda_mult=lambda_mult, metadata_filter=metadata_filter,
+                                  top_documents=top_documents, with_parents=self.with_parents)
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, metadata_filter=None, top_documents=None,
+                                               **kwargs):
+        return self.client.search(self.index_name, [embedding], search_type="similarity", k=k,
+                                  metadata_filter=metadata_filter, top_documents=top_documents,
+                                  with_parents=self.with_parents)[0]
+
+    def max_marginal_relevance_search_with_score_by_vector(self, embedding, k=4, fetch_k=20, lambda_mult=0.5, **kwargs):
+        return self.batch_mmr_search_with_score([embedding], k=k, fetch_k=fetch_k, lambda_mult=lambda_mult)[0]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.client.search(self.index_name, texts=[query], search_type="similarity", k=k)[0]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k)]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k=k)]
+
+    def _similarity_search_with_relevance_scores(self, query, k=4, **kwargs):
+        relevance_fn = self._select_relevance_score_fn()
+        return [(doc, relevance_fn(score)) for doc, score in self.similarity_search_with_score(query, k=k)]
+
+    def max_marginal_relevance_search(self, query, k=4, fetch_k=20, lambda_mult=0.5, **kwargs):
+        results = self.client.search(self.index_name, texts=[query], search_type="mmr", k=k,
+                                     fetch_k=fetch_k, lambda_mult=lambda_mult)[0]
+        return [doc for doc, _ in results]
+
+    def max_marginal_relevance_search_by_vector(self, embedding, k=4, fetch_k=20, lambda_mult=0.5, **kwargs):
+        results = self.max_marginal_relevance_search_with_score_by_vector(
+            embedding, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult)
+        return [doc for doc, _ in results]
+
+
+class RemoteParentStore(ParentStore):
+    """Родительские разделы из хранилища процесса поиска (расширение - как у ParentStore).
+
+    Разделы берутся из ответа на последний поиск потока - той же версии индекса,
+    что и найденные фрагменты; отдельный запрос OP_PARENTS - только для прочих id.
+    """
+
+    def __init__(self, client, index):
+        self.client = client
+        self.index_name = index
+
+    def get_parents(self, parent_ids):
+        if not parent_ids:
+            return {}
+        found = self.client.search_parents(self.index_name)
+        if all(parent_id in found for parent_id in parent_ids):
+            # Новые объекты: expand() меняет метаданные раздела (matched_children)
+            return {parent_id: Document(page_content=found[parent_id][0], metadata=dict(found[parent_id][1]))
+                    for parent_id in parent_ids}
+        return self.client.parents(self.index_name, parent_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Процесс поиска: общая модель эмбеддингов и индексы для клиентов")
+    parser.add_argument("--address", default=worker_address() or DEFAULT_ADDRESS,
+                        help=f"unix:/путь или tcp:хост:порт (по умолчанию {DEFAULT_ADDRESS})")
+    parser.add_argument("--embedding-model", default=DEFAULT_EMBEDDING_MODEL)
+    parser.add_argument("--poll-interval", type=float, default=None,
+                        help="период проверки документов и версий индексов, с")
+    args = parser.parse_args()
+    logging.basicConfig(filename='activity.log', level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    serve(args.address, args.embedding_model, args.poll_interval)
+
+
+if __name__ == "__main__":
+    main()
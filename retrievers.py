@@ -0,0 +1,556 @@
+"""Ретривер с динамическим k: отсечение слабых фрагментов по откалиброванному порогу.
+
+Вместо фиксированного k (6, 8 или 10) фрагменты сохраняются, пока их релевантность
+не ниже порога корпуса или отставание от лучшего фрагмента не больше допустимого,
+в пределах min_k..k. Порог и допустимое отставание подбираются при построении
+индекса по небольшому размеченному набору вопросов (JSONL):
+
+    {"question": "...", "relevant": ["ГОСТ 7746-2015", "коэффициент безопасности"]}
+
+Фрагмент считается релевантным, если любая строка из relevant встречается в имени
+файла, разделах или тексте фрагмента. Выбирается пара параметров с наименьшим
+средним k при полноте не ниже заданной доли полноты фиксированного k.
+Результат сохраняется в calibration.json в папке индекса.
+
+Здесь же векторизованный MMR: вместо цикла LangChain на Python для каждого
+запроса кандидаты fetch_k всей пачки запросов берутся из FAISS одним поиском,
+их векторы восстанавливаются из индекса, и жадный отбор MMR идет матричными
+операциями NumPy сразу по всем запросам.
+
+Фильтр по метаданным (metadata_filter в настройках, например у коллекции из
+collection_registry.py) не отсеивает найденное после поиска: подходящие номера
+векторов передаются в FAISS через IDSelector, и k ближайших ищутся только среди них.
+Так же (IDSelectorRange по фрагментам выбранных документов) работает двухуровневый
+поиск: см. document_index.py и top_documents в настройках или в калибровке индекса.
+"""
+import os
+import json
+import logging
+import re
+from datetime import datetime
+from typing import Any, List
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from document_index import TOP_DOCUMENTS, TOP_DOCUMENTS_GRID, search_chunks
+
+CALIBRATION_FILE = "calibration.json"
+DEFAULT_CALIBRATION_QUESTIONS = "calibration_questions.jsonl"
+
+# Нижняя граница k и целевая полнота калибровки; поиск - с настройками калибруемого режима
+DYNAMIC_K_DEFAULTS = {
+    "min_k": 2,
+    "target_recall": 1.0,   # доля от полноты фиксированного k, которую нельзя потерять
+    "grid_size": 20,
+    "top_documents_recall": 1.0,  # доля от полноты плоского поиска для двухуровневого
+}
+CALIBRATION_MODE = "rag"  # режим, в котором калибровка применяется (цепочка ответов qa_chain)
+
+# Обозначение документа в тексте: ГОСТ 7746-2015, ГОСТ Р 52565-2006, СП 76.13330
+DESIGNATION = re.compile(r"\b(?:гост|ост|сп|снип|ту|iec|мэк)(?:\s*р)?\s*[\d.\-–]+", re.IGNORECASE)
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def mmr_select(query_vectors, candidate_vectors, valid, k, lambda_mult=0.5):
+    """Жадный MMR сразу для пачки запросов.
+
+    query_vectors (n, d), candidate_vectors (n, f, d), valid (n, f) - маска реальных кандидатов.
+    Возвращает (n, k) номеров кандидатов в порядке отбора, -1 там, где кандидатов не хватило.
+    Отбор совпадает с langchain maximal_marginal_relevance (косинусная близость).
+    """
+    queries = _normalize(np.asarray(query_vectors, dtype=np.float32))
+    candidates = _normalize(np.asarray(candidate_vectors, dtype=np.float32))
+    n, f = valid.shape
+    similarity_to_query = np.einsum("nfd,nd->nf", candidates, queries)
+    pairwise = np.matmul(candidates, candidates.transpose(0, 2, 1))
+
+    rows = np.arange(n)
+    available = valid.copy()
+    redundancy = np.full((n, f), -np.inf, dtype=np.float32)
+    selected = np.full((n, k), -1, dtype=np.int64)
+    for step in range(min(k, f)):
+        if step == 0:
+            scores = similarity_to_query.copy()
+        else:
+            scores = lambda_mult * similarity_to_query - (1 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+        picked = np.argmax(scores, axis=1)
+        has_candidate = available[rows, picked]
+        selected[has_candidate, step] = picked[has_candidate]
+        available[rows[has_candidate], picked[has_candidate]] = False
+        redundancy = np.maximum(redundancy, pairwise[rows, picked])
+    return selected
+
+
+def _reconstruct(index, ids):
+    try:
+        return index.reconstruct_batch(ids)
+    except Exception:
+        # Не все типы индексов FAISS поддерживают пакетное восстановление
+        return np.stack([index.reconstruct(int(i)) for i in ids])
+
+
+def relevance_score_fn(distance_strategy):
+    """Перевод оценки FAISS в релевантность 0..1 по метрике индекса (как у FAISS в LangChain)"""
+    from langchain_core.vectorstores import VectorStore
+
+    strategy = getattr(distance_strategy, "value", distance_strategy)
+    if strategy == "MAX_INNER_PRODUCT":
+        return VectorStore._max_inner_product_relevance_score_fn
+    if strategy == "COSINE":
+        return VectorStore._cosine_relevance_score_fn
+    return VectorStore._euclidean_relevance_score_fn
+
+
+def metadata_matches(metadata, metadata_filter):
+    """Подходят ли метаданные под фильтр {ключ: значение или список допустимых значений}"""
+    for key, allowed in metadata_filter.items():
+        allowed = allowed if isinstance(allowed, (list, tuple, set)) else [allowed]
+        value = metadata.get(key)
+        # Для списков (sections) достаточно одного совпадения
+        values = value if isinstance(value, list) else [value]
+        if not any(item in allowed for item in values):
+            return False
+    return True
+
+
+def _designation_key(text):
+    return re.sub(r"[\s_]+", "", text.lower().replace("ё", "е")).replace("–", "-").rstrip(".-")
+
+
+def designations(text):
+    """Обозначения документов из текста вопроса (для designation_matches)"""
+    return [_designation_key(match.group(0)) for match in DESIGNATION.finditer(text)]
+
+
+def designation_matches(metadata, wanted):
+    """Назван ли документ фрагмента (metadata["filename"]) одним из обозначений wanted.
+
+    "ГОСТ 1983" подходит к "ГОСТ 1983-2001.pdf", но не к "ГОСТ 19830-...";
+    регистр, пробелы и подчеркивания в имени файла не важны.
+    """
+    filename = _designation_key(str(metadata.get("filename", "")))
+    return any(re.search(re.escape(key) + r"(?!\d)", filename) for key in wanted)
+
+
+def filter_selector(vectorstore, metadata_filter):
+    """(номера векторов, IDSelector FAISS) для фильтра; считаются один раз на хранилище и фильтр"""
+    import faiss
+
+    key = json.dumps(metadata_filter, sort_keys=True, ensure_ascii=False)
+    cache = vectorstore.__dict__.setdefault("_filter_selectors", {})
+    if key not in cache:
+        ids = np.array(sorted(
+            i for i, _id in vectorstore.index_to_docstore_id.items()
+            if metadata_matches(vectorstore.docstore.search(_id).metadata, metadata_filter)
+        ), dtype=np.int64)
+        cache[key] = (ids, faiss.IDSelectorBatch(ids) if len(ids) else None)
+    return cache[key]
+
+
+def faiss_search(vectorstore, queries, k, metadata_filter=None, top_documents=None):
+    """index.search FAISS; с фильтром ищет только среди подходящих векторов, а не отсеивает найденные.
+
+    С top_documents и индексом документов (vectorstore.document_index) каждый запрос
+    ищет только среди фрагментов top_documents документов с ближайшими центроидами.
+    """
+    import faiss
+
+    filter_ids, selector = None, None
+    if metadata_filter:
+        filter_ids, selector = filter_selector(vectorstore, metadata_filter)
+        if selector is None:
+            return np.zeros((len(queries), k), dtype=np.float32), np.full((len(queries), k), -1, dtype=np.int64)
+    document_index = getattr(vectorstore, "document_index", None)
+    if not top_documents or document_index is None or document_index.size <= top_documents:
+        if selector is None:
+            return vectorstore.index.search(queries, k)
+        return vectorstore.index.search(queries, k, params=faiss.SearchParameters(sel=selector))
+
+    allowed = document_index.documents_of(filter_ids) if filter_ids is not None else None
+    scores = np.zeros((len(queries), k), dtype=np.float32)
+    indices = np.full((len(queries), k), -1, dtype=np.int64)
+    for row, documents in enumerate(document_index.top_documents(queries, top_documents, allowed)):
+        ids = document_index.chunk_ids(documents)
+        if filter_ids is not None:
+            ids = np.intersect1d(ids, filter_ids, assume_unique=True)
+        scores[row], indices[row] = search_chunks(vectorstore.index, queries[row:row + 1], k, ids)
+    return scores, indices
+
+
+def batch_similarity_search_with_score(vectorstore, vectors, k=4, metadata_filter=None, top_documents=None):
+    """Поиск ближайших для пачки векторов: [[(doc, score FAISS), ...], ...]"""
+    if not hasattr(vectorstore, "index"):
+        # Шардированное хранилище или индекс в процессе поиска фильтруют у себя
+        options = {key: value for key, value in (("metadata_filter", metadata_filter),
+                                                 ("top_documents", top_documents)) if value}
+        return [vectorstore.similarity_search_with_score_by_vector(vector, k=k, **options) for vector in vectors]
+    queries = np.asarray(vectors, dtype=np.float32)
+    if len(queries) == 0:
+        return []
+    scores, indices = faiss_search(vectorstore, queries, k, metadata_filter, top_documents)
+    return [
+        [(vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]), score)
+         for score, i in zip(row_scores, row_indices) if i != -1]
+        for row_scores, row_indices in zip(scores, indices)
+    ]
+
+
+def batch_mmr_search_with_score(vectorstore, vectors, k=4, fetch_k=20, lambda_mult=0.5, metadata_filter=None,
+                                top_documents=None):
+    """MMR для пачки векторов запросов: [[(doc, score FAISS), ...], ...] как у LangChain"""
+    if hasattr(vectorstore, "batch_mmr_search_with_score"):
+        # Хранилище со своим пакетным MMR (шардированный индекс, индекс в процессе поиска)
+        return vectorstore.batch_mmr_search_with_score(vectors, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult,
+                                                       metadata_filter=metadata_filter, top_documents=top_documents)
+    if not hasattr(vectorstore, "index"):
+        return [
+            vectorstore.max_marginal_relevance_search_with_score_by_vector(
+                vector, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult)
+            for vector in vectors
+        ]
+    queries = np.asarray(vectors, dtype=np.float32)
+    if len(queries) == 0:
+        return []
+    scores, indices = faiss_search(vectorstore, queries, fetch_k, metadata_filter, top_documents)
+    valid = indices != -1
+    unique_ids = np.unique(indices[valid])
+    candidate_vectors = np.zeros(indices.shape + (queries.shape[1],), dtype=np.float32)
+    if len(unique_ids):
+        reconstructed = _reconstruct(vectorstore.index, unique_ids.astype(np.int64))
+        candidate_vectors[valid] = reconstructed[np.searchsorted(unique_ids, indices[valid])]
+
+    selected = mmr_select(queries, candidate_vectors, valid, k, lambda_mult)
+    results = []
+    for row, picks in enumerate(selected):
+        docs_and_scores = []
+        for i in picks[picks != -1]:
+            _id = vectorstore.index_to_docstore_id[indices[row, i]]
+            doc = vectorstore.docstore.search(_id)
+            if not isinstance(doc, Document):
+                raise ValueError(f"Could not find document for id {_id}, got {doc}")
+            docs_and_scores.append((doc, scores[row, i]))
+        results.append(docs_and_scores)
+    return results
+
+
+def expand_parents(docs_and_scores, settings):
+    """Дочерние фрагменты -> родительские разделы, если передано хранилище разделов (parent_store=...)"""
+    parent_store = settings.get("parent_store")
+    return parent_store.expand(docs_and_scores) if parent_store else docs_and_scores
+
+
+def select_context(docs_and_scores, settings, k=None):
+    """Отсечение по калибровке (если есть) и расширение до родительских разделов"""
+    k = k or settings["k"]
+    return expand_parents(apply_cutoff(docs_and_scores, settings.get("calibration"), max_k=k), settings)
+
+
+def _top_documents(settings):
+    """Документов на запрос в двухуровневом поиске: настройка режима или калибровка индекса"""
+    if "top_documents" in settings:
+        return settings["top_documents"]
+    return (settings.get("calibration") or {}).get("top_documents", TOP_DOCUMENTS)
+
+
+def batch_scored_search(vectorstore, vectors, settings, k=None):
+    """Документы с релевантностью (0..1) для пачки векторов по настройкам режима (MMR - векторизованный)"""
+    k = k or settings["k"]
+    if settings.get("search_type", "mmr") == "mmr":
+        results = batch_mmr_search_with_score(
+            vectorstore, vectors, k=k,
+            fetch_k=max(settings.get("fetch_k", 20), k),
+            lambda_mult=settings.get("lambda_mult", 0.5),
+            metadata_filter=settings.get("metadata_filter"),
+            top_documents=_top_documents(settings),
+        )
+    else:
+        results = batch_similarity_search_with_score(vectorstore, vectors, k, settings.get("metadata_filter"),
+                                                     _top_documents(settings))
+    relevance_fn = relevance_score_fn(vectorstore.distance_strategy)
+    return [
+        expand_parents([(doc, float(relevance_fn(score))) for doc, score in docs_and_scores], settings)
+        for docs_and_scores in results
+    ]
+
+
+def batch_search(vectorstore, vectors, settings, k=None):
+    """Документы для пачки векторов по настройкам режима (MMR - векторизованный)"""
+    return [[doc for doc, _ in docs_and_scores] for docs_and_scores in batch_scored_search(vectorstore, vectors,
+                                                                                           settings, k)]
+
+
+def scored_search(vectorstore, vector, settings, k):
+    """Поиск по вектору с релевантностью (0..1, больше - лучше) в порядке выдачи"""
+    if settings.get("search_type", "mmr") == "mmr":
+        docs_and_scores = batch_mmr_search_with_score(
+            vectorstore,
+            [vector],
+            k=k,
+            fetch_k=max(settings.get("fetch_k", 20), k),
+            lambda_mult=settings.get("lambda_mult", 0.5),
+            metadata_filter=settings.get("metadata_filter"),
+            top_documents=_top_documents(settings),
+        )[0]
+    else:
+        docs_and_scores = batch_similarity_search_with_score(vectorstore, [vector], k,
+                                                             settings.get("metadata_filter"),
+                                                             _top_documents(settings))[0]
+    relevance_fn = relevance_score_fn(vectorstore.distance_strategy)
+    return [(doc, float(relevance_fn(score))) for doc, score in docs_and_scores]
+
+
+def _keep_mask(scores, threshold, max_gap):
+    top = max(scores, default=0.0)
+    return [
+        (threshold is not None and score >= threshold) or (max_gap is not None and top - score <= max_gap)
+        for score in scores
+    ]
+
+
+def apply_cutoff(docs_and_scores, calibration, max_k=None, min_k=None):
+    """Оставляет фрагменты выше порога или в пределах отставания от лучшего (min_k..max_k)"""
+    if max_k is not None:
+        docs_and_scores = docs_and_scores[:max_k]
+    if not calibration:
+        return docs_and_scores
+    if min_k is None:
+        min_k = calibration.get("min_k", 1)
+    mask = _keep_mask([score for _, score in docs_and_scores],
+                      calibration.get("threshold"), calibration.get("max_gap"))
+    if sum(mask) < min_k:
+        # Добираем до минимума самыми релевантными из отброшенных, сохраняя порядок выдачи
+        dropped = sorted((i for i, keep in enumerate(mask) if not keep),
+                         key=lambda i: docs_and_scores[i][1], reverse=True)
+        for i in dropped[:min_k - sum(mask)]:
+            mask[i] = True
+    return [item for item, keep in zip(docs_and_scores, mask) if keep]
+
+
+class MMRRetriever(BaseRetriever):
+    """Ретривер LangChain с векторизованным MMR; пачка запросов - одним поиском"""
+
+    vectorstore: Any
+    settings: dict
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        vector = self.vectorstore.embeddings.embed_query(query)
+        return batch_search(self.vectorstore, [vector], self.settings)[0]
+
+    def retrieve_batch(self, queries):
+        vectors = self.vectorstore.embeddings.embed_documents(list(queries))
+        return batch_search(self.vectorstore, vectors, self.settings)
+
+
+class DynamicKRetriever(BaseRetriever):
+    """Ретривер LangChain с отсечением по откалиброванному порогу"""
+
+    vectorstore: Any
+    settings: dict
+    calibration: dict
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        vector = self.vectorstore.embeddings.embed_query(query)
+        return [doc for doc, _ in self.retrieve_with_scores(vector)]
+
+    def retrieve_with_scores(self, vector):
+        max_k = self.settings["k"]
+        docs_and_scores = scored_search(self.vectorstore, vector, self.settings, max_k)
+        kept = apply_cutoff(docs_and_scores, self.calibration, max_k=max_k)
+        logging.debug(f"Dynamic k: {len(kept)} of {len(docs_and_scores)}")
+        return expand_parents(kept, self.settings)
+
+
+def read_labelled_questions(path):
+    """Читает размеченные вопросы для калибровки"""
+    labelled = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Пропущена строка {line_no}: некорректный JSON ({e})")
+                continue
+            relevant = record.get("relevant") or []
+            if isinstance(relevant, str):
+                relevant = [relevant]
+            if not record.get("question") or not relevant:
+                print(f"Пропущена строка {line_no}: нужны поля 'question' и 'relevant'")
+                continue
+            labelled.append({"question": record["question"], "relevant": [r.lower() for r in relevant]})
+    return labelled
+
+
+def is_relevant(doc, relevant):
+    """Совпадает ли фрагмент с разметкой: имя файла, разделы или текст"""
+    haystack = " ".join([
+        str(doc.metadata.get("filename", "")),
+        " ".join(doc.metadata.get("sections", [])),
+        doc.page_content,
+    ]).lower()
+    return any(marker in haystack for marker in relevant)
+
+
+def _quantiles(values, count):
+    values = sorted(set(values))
+    if len(values) <= count:
+        return values
+    return [values[round(i * (len(values) - 1) / (count - 1))] for i in range(count)]
+
+
+def _top_documents_candidates(vectorstore):
+    """Значения top_documents, при которых поиск действительно двухуровневый"""
+    document_index = getattr(vectorstore, "document_index", None)
+    if document_index is not None:
+        return [n for n in TOP_DOCUMENTS_GRID if n < document_index.size]
+    # У шардированного индекса центроиды документов - в процессах частей
+    return list(TOP_DOCUMENTS_GRID) if hasattr(vectorstore, "shards") else []
+
+
+def _calibration_runs(vectorstore, labelled, vectors, settings, k):
+    runs = []
+    for item, vector in zip(labelled, vectors):
+        docs_and_scores = scored_search(vectorstore, vector, settings, k)
+        runs.append((
+            [score for _, score in docs_and_scores],
+            [is_relevant(doc, item["relevant"]) for doc, _ in docs_and_scores],
+        ))
+    return runs
+
+
+def calibrate(vectorstore, labelled, settings, **kwargs):
+    """Подбирает порог и допустимое отставание по размеченным вопросам.
+
+    settings - настройки поиска режима, в котором калибровка применяется (k, fetch_k,
+    lambda_mult, ...): порог описывает тот же набор кандидатов, что и при ответе.
+    Если у индекса есть центроиды документов и режим не задает top_documents, сначала
+    выбирается наименьшее top_documents, с которым двухуровневый поиск находит не
+    меньше top_documents_recall размеченных фрагментов плоского поиска (иначе поиск
+    остается плоским), и порог подбирается уже для него.
+    """
+    params = dict(DYNAMIC_K_DEFAULTS)
+    params.update(kwargs)
+    max_k, min_k = settings["k"], params["min_k"]
+
+    vectors = vectorstore.embeddings.embed_documents([item["question"] for item in labelled])
+    runs = _calibration_runs(vectorstore, labelled, vectors, settings, max_k)
+
+    baseline_hits = sum(sum(flags) for _, flags in runs)
+    baseline_k = sum(len(scores) for scores, _ in runs) / max(len(runs), 1)
+    if baseline_hits == 0:
+        print("Калибровка невозможна: ни один размеченный фрагмент не найден при фиксированном k")
+        return None
+
+    chosen_top_documents, coarse_recall = None, None
+    if "top_documents" not in settings:
+        for candidate in _top_documents_candidates(vectorstore):
+            coarse_runs = _calibration_runs(vectorstore, labelled, vectors,
+                                            dict(settings, top_documents=candidate), max_k)
+            recall = sum(sum(flags) for _, flags in coarse_runs) / baseline_hits
+            if recall + 1e-9 >= params["top_documents_recall"]:
+                chosen_top_documents, coarse_recall, runs = candidate, recall, coarse_runs
+                baseline_hits = sum(sum(flags) for _, flags in runs)
+                break
+
+    def evaluate(threshold, max_gap):
+        hits, total_k = 0, 0
+        for scores, flags in runs:
+            kept = apply_cutoff(list(zip(flags, scores)), {"threshold": threshold, "max_gap": max_gap},
+                                max_k=max_k, min_k=min_k)
+            hits += sum(flag for flag, _ in kept)
+            total_k += len(kept)
+        return hits / baseline_hits, total_k / len(runs)
+
+    all_scores = [score for scores, _ in runs for score in scores]
+    all_gaps = [max(scores) - score for scores, _ in runs if scores for score in scores]
+    thresholds = [None] + _quantiles(all_scores, params["grid_size"])
+    gaps = [None] + _quantiles(all_gaps, params["grid_size"])
+
+    best = None
+    for threshold in thresholds:
+        for max_gap in gaps:
+            if threshold is None and max_gap is None:
+                continue
+            recall, avg_k = evaluate(threshold, max_gap)
+            if recall + 1e-9 < params["target_recall"]:
+                continue
+            if best is None or avg_k < best["avg_k"]:
+                best = {"threshold": threshold, "max_gap": max_gap, "recall": recall, "avg_k": avg_k}
+
+    return {
+        "threshold": best["threshold"],
+        "max_gap": best["max_gap"],
+        "min_k": min_k,
+        "relative_recall": round(best["recall"], 4),
+        "avg_k": round(best["avg_k"], 2),
+        "baseline_k": round(baseline_k, 2),
+        "top_documents": chosen_top_documents,
+        "top_documents_recall": None if coarse_recall is None else round(coarse_recall, 4),
+        "questions": len(runs),
+        "search": {"search_type": settings.get("search_type", "mmr"), "k": max_k,
+                   "fetch_k": max(settings.get("fetch_k", 20), max_k), "lambda_mult": settings.get("lambda_mult", 0.5)},
+        "embedding_model": getattr(vectorstore.embeddings, "model_name", None),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def save_calibration(index_dir, calibration):
+    path = os.path.join(index_dir, CALIBRATION_FILE)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(calibration, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def load_calibration(index_dir, embeddings=None):
+    """Загружает калибровку индекса; None, если ее нет или она для другой модели эмбеддингов"""
+    path = os.path.join(index_dir, CALIBRATION_FILE)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            calibration = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logging.error(f"Calibration load error ({path}): {e}")
+        return None
+    model_name = getattr(embeddings, "model_name", None)
+    if model_name and calibration.get("embedding_model") and calibration["embedding_model"] != model_name:
+        logging.warning(f"Calibration in {path} was made for {calibration['embedding_model']}, ignored for {model_name}")
+        return None
+    return calibration
+
+
+def calibrate_index(index_dir, vectorstore, questions_path=DEFAULT_CALIBRATION_QUESTIONS, mode=CALIBRATION_MODE,
+                    **kwargs):
+    """Калибрует индекс по набору вопросов с настройками поиска режима mode и сохраняет результат"""
+    from chain_factory import get_mode_settings
+
+    if not os.path.exists(questions_path):
+        print(f"Набор вопросов для калибровки {questions_path} не найден, используется фиксированный k")
+        return None
+    labelled = read_labelled_questions(questions_path)
+    if not labelled:
+        print("Нет размеченных вопросов для калибровки")
+        return None
+    settings, _, _ = get_mode_settings(mode)
+    calibration = calibrate(vectorstore, labelled, settings, **kwargs)
+    if calibration is None:
+        return None
+    calibration["mode"] = mode
+    path = save_calibration(index_dir, calibration)
+    describe = lambda value: "не используется" if value is None else f"{value:.3f}"
+    print(f"Калибровка сохранена в {path}: порог {describe(calibration['threshold'])}, "
+          f"отставание {describe(calibration['max_gap'])}, "
+          f"среднее k {calibration['avg_k']} вместо {calibration['baseline_k']}, "
+          f"полнота {calibration['relative_recall']:.0%} от фиксированного k, "
+          f"документов на запрос: {calibration['top_documents'] or 'все (плоский поиск)'}")
+    logging.info(f"Calibration - Index: {index_dir} - {json.dumps(calibration, ensure_ascii=False)}")
+    return calibration
@@ -1,13 +1,19 @@
 import os
 import logging
 from langchain_core.prompts import PromptTemplate
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
 from langchain_ollama import OllamaLLM
+from retrievers import MMRRetriever
 
 
-def setup_search_chain(vectorstore):
-    retriever = vectorstore.as_retriever(search_type="mmr", search_kwargs={"k": 6, "fetch_k": 60, "lambda_mult": 0.8})
+def setup_search_chain(vectorstore, parent_store=None, table_store=None, terms_index=None):
+    if parent_store is not None:
+        # Child chunks of the index are expanded to their parent sections
+        retriever = MMRRetriever(vectorstore=vectorstore, settings={
+            "search_type": "mmr", "k": 6, "fetch_k": 60, "lambda_mult": 0.8, "parent_store": parent_store})
+    else:
+        retriever = vectorstore.as_retriever(search_type="mmr", search_kwargs={"k": 6, "fetch_k": 60, "lambda_mult": 0.8})
     def format_docs(docs):
         formatted_docs = []
         for doc in docs:
@@ -24,6 +30,12 @@ def setup_search_chain(vectorstore):
                 section_refs = ", ".join(sections)
                 content = f"[Разделы: {section_refs}] {content}"
 
+            # Page provenance of parent sections (small-to-big index)
+            if 'page_start' in metadata:
+                pages = metadata['page_start'] if metadata['page_start'] == metadata['page_end'] \
+                    else f"{metadata['page_start']}–{metadata['page_end']}"
+                doc_name = f"{doc_name}, стр. {pages}"
+
             # Add document reference
             content = f"[Документ: {doc_name}]\n{content}"
 
@@ -58,6 +70,19 @@ def setup_search_chain(vectorstore):
         {"context": retriever | format_docs, "question": RunnablePassthrough()}
         | prompt | llm | StrOutputParser()
     )
+    fast_paths = [source for source in (terms_index, table_store) if source is not None]
+    if fast_paths:
+        # Definitions and exact parameter lookups are answered from the index without the LLM
+        llm_chain = search_chain
+
+        def answer_question(question):
+            for source in fast_paths:
+                answer = source.answer(question)
+                if answer is not None:
+                    return answer
+            return llm_chain.invoke(question)
+
+        search_chain = RunnableLambda(answer_question)
     return search_chain
 
 
@@ -0,0 +1,459 @@
+"""Шардированный индекс: поиск по частям в отдельных процессах с объединением результатов.
+
+Монолитный индекс FAISS корпуса целиком загружается в один процесс. Шардированный
+индекс делит документы на N частей при построении; каждая часть - обычный индекс
+FAISS со своим хранилищем разделов (parents.db) в <index_dir>/shard-XX/, состав
+описан в <index_dir>/shards.json. Документ всегда целиком попадает в одну часть:
+
+    document - документы раскладываются по частям с выравниванием объема текста;
+    hash     - часть определяется хэшем имени файла (состав частей стабилен при
+               добавлении документов)
+
+При поиске каждая часть обслуживается своим процессом (в нем только индекс
+части, без модели эмбеддингов). Вектор запроса рассылается всем частям
+параллельно, каждая возвращает fetch_k кандидатов с исходными оценками FAISS и
+векторами, а объединение идет по общей метрике индекса: оценки частей
+переводятся в релевантность той же функцией, что и для монолитного индекса
+(а не нормируются внутри части), и глобальный MMR считается заново по
+объединенным кандидатам - результат совпадает с поиском по одному индексу.
+Часть, которая не ответила за shard_timeout или чей процесс упал, пропускается
+(с предупреждением в логе); упавший процесс перезапускается в фоне, и пока он
+загружается, запросы идут без этой части.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from document_index import DocumentIndex
+from parent_store import ParentStore
+from retrievers import _reconstruct, calibrate_index, faiss_search, mmr_select, relevance_score_fn
+
+SHARDS_FILE = "shards.json"
+SHARD_STRATEGIES = ("document", "hash")
+SHARD_TIMEOUT = 10.0
+RESTART_INTERVAL = 30.0
+
+
+def is_sharded(index_dir):
+    return os.path.exists(os.path.join(index_dir, SHARDS_FILE))
+
+
+def read_manifest(index_dir):
+    with open(os.path.join(index_dir, SHARDS_FILE), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def shard_dir(index_dir, shard):
+    return os.path.join(index_dir, f"shard-{shard:02d}")
+
+
+def assign_shards(documents, num_shards, strategy="document"):
+    """Номер части для каждого документа"""
+    if strategy not in SHARD_STRATEGIES:
+        raise ValueError(f"Неизвестный способ деления на части: {strategy}")
+    if strategy == "hash":
+        return [zlib.crc32(doc["metadata"]["filename"].encode("utf-8")) % num_shards for doc in documents]
+    # Крупные документы первыми - в наименее заполненную часть
+    sizes = [0] * num_shards
+    assignment = [0] * len(documents)
+    for index in sorted(range(len(documents)), key=lambda i: len(documents[i]["content"]), reverse=True):
+        shard = min(range(num_shards), key=sizes.__getitem__)
+        assignment[index] = shard
+        sizes[shard] += len(documents[index]["content"])
+    return assignment
+
+
+def build_sharded_index(documents, index_dir, num_shards, strategy="document", calibrate=False, embedding_model=None):
+    """Строит индекс из num_shards частей; возвращает манифест"""
+    # main импортирует тяжелые модули цепочек, поэтому импорт отложен
+    from main import create_vectorstore
+
+    assignment = assign_shards(documents, num_shards, strategy)
+    manifest = {"num_shards": num_shards, "strategy": strategy, "shards": []}
+    embeddings = None
+    for shard in range(num_shards):
+        shard_documents = [doc for doc, assigned in zip(documents, assignment) if assigned == shard]
+        path = shard_dir(index_dir, shard)
+        entry = {"shard": shard, "path": os.path.basename(path), "documents": len(shard_documents), "chunks": 0}
+        if shard_documents:
+            print(f"Часть {shard + 1}/{num_shards}: {len(shard_documents)} документов")
+            vectorstore = create_vectorstore(shard_documents, path, embedding_model)
+            vectorstore.save_local(path)
+            entry["chunks"] = vectorstore.index.ntotal
+            embeddings = vectorstore.embeddings
+            manifest["distance_strategy"] = vectorstore.distance_strategy.value
+        manifest["shards"].append(entry)
+    os.makedirs(index_dir, exist_ok=True)
+    # Манифест пишется последним: без него папка не считается шардированным индексом
+    with open(os.path.join(index_dir, SHARDS_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    logging.info(f"Sharded index built - {index_dir} - {json.dumps(manifest, ensure_ascii=False)}")
+    if calibrate and embeddings is not None:
+        # Оценки объединенного поиска те же, что у монолитного индекса, поэтому порог общий
+        vectorstore = ShardedVectorStore(index_dir, embeddings)
+        try:
+            calibrate_index(index_dir, vectorstore)
+        finally:
+            vectorstore.close()
+    return manifest
+
+
+def has_index(index_dir):
+    return is_sharded(index_dir) or os.path.exists(os.path.join(index_dir, "index.faiss"))
+
+
+def load_index(index_dir, embeddings):
+    """(хранилище, хранилище разделов) папки индекса: шардированного или обычного FAISS"""
+    if is_sharded(index_dir):
+        vectorstore = ShardedVectorStore(index_dir, embeddings)
+    else:
+        from langchain_community.vectorstores import FAISS
+        vectorstore = FAISS.load_local(index_dir, embeddings, allow_dangerous_deserialization=True)
+        vectorstore.document_index = DocumentIndex.open(index_dir)
+    return vectorstore, open_parent_store(index_dir, vectorstore)
+
+
+def open_parent_store(index_dir, vectorstore):
+    """Хранилище разделов индекса (у шардированного - разделы всех частей)"""
+    if isinstance(vectorstore, ShardedVectorStore):
+        return vectorstore.parent_store
+    return ParentStore.open(index_dir)
+
+
+def index_size(vectorstore):
+    """Число фрагментов в индексе"""
+    if isinstance(vectorstore, ShardedVectorStore):
+        return vectorstore.ntotal
+    return vectorstore.index.ntotal
+
+
+# --- Процесс части ---
+
+class _VectorOnlyEmbeddings(Embeddings):
+    """Процесс части ищет только по готовым векторам"""
+
+    def embed_documents(self, texts):
+        raise RuntimeError("Процесс части индекса не кодирует тексты")
+
+    def embed_query(self, text):
+        raise RuntimeError("Процесс части индекса не кодирует тексты")
+
+
+def _shard_candidates(vectorstore, queries, fetch_k, with_vectors, metadata_filter=None, top_documents=None):
+    """[[(content, metadata, score, vector | None), ...], ...] - fetch_k ближайших для каждого запроса"""
+    scores, indices = faiss_search(vectorstore, queries, fetch_k, metadata_filter, top_documents)
+    vectors = {}
+    if with_vectors:
+        unique_ids = np.unique(indices[indices != -1]).astype(np.int64)
+        if len(unique_ids):
+            vectors = dict(zip(unique_ids.tolist(), _reconstruct(vectorstore.index, unique_ids)))
+    results = []
+    for row_scores, row_indices in zip(scores, indices):
+        row = []
+        for score, i in zip(row_scores, row_indices):
+            if i == -1:
+                continue
+            doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[i])
+            row.append((doc.page_content, doc.metadata, float(score), vectors.get(int(i))))
+        results.append(row)
+    return results
+
+
+def _shard_worker(path, conn):
+    from langchain_community.vectorstores import FAISS
+
+    vectorstore = FAISS.load_local(path, _VectorOnlyEmbeddings(), allow_dangerous_deserialization=True)
+    # Документы части выбираются по центроидам внутри части
+    vectorstore.document_index = DocumentIndex.open(path)
+    parent_store = ParentStore.open(path)
+    conn.send(("ready", vectorstore.index.ntotal))
+    while True:
+        try:
+            op, args = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            if op == "ping":
+                result = vectorstore.index.ntotal
+            elif op == "search":
+                queries, fetch_k, with_vectors, metadata_filter, top_documents = args
+                result = _shard_candidates(vectorstore, np.asarray(queries, dtype=np.float32), fetch_k,
+                                           with_vectors, metadata_filter, top_documents)
+            elif op == "parents":
+                parents = parent_store.get_parents(args) if parent_store else {}
+                result = {parent_id: (doc.page_content, doc.metadata) for parent_id, doc in parents.items()}
+            else:
+                raise ValueError(f"Неизвестная операция {op}")
+            conn.send(("ok", result))
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+
+class _ShardProcess:
+    """Процесс одной части и канал к нему; один запрос к части за раз
+
+    Запросы к части выполняет ее собственный поток: зависшая часть задерживает
+    только очередь запросов к себе, а не запросы к остальным частям.
+    """
+
+    def __init__(self, shard, path, timeout):
+        self.shard = shard
+        self.path = path
+        self.timeout = timeout
+        self.size = 0
+        self._lock = threading.Lock()
+        self._process = None
+        self._conn = None
+        self._last_start = 0.0
+        self._restarting = False
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"index-shard-{shard}")
+
+    def start(self):
+        """Запускает процесс части и ждет загрузки индекса (без блокировки запросов к части)"""
+        context = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(target=_shard_worker, args=(self.path, child_conn),
+                                  name=f"index-shard-{self.shard}", daemon=True)
+        self._last_start = time.monotonic()
+        process.start()
+        child_conn.close()
+        # Загрузка части может занять больше времени, чем обычный запрос
+        if not parent_conn.poll(max(self.timeout, 120.0)):
+            process.terminate()
+            raise TimeoutError(f"часть {self.shard} не загрузилась")
+        status, size = parent_conn.recv()
+        with self._lock:
+            self._stop()
+            if self._closed:
+                process.terminate()
+                return
+            self._process, self._conn, self.size = process, parent_conn, size
+        logging.info(f"Index shard started - {self.path} - {self.size} vectors")
+
+    def _restart_in_background(self):
+        """Перезапуск упавшей части в отдельном потоке (вызывается под self._lock)"""
+        if self._restarting or self._closed:
+            return
+        if self._last_start and time.monotonic() - self._last_start < RESTART_INTERVAL:
+            return
+        self._restarting = True
+        threading.Thread(target=self._restart, name=f"index-shard-{self.shard}-restart", daemon=True).start()
+
+    def _restart(self):
+        try:
+            self.start()
+        except Exception as e:
+            logging.warning(f"Index shard restart failed - {self.path}: {e}")
+        finally:
+            self._restarting = False
+
+    def _stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join(timeout=5)
+        self._process = self._conn = None
+
+    def call(self, op, args):
+        with self._lock:
+            if self._process is None or not self._process.is_alive():
+                # Загрузка части долгая - запрос не ждет ее, а идет без этой части
+                self._stop()
+                self._restart_in_background()
+                raise ConnectionError(f"часть {self.shard} недоступна")
+            try:
+                self._conn.send((op, args))
+                if not self._conn.poll(self.timeout):
+                    raise TimeoutError(f"часть {self.shard} не ответила за {self.timeout} с")
+                status, result = self._conn.recv()
+            except (EOFError, OSError, TimeoutError):
+                # Опоздавший ответ сбил бы порядок в канале - процесс перезапускается
+                self._stop()
+                raise
+        if status != "ok":
+            raise RuntimeError(result)
+        return result
+
+    def submit(self, op, args):
+        """Ставит запрос в очередь потока части; Future с результатом call"""
+        return self._executor.submit(self.call, op, args)
+
+    def close(self):
+        # Оставшиеся в очереди запросы быстро завершатся ошибкой: процесс части остановлен
+        self._executor.shutdown(wait=False)
+        with self._lock:
+            self._closed = True
+            self._stop()
+
+    def __del__(self):
+        # Старый снимок индекса после горячей замены освобождает процессы частей
+        self._stop()
+        self._executor.shutdown(wait=False)
+
+
+class ShardedVectorStore(VectorStore):
+    """Шардированный индекс с интерфейсом хранилища LangChain (только чтение)"""
+
+    def __init__(self, index_dir, embeddings, shard_timeout=SHARD_TIMEOUT):
+        self.index_dir = index_dir
+        self._embeddings = embeddings
+        self.manifest = read_manifest(index_dir)
+        self.distance_strategy = self.manifest.get("distance_strategy", "EUCLIDEAN_DISTANCE")
+        self.shard_timeout = shard_timeout
+        self.shards = [
+            _ShardProcess(entry["shard"], os.path.join(index_dir, entry["path"]), shard_timeout)
+            for entry in self.manifest["shards"] if entry["chunks"]
+        ]
+        self.parent_store = ShardedParentStore(self)
+        self.missing_shards = 0
+        # Части стартуют параллельно, ошибки запуска - как недоступные части при поиске
+        with ThreadPoolExecutor(max_workers=max(len(self.shards), 1), thread_name_prefix="index-shard-start") as pool:
+            list(pool.map(self._warm_up, self.shards))
+
+    @staticmethod
+    def _warm_up(shard):
+        try:
+            shard.start()
+        except Exception as e:
+            logging.warning(f"Index shard unavailable - {shard.path}: {e}")
+
+    @property
+    def embeddings(self):
+        return self._embeddings
+
+    @property
+    def ntotal(self):
+        return sum(shard.size for shard in self.shards)
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError("Шардированный индекс строится main.py --shards")
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError("Шардированный индекс строится main.py --shards")
+
+    def _select_relevance_score_fn(self):
+        return relevance_score_fn(self.distance_strategy)
+
+    def _scatter(self, op, args_for_shard, shards=None):
+        """{номер части: результат} по частям, ответившим за shard_timeout"""
+        shards = self.shards if shards is None else shards
+        futures = {shard.shard: shard.submit(op, args_for_shard(shard)) for shard in shards}
+        # Общий срок на все части: зависшая часть или очередь запросов к ней не задерживают поиск
+        wait(futures.values(), timeout=self.shard_timeout)
+        results = {}
+        for number, future in futures.items():
+            if not future.done():
+                future.cancel()
+                self.missing_shards += 1
+                logging.warning(f"Index shard skipped - {self.index_dir} shard {number}: "
+                                f"no response in {self.shard_timeout}s")
+                continue
+            try:
+                results[number] = future.result()
+            except Exception as e:
+                self.missing_shards += 1
+                logging.warning(f"Index shard skipped - {self.index_dir} shard {number}: {e}")
+        return results
+
+    def _gather(self, queries, fetch_k, with_vectors, metadata_filter=None, top_documents=None):
+        """Объединенные кандидаты всех частей для каждого запроса, лучшие первыми"""
+        relevance = self._select_relevance_score_fn()
+        per_shard = self._scatter("search", lambda shard: (queries, fetch_k, with_vectors, metadata_filter,
+                                                                top_documents))
+        merged = [[] for _ in range(len(queries))]
+        for number, rows in per_shard.items():
+            for row, candidates in enumerate(rows):
+                for content, metadata, score, vector in candidates:
+                    metadata = dict(metadata, shard=number)
+                    if "parent_id" in metadata:
+                        metadata["parent_id"] = f"{number}:{metadata['parent_id']}"
+                    merged[row].append((Document(page_content=content, metadata=metadata), score, vector))
+        return [sorted(row, key=lambda item: relevance(item[1]), reverse=True)[:fetch_k] for row in merged]
+
+    def batch_mmr_search_with_score(self, vectors, k=4, fetch_k=20, lambda_mult=0.5, metadata_filter=None,
+                                    top_documents=None):
+        """Глобальный MMR по кандидатам всех частей (как у retrievers.batch_mmr_search_with_score)"""
+        queries = np.asarray(vectors, dtype=np.float32)
+        if len(queries) == 0:
+            return []
+        merged = self._gather(queries, fetch_k, True, metadata_filter, top_documents)
+        width = max((len(row) for row in merged), default=0)
+        candidate_vectors = np.zeros((len(queries), max(width, 1), queries.shape[1]), dtype=np.float32)
+        valid = np.zeros((len(queries), max(width, 1)), dtype=bool)
+        for row, candidates in enumerate(merged):
+            for column, (_, _, vector) in enumerate(candidates):
+                candidate_vectors[row, column] = vector
+                valid[row, column] = True
+        selected = mmr_select(queries, candidate_vectors, valid, k, lambda_mult)
+        return [
+            [(merged[row][i][0], merged[row][i][1]) for i in picks[picks != -1]]
+            for row, picks in enumerate(selected)
+        ]
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, metadata_filter=None, top_documents=None,
+                                               **kwargs):
+        queries = np.asarray([embedding], dtype=np.float32)
+        return [(doc, score) for doc, score, _ in self._gather(queries, k, False, metadata_filter, top_documents)[0]]
+
+    def max_marginal_relevance_search_with_score_by_vector(self, embedding, k=4, fetch_k=20, lambda_mult=0.5, **kwargs):
+        return self.batch_mmr_search_with_score([embedding], k=k, fetch_k=fetch_k, lambda_mult=lambda_mult)[0]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_with_score_by_vector(self._embeddings.embed_query(query), k=k)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k)]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k=k)]
+
+    def _similarity_search_with_relevance_scores(self, query, k=4, **kwargs):
+        relevance_fn = self._select_relevance_score_fn()
+        return [(doc, relevance_fn(score)) for doc, score in self.similarity_search_with_score(query, k=k)]
+
+    def max_marginal_relevance_search(self, query, k=4, fetch_k=20, lambda_mult=0.5, **kwargs):
+        return self.max_marginal_relevance_search_by_vector(
+            self._embeddings.embed_query(query), k=k, fetch_k=fetch_k, lambda_mult=lambda_mult)
+
+    def max_marginal_relevance_search_by_vector(self, embedding, k=4, fetch_k=20, lambda_mult=0.5, **kwargs):
+        results = self.max_marginal_relevance_search_with_score_by_vector(
+            embedding, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult)
+        return [doc for doc, _ in results]
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+class ShardedParentStore(ParentStore):
+    """Родительские разделы из частей; parent_id вида "<часть>:<id в части>" """
+
+    def __init__(self, vectorstore):
+        self.vectorstore = vectorstore
+
+    def get_parents(self, parent_ids):
+        by_shard = {}
+        for parent_id in parent_ids:
+            number, _, local_id = str(parent_id).partition(":")
+            by_shard.setdefault(int(number), []).append(int(local_id))
+        shards = [shard for shard in self.vectorstore.shards if shard.shard in by_shard]
+        # Без раздела из неответившей части фрагмент останется как есть (см. ParentStore.expand)
+        results = self.vectorstore._scatter("parents", lambda shard: by_shard[shard.shard], shards)
+        parents = {}
+        for number, rows in results.items():
+            for local_id, (content, metadata) in rows.items():
+                parent_id = f"{number}:{local_id}"
+                parents[parent_id] = Document(page_content=content, metadata=dict(metadata, parent_id=parent_id,
+                                                                                  shard=number))
+        return parents
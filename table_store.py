@@ -0,0 +1,270 @@
+"""Таблицы нормативных документов в SQLite для ответов на точные вопросы без LLM.
+
+Классы точности, пределы погрешностей, испытательные напряжения - это таблицы
+стандартов, и вопросы по ним ("Какой предел погрешности для класса точности 0,5?")
+не требуют генерации: нужная строка таблицы и есть ответ. Полная генерация RAG на
+такие вопросы тратит секунды и иногда путает числа соседних строк.
+
+При построении индекса (main.create_vectorstore) таблицы Markdown, которые
+convert_pdfs_to_markdown выводит через fitz find_tables, разбираются на заголовок
+и строки и сохраняются в tables.db рядом с индексом: документ, страница, пункт
+(ближайший номер раздела перед таблицей) и подпись ("Таблица 3 - ...").
+
+TableStore.answer отвечает, только если вопрос похож на точный запрос параметра:
+в нем есть значение-ключ (число или обозначение класса), которое находится в
+строке таблицы, и слова вопроса совпадают с подписью или заголовком таблицы. Если
+в вопросе назван документ (ГОСТ 1983-2001), строки ищутся только в его таблицах. Ответ -
+найденные строки с заголовком и ссылкой на источник; иначе None, и вопрос уходит
+в обычную цепочку с LLM. У шардированного индекса таблицы лежат в каждой части.
+"""
+import glob
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from parent_store import page_at
+from retrievers import DESIGNATION, designation_matches, designations, metadata_matches
+
+TABLE_STORE_FILE = "tables.db"
+
+TABLE_LOOKUP_DEFAULTS = {
+    "min_word_overlap": 2,  # сколько слов вопроса должно совпасть с подписью или заголовком таблицы
+    "max_rows": 3,          # больше подходящих строк - вопрос неоднозначен, отвечает LLM
+}
+
+# Вопросы-рассуждения не подменяются строкой таблицы
+NARRATIVE_MARKERS = [
+    "почему", "зачем", "объясни", "обоснуй", "сравни", "опиши", "расскажи", "проанализируй",
+    "как провод", "как выполн", "в чем разница", "чем отличается",
+]
+
+# Вопросительные и служебные слова не считаются совпадением с таблицей (основы по 5 букв)
+STOP_STEMS = {
+    "какой", "какая", "какое", "какие", "каков", "какую", "каким", "сколь", "чему", "равен", "равна", "равно",
+    "значе", "указа", "устан", "должн", "соотв", "согла", "котор", "также", "или",
+    "для", "при", "что", "это", "его", "над", "под", "без", "где",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tables (
+    table_id INTEGER PRIMARY KEY,
+    metadata TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    clause TEXT,
+    caption TEXT,
+    header TEXT NOT NULL,
+    words TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS table_rows (
+    table_id INTEGER NOT NULL REFERENCES tables(table_id),
+    row_number INTEGER NOT NULL,
+    cells TEXT NOT NULL,
+    PRIMARY KEY (table_id, row_number)
+);
+CREATE TABLE IF NOT EXISTS row_values (
+    value TEXT NOT NULL,
+    table_id INTEGER NOT NULL,
+    row_number INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS row_values_value ON row_values (value);
+"""
+
+_SEPARATOR_ROW = re.compile(r"^\|?\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)*\|?\s*$")
+_CAPTION = re.compile(r"^[#*\s]*(Таблица\s+[\dА-ЯA-Z][\w.]*.*?)[*\s]*$", re.IGNORECASE)
+_CLAUSE = re.compile(r"(?m)^[#*\s]*(\d+(?:\.\d+)+)\.?\s")
+_VALUE = re.compile(r"\d+(?:[.,]\d+)*[a-zа-яё]*")
+_WORD = re.compile(r"[a-zа-яё]{3,}")
+
+
+def _clean_cell(cell):
+    return re.sub(r"\s+", " ", cell.replace("<br>", " ")).strip()
+
+
+def _split_row(line):
+    return [_clean_cell(cell) for cell in line.strip().strip("|").split("|")]
+
+
+def value_tokens(text):
+    """Числа и обозначения (0,5; 0,2S; 10P; 110) с десятичной запятой"""
+    return {re.sub(r"(?<=\d)\.(?=\d)", ",", token) for token in _VALUE.findall(text.lower().replace("ё", "е"))}
+
+
+def word_stems(text):
+    """Основы значимых слов (первые 5 букв) без вопросительных и служебных"""
+    stems = {word[:5] for word in _WORD.findall(text.lower().replace("ё", "е"))}
+    return stems - STOP_STEMS
+
+
+def extract_tables(text, page_offsets=(0,)):
+    """Таблицы Markdown документа: [{page, clause, caption, header, rows}, ...]"""
+    tables = []
+    lines = text.splitlines(keepends=True)
+    offsets, position = [], 0
+    for line in lines:
+        offsets.append(position)
+        position += len(line)
+    i = 0
+    while i < len(lines):
+        if not lines[i].lstrip().startswith("|"):
+            i += 1
+            continue
+        start = i
+        while i < len(lines) and lines[i].lstrip().startswith("|"):
+            i += 1
+        rows = [_split_row(line) for line in lines[start:i] if not _SEPARATOR_ROW.match(line.strip())]
+        if len(rows) < 2:
+            continue
+        header, rows = rows[0], [row for row in rows[1:] if any(row)]
+        # Подпись - строка "Таблица N" в нескольких строках над таблицей
+        caption = None
+        for line in reversed([line.strip() for line in lines[max(0, start - 4):start] if line.strip()]):
+            match = _CAPTION.match(line)
+            if match:
+                caption = match.group(1).strip()
+                break
+        clauses = _CLAUSE.findall(text[:offsets[start]])
+        tables.append({
+            "page": page_at(list(page_offsets), offsets[start]),
+            "clause": clauses[-1] if clauses else None,
+            "caption": caption,
+            "header": header,
+            "rows": rows,
+        })
+    return tables
+
+
+def _markdown_row(cells):
+    return "| " + " | ".join(cell or " " for cell in cells) + " |"
+
+
+class TableStore:
+    """Таблицы документов индекса в SQLite (tables.db; у шардированного индекса - в каждой части)"""
+
+    def __init__(self, db_paths):
+        self.db_paths = list(db_paths)
+        self._local = threading.local()
+        for db_path in self.db_paths:
+            self._connection(db_path).executescript(SCHEMA)
+
+    @classmethod
+    def open(cls, index_dir):
+        """Таблицы индекса или None, если индекс построен без них"""
+        db_path = os.path.join(index_dir, TABLE_STORE_FILE)
+        db_paths = [db_path] if os.path.exists(db_path) else \
+            sorted(glob.glob(os.path.join(index_dir, "shard-*", TABLE_STORE_FILE)))
+        return cls(db_paths) if db_paths else None
+
+    @classmethod
+    def create(cls, index_dir):
+        """Новое пустое хранилище таблиц (старое удаляется)"""
+        os.makedirs(index_dir, exist_ok=True)
+        db_path = os.path.join(index_dir, TABLE_STORE_FILE)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        return cls([db_path])
+
+    def _connection(self, db_path):
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+        if db_path not in connections:
+            connections[db_path] = sqlite3.connect(db_path, timeout=30)
+        return connections[db_path]
+
+    def add_document(self, metadata, content, page_offsets=(0,)):
+        """Разбирает таблицы документа и сохраняет их; возвращает число таблиц"""
+        conn = self._connection(self.db_paths[0])
+        tables = extract_tables(content, page_offsets)
+        for table in tables:
+            words = word_stems(" ".join([table["caption"] or ""] + table["header"]))
+            cursor = conn.execute(
+                "INSERT INTO tables (metadata, page, clause, caption, header, words) VALUES (?, ?, ?, ?, ?, ?)",
+                (json.dumps(metadata, ensure_ascii=False), table["page"], table["clause"], table["caption"],
+                 json.dumps(table["header"], ensure_ascii=False), json.dumps(sorted(words), ensure_ascii=False)),
+            )
+            for row_number, cells in enumerate(table["rows"]):
+                conn.execute("INSERT INTO table_rows (table_id, row_number, cells) VALUES (?, ?, ?)",
+                             (cursor.lastrowid, row_number, json.dumps(cells, ensure_ascii=False)))
+                conn.executemany("INSERT INTO row_values (value, table_id, row_number) VALUES (?, ?, ?)",
+                                 [(value, cursor.lastrowid, row_number) for value in value_tokens(" ".join(cells))])
+        return len(tables)
+
+    def commit(self):
+        self._connection(self.db_paths[0]).commit()
+
+    def _candidate_rows(self, db_path, values):
+        """Строки, содержащие хотя бы одно значение вопроса, с их таблицами"""
+        placeholders = ", ".join("?" for _ in values)
+        return self._connection(db_path).execute(
+            f"SELECT t.table_id, t.metadata, t.page, t.clause, t.caption, t.header, t.words, r.row_number, r.cells "
+            f"FROM (SELECT DISTINCT table_id, row_number FROM row_values WHERE value IN ({placeholders})) v "
+            f"JOIN tables t ON t.table_id = v.table_id "
+            f"JOIN table_rows r ON r.table_id = v.table_id AND r.row_number = v.row_number",
+            sorted(values),
+        ).fetchall()
+
+    def lookup(self, question, metadata_filter=None, **kwargs):
+        """Лучшие строки таблиц для точного вопроса: [(таблица, [строки])] или [] (вопрос не табличный)"""
+        params = dict(TABLE_LOOKUP_DEFAULTS)
+        params.update(kwargs)
+        lowered = question.lower()
+        if any(marker in lowered for marker in NARRATIVE_MARKERS):
+            return []
+        # Обозначения документов (ГОСТ 7746-2015) - не значения параметров, а выбор документа
+        values, words = value_tokens(DESIGNATION.sub(" ", question)), word_stems(question)
+        if not values:
+            return []
+        wanted = designations(question)
+
+        best_score, matches = None, {}
+        for db_path in self.db_paths:
+            for table_id, metadata, page, clause, caption, header, table_words, row_number, cells in \
+                    self._candidate_rows(db_path, values):
+                metadata = json.loads(metadata)
+                if metadata_filter and not metadata_matches(metadata, metadata_filter):
+                    continue
+                if wanted and not designation_matches(metadata, wanted):
+                    continue
+                cells, header = json.loads(cells), json.loads(header)
+                row_values = value_tokens(" ".join(cells))
+                # Все значения вопроса - в строке или в подписи и заголовке (например, "при 50 Гц")
+                if values - row_values - value_tokens(" ".join([caption or ""] + header)):
+                    continue
+                overlap = len(words & set(json.loads(table_words)))
+                if overlap < params["min_word_overlap"]:
+                    continue
+                # Значение в первой (ключевой) колонке важнее совпадения в ячейке с нормой
+                score = (len(values & row_values), len(values & value_tokens(cells[0] if cells else "")), overlap)
+                if best_score is not None and score < best_score:
+                    continue
+                if best_score is None or score > best_score:
+                    best_score, matches = score, {}
+                table = {"db_path": db_path, "table_id": table_id, "metadata": metadata, "page": page,
+                         "clause": clause, "caption": caption, "header": header}
+                matches.setdefault((db_path, table_id), (table, []))[1].append(cells)
+
+        if not matches or sum(len(rows) for _, rows in matches.values()) > params["max_rows"]:
+            return []
+        return list(matches.values())
+
+    def answer(self, question, metadata_filter=None, **kwargs):
+        """Ответ из таблиц (строки с заголовком и источником) или None - тогда отвечает LLM"""
+        found = self.lookup(question, metadata_filter, **kwargs)
+        if not found:
+            return None
+        parts = []
+        for table, rows in found:
+            doc_name = table["metadata"].get("filename", "Unknown").replace(".pdf", "").replace("_", " ").strip()
+            source = [doc_name]
+            if table["clause"]:
+                source.append(f"п. {table['clause']}")
+            if table["caption"]:
+                source.append(table["caption"])
+            source.append(f"стр. {table['page']}")
+            lines = [_markdown_row(table["header"]), _markdown_row(["---"] * len(table["header"]))]
+            lines.extend(_markdown_row(cells) for cells in rows)
+            parts.append(f"Источник: {', '.join(source)}\n\n" + "\n".join(lines))
+        return "\n\n".join(parts) + "\n\n(Ответ взят из таблицы документа без генерации.)"
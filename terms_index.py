@@ -0,0 +1,212 @@
+"""Словарь терминов из разделов "Термины и определения" для ответов без LLM.
+
+В каждом ГОСТ есть раздел "Термины и определения", а вопросы "что такое ..." -
+большая доля обращений. Ответ на них - дословный текст определения, поэтому MMR и
+генерация 8B для них не нужны.
+
+При построении индекса (main.create_vectorstore) раздел терминов каждого документа
+разбирается на статьи вида "3.1 трансформатор тока: Трансформатор, в котором ...";
+статья (дословный текст, пункт, страница, документ) сохраняется в terms.json рядом
+с индексом под ключом из лемм термина. Леммы дает pymorphy3, если он установлен
+(pip install pymorphy3), иначе - отсечение типичных окончаний, так что "под
+трансформатором тока" и "трансформатор тока" дают один ключ. Ключ вопроса
+ищется точно, затем нечетко (difflib) - опечатки и варианты написания не мешают.
+
+TermsIndex.answer отвечает только на вопросы об определении ("что такое X",
+"что означает X", "определение X") и цитирует статью дословно со ссылкой на
+источник; для остальных вопросов - None, и вопрос уходит в цепочку с LLM. Если в
+вопросе назван документ ("что такое X по ГОСТ 1983-2001"), статья берется только из
+него; нет термина в этом документе - отвечает LLM.
+"""
+import difflib
+import glob
+import json
+import logging
+import os
+import re
+
+from parent_store import page_at
+from retrievers import designation_matches, designations, metadata_matches
+
+TERMS_INDEX_FILE = "terms.json"
+
+TERMS_DEFAULTS = {
+    "fuzzy_cutoff": 0.85,  # минимальное сходство ключей для нечеткого совпадения (difflib)
+    "max_sources": 3,      # сколько документов с одним термином цитировать
+}
+
+# Заголовок раздела терминов и начало следующего раздела верхнего уровня
+_SECTION_HEADING = re.compile(r"(?m)^[#*\s]*(\d+)\s*\.?\s*\**\s*Термины(?:,)?\s+(?:и\s+)?(?:определения|сокращения)")
+_TOP_SECTION = re.compile(r"(?m)^[#*\s]*(\d+)\s*\.?\s+\**[А-ЯЁ]")
+# Статья: номер, термин (может быть выделен), необязательный английский эквивалент, двоеточие
+_ENTRY = re.compile(r"(?m)^[#*\s]*(\d+\.\d+(?:\.\d+)*)\.?\s+\**([^:\n]{2,150}?)\**\s*(?:\([^)\n]*\))?\s*:\s*\S")
+# Вопросы об определении: термин - в группе term
+_DEFINITION_QUESTIONS = [
+    re.compile(r"^\s*(?:а\s+)?что\s+(?:такое|означает|значит|называется|называют|понимается\s+под)\s+(?P<term>.+?)\s*\??\s*$",
+               re.IGNORECASE),
+    re.compile(r"^\s*(?:дай(?:те)?\s+|приведи(?:те)?\s+)?определение\s+(?:термина\s+|понятия\s+)?(?P<term>.+?)\s*\??\s*$",
+               re.IGNORECASE),
+    re.compile(r"^\s*(?P<term>.+?)\s*(?:-|—|–)\s*это\s+что\s*\??\s*$", re.IGNORECASE),
+]
+
+# Окончания для отсечения без pymorphy3 (длинные первыми)
+_ENDINGS = sorted("""ами ями ого его ому ему ыми ими ой ей ий ый ая яя ое ее ые ие ом ем ам ям ах ях ов ев ью
+                     а я о е ы и у ю ь""".split(), key=len, reverse=True)
+
+_morph = None
+_morph_checked = False
+
+
+def _analyzer():
+    """MorphAnalyzer pymorphy3 или None, если он не установлен"""
+    global _morph, _morph_checked
+    if not _morph_checked:
+        _morph_checked = True
+        try:
+            import pymorphy3
+            _morph = pymorphy3.MorphAnalyzer()
+        except ImportError:
+            logging.info("pymorphy3 не установлен - ключи терминов по отсечению окончаний")
+    return _morph
+
+
+def _lemma(word):
+    morph = _analyzer()
+    if morph is not None:
+        return morph.parse(word)[0].normal_form.replace("ё", "е")
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def term_key(text):
+    """Ключ термина: леммы слов через пробел (регистр, ё и пунктуация не важны)"""
+    words = re.findall(r"[a-zа-яё0-9]+", text.lower().replace("ё", "е"))
+    return " ".join(_lemma(word) for word in words)
+
+
+def definition_term(question):
+    """(термин, обозначения документов) из вопроса об определении или (None, []), если вопрос не об определении"""
+    for pattern in _DEFINITION_QUESTIONS:
+        match = pattern.match(question.strip())
+        if match:
+            term = match.group("term").strip(" \"'«»")
+            # "что такое X в ГОСТ ..." - уточнение документа не входит в термин, а выбирает документ
+            parts = re.split(r"\s+(?:по|в|согласно)\s+(?=гост|сп|ту|стандарт)", term, maxsplit=1, flags=re.IGNORECASE)
+            return parts[0] or None, (designations(parts[1]) if len(parts) > 1 else [])
+    return None, []
+
+
+def _section_terms(text, heading, page_offsets):
+    section_number = heading.group(1)
+    end = len(text)
+    for match in _TOP_SECTION.finditer(text, heading.end()):
+        if match.group(1) != section_number:
+            end = match.start()
+            break
+    section = text[heading.end():end]
+    entries = list(_ENTRY.finditer(section))
+    terms = []
+    for i, match in enumerate(entries):
+        if not match.group(1).startswith(section_number + "."):
+            continue
+        entry_end = entries[i + 1].start() if i + 1 < len(entries) else len(section)
+        terms.append({
+            "term": re.sub(r"[*_]", "", match.group(2)).strip(),
+            "clause": match.group(1),
+            "page": page_at(list(page_offsets), heading.end() + match.start()),
+            "text": section[match.start():entry_end].strip().lstrip("#* "),
+        })
+    return terms
+
+
+def extract_terms(text, page_offsets=(0,)):
+    """Статьи раздела "Термины и определения": [{term, clause, page, text}, ...]"""
+    # Заголовок встречается и в содержании - берется вхождение с наибольшим числом статей
+    candidates = [_section_terms(text, heading, page_offsets) for heading in _SECTION_HEADING.finditer(text)]
+    return max(candidates, key=len, default=[])
+
+
+class TermsIndex:
+    """Термины документов индекса: {ключ из лемм: [статьи]} в terms.json"""
+
+    def __init__(self, entries=None, path=None):
+        self.path = path
+        self.entries = {}
+        for entry in entries or []:
+            # Ключ считается заново: словарь мог быть построен без pymorphy3, а читаться с ним
+            self.entries.setdefault(term_key(entry["term"]), []).append(entry)
+
+    @classmethod
+    def open(cls, index_dir):
+        """Термины индекса (у шардированного - всех частей) или None, если индекс построен без них"""
+        path = os.path.join(index_dir, TERMS_INDEX_FILE)
+        paths = [path] if os.path.exists(path) else sorted(glob.glob(os.path.join(index_dir, "shard-*", TERMS_INDEX_FILE)))
+        if not paths:
+            return None
+        entries = []
+        for path in paths:
+            with open(path, "r", encoding="utf-8") as f:
+                entries.extend(json.load(f)["terms"])
+        return cls(entries)
+
+    @classmethod
+    def create(cls, index_dir):
+        """Новый пустой словарь; save() записывает его в папку индекса"""
+        return cls(path=os.path.join(index_dir, TERMS_INDEX_FILE))
+
+    @property
+    def size(self):
+        return sum(len(entries) for entries in self.entries.values())
+
+    def add_document(self, metadata, content, page_offsets=(0,)):
+        """Разбирает раздел терминов документа; возвращает число статей"""
+        terms = extract_terms(content, page_offsets)
+        for term in terms:
+            self.entries.setdefault(term_key(term["term"]), []).append(dict(term, metadata=metadata))
+        return len(terms)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump({"terms": [entry for entries in self.entries.values() for entry in entries]},
+                      f, ensure_ascii=False, indent=1)
+
+    def lookup(self, term, metadata_filter=None, documents=None, **kwargs):
+        """Статьи термина: точное совпадение ключа, затем ближайший ключ (difflib).
+
+        documents - обозначения документов (retrievers.designations): статьи только из них.
+        """
+        params = dict(TERMS_DEFAULTS)
+        params.update(kwargs)
+        entries = self.entries
+        if metadata_filter or documents:
+            # Нечеткий поиск - только среди терминов подходящих документов
+            entries = {}
+            for key, items in self.entries.items():
+                items = [entry for entry in items
+                         if (not metadata_filter or metadata_matches(entry["metadata"], metadata_filter))
+                         and (not documents or designation_matches(entry["metadata"], documents))]
+                if items:
+                    entries[key] = items
+        key = term_key(term)
+        keys = [key] if key in entries else \
+            difflib.get_close_matches(key, list(entries), n=1, cutoff=params["fuzzy_cutoff"])
+        found = [entry for key in keys for entry in entries[key]]
+        return found[:params["max_sources"]]
+
+    def answer(self, question, metadata_filter=None, **kwargs):
+        """Дословное определение со ссылкой на источник или None - тогда отвечает LLM"""
+        term, documents = definition_term(question)
+        if term is None:
+            return None
+        found = self.lookup(term, metadata_filter, documents, **kwargs)
+        if not found:
+            return None
+        parts = []
+        for entry in found:
+            doc_name = entry["metadata"].get("filename", "Unknown").replace(".pdf", "").replace("_", " ").strip()
+            quote = "\n".join(f"> {line}" if line.strip() else ">" for line in entry["text"].splitlines())
+            parts.append(f"Источник: {doc_name}, п. {entry['clause']}, стр. {entry['page']}\n\n{quote}")
+        return "\n\n".join(parts) + "\n\n(Определение приведено дословно из документа без генерации.)"
@@ -0,0 +1,208 @@
+"""Генерация ТТ по разделам: отдельный поиск на каждый раздел и параллельная генерация.
+
+Вместо одной длинной генерации всех семи разделов по общему контексту k=10
+для каждого раздела выполняется свой поиск (запросы всех разделов кодируются
+одной пачкой), разделы генерируются одновременно в пределах общего пула
+потоков и собираются по порядку. Любой раздел можно перегенерировать, не
+повторяя остальные: найденный контекст запоминается для последних запросов.
+
+С merge_vectorstore (нормативный индекс, включается TT_MERGE_NORMATIVE=1)
+контекст разделов собирается из обоих корпусов: поиски в индексе ТТ и в
+нормативном идут параллельно, фрагменты объединяются по релевантности.
+"""
+import logging
+import threading
+import concurrent.futures
+from collections import OrderedDict
+
+from langchain_core.prompts import PromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from langchain_ollama import OllamaLLM
+
+from answer_cache import ACTIVITY
+from chain_factory import TT_DEFAULTS, format_docs
+from retrievers import batch_scored_search, batch_search
+
+# Разделы ТТ и уточнения для поиска контекста по каждому из них
+TT_SECTIONS = [
+    ("Общие положения", "область применения, назначение, условия эксплуатации, термины"),
+    ("Технические характеристики", "номинальные параметры, характеристики, классы точности, допустимые значения"),
+    ("Требования к материалам", "материалы, изоляция, магнитопровод, обмотки, конструкция"),
+    ("Процесс производства/испытаний", "испытания, методы испытаний, порядок проведения, схемы измерений"),
+    ("Нормы контроля качества", "контроль качества, приемка, приемо-сдаточные и периодические испытания, допуски"),
+    ("Упаковка и маркировка", "упаковка, маркировка, транспортирование, хранение, паспорт"),
+    ("Ссылки на нормы", "нормативные ссылки, стандарты, ГОСТ, СП"),
+]
+
+# Общий бюджет одновременных генераций разделов для всех пользователей
+SECTION_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="tt-section")
+# Параллельные поиски по индексу ТТ и нормативному при объединении контекста
+SEARCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="tt-search")
+MERGE_NORMATIVE_ENV = "TT_MERGE_NORMATIVE"
+
+SECTION_TEMPLATE = """Ты инженер-технолог, специализирующийся на создании технических требований (ТТ) на основе нормативных документов.
+
+Ты пишешь ОДИН раздел технических требований: "{number}. {heading}".
+Другие разделы пишутся отдельно - НЕ повторяй их содержание и НЕ пиши другие разделы.
+
+КРИТИЧЕСКИ ВАЖНЫЕ ПРАВИЛА:
+- ОТВЕЧАЙ ТОЛЬКО НА РУССКОМ ЯЗЫКЕ - ЗАПРЕЩЕНЫ ответы на английском или других языках
+- ЗАПРЕЩЕНО добавлять в ответ текст о скачивании, экспорте или форматировании в Word - это обрабатывается системой автоматически
+- Используй точные термины из контекста нормативных документов
+- Ссылайся на конкретные пункты и разделы документов
+- Если информации недостаточно, укажи это и используй общепринятые стандарты
+- Будь конкретен и измеряем
+- Начни ответ с заголовка "{number}. {heading}", подпункты нумеруй {number}.1, {number}.2 и т.д.
+
+Контекст из нормативных документов:
+{context}
+
+Запрос: {question}
+
+Раздел "{number}. {heading}" ТОЛЬКО НА РУССКОМ ЯЗЫКЕ:"""
+
+
+class SectionedTTEngine:
+    """Генератор ТТ по разделам, совместимый с цепочками по методу invoke()"""
+
+    def __init__(self, vectorstore, sections=None, retrieval_cache_size=16, merge_vectorstore=None,
+                 merge_parent_store=None, **kwargs):
+        settings = dict(TT_DEFAULTS)
+        settings.update({"k": 5, "fetch_k": 20})
+        settings.update(kwargs)
+        self.settings = settings
+        self.vectorstore = vectorstore
+        # Второй корпус для контекста разделов (со своим хранилищем разделов)
+        self.merge_vectorstore = merge_vectorstore if merge_vectorstore is not vectorstore else None
+        self.merge_settings = dict(settings, parent_store=merge_parent_store)
+        self.sections = list(sections or TT_SECTIONS)
+        llm = OllamaLLM(model=settings["model"], temperature=settings["temperature"])
+        prompt = PromptTemplate(
+            template=SECTION_TEMPLATE,
+            input_variables=["number", "heading", "context", "question"]
+        )
+        self.section_chain = prompt | llm | StrOutputParser()
+        self._retrieval_cache = OrderedDict()
+        self._retrieval_cache_size = retrieval_cache_size
+        self._cache_lock = threading.Lock()
+
+    def section_queries(self, question):
+        return [f"{question}. {heading}: {hint}" for heading, hint in self.sections]
+
+    def retrieve(self, question):
+        """Контекст для каждого раздела; запросы всех разделов кодируются одной пачкой"""
+        with self._cache_lock:
+            if question in self._retrieval_cache:
+                self._retrieval_cache.move_to_end(question)
+                return self._retrieval_cache[question]
+
+        queries = self.section_queries(question)
+        if self.merge_vectorstore is None:
+            vectors = self.vectorstore.embeddings.embed_documents(queries)
+            contexts = batch_search(self.vectorstore, vectors, self.settings)
+        else:
+            contexts = self._merged_search(queries)
+
+        with self._cache_lock:
+            self._retrieval_cache[question] = contexts
+            while len(self._retrieval_cache) > self._retrieval_cache_size:
+                self._retrieval_cache.popitem(last=False)
+        return contexts
+
+    @staticmethod
+    def _scored_search(vectorstore, queries, settings):
+        vectors = vectorstore.embeddings.embed_documents(queries)
+        return batch_scored_search(vectorstore, vectors, settings)
+
+    def _merged_search(self, queries):
+        """Контекст разделов из обоих индексов: k самых релевантных фрагментов на раздел"""
+        futures = [
+            SEARCH_EXECUTOR.submit(self._scored_search, self.vectorstore, queries, self.settings),
+            SEARCH_EXECUTOR.submit(self._scored_search, self.merge_vectorstore, queries, self.merge_settings),
+        ]
+        results = [future.result() for future in futures]
+        contexts = []
+        for rows in zip(*results):
+            merged, seen = [], set()
+            for doc, _ in sorted((item for row in rows for item in row), key=lambda item: item[1], reverse=True):
+                if doc.page_content not in seen:
+                    seen.add(doc.page_content)
+                    merged.append(doc)
+            contexts.append(merged[:self.settings["k"]])
+        return contexts
+
+    def generate_section(self, question, index, docs=None, should_stop=None):
+        """Генерирует один раздел (index с нуля).
+
+        С should_stop генерация идет потоком и прерывается, как только should_stop()
+        вернет True; тогда возвращается None.
+        """
+        if docs is None:
+            docs = self.retrieve(question)[index]
+        heading, _ = self.sections[index]
+        inputs = {
+            "number": index + 1,
+            "heading": heading,
+            "context": format_docs(docs),
+            "question": question,
+        }
+        if should_stop is None:
+            return self.section_chain.invoke(inputs).strip()
+        pieces = []
+        for piece in self.section_chain.stream(inputs):
+            if should_stop():
+                return None
+            pieces.append(piece)
+        return "".join(pieces).strip()
+
+    def stream_sections(self, question):
+        """Генерирует разделы параллельно и отдает (index, heading, text) по мере готовности"""
+        # Прогрев кэша ответов (cache_warmer.py) уступает генерации ТТ
+        with ACTIVITY.request():
+            yield from self._stream_sections(question)
+
+    def _stream_sections(self, question):
+        contexts = self.retrieve(question)
+        futures = {
+            SECTION_EXECUTOR.submit(self.generate_section, question, index, docs): index
+            for index, docs in enumerate(contexts)
+        }
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                index = futures[future]
+                heading, _ = self.sections[index]
+                try:
+                    text = future.result()
+                except Exception as e:
+                    logging.error(f"TT section {index + 1} ({heading}) generation error: {e}")
+                    text = f"{index + 1}. {heading}\nОшибка при генерации раздела: {e}"
+                yield index, heading, text
+        finally:
+            # Если потребитель прервал итерацию, не тратим LLM на ненужные разделы
+            for future in futures:
+                future.cancel()
+
+    def assemble(self, texts):
+        """Собирает разделы в порядке структуры ТТ; отсутствующие помечаются"""
+        parts = []
+        for index, (heading, _) in enumerate(self.sections):
+            text = texts.get(index) if isinstance(texts, dict) else texts[index]
+            parts.append(text if text else f"{index + 1}. {heading}\n(раздел генерируется...)")
+        return "\n\n".join(parts)
+
+    def generate(self, question):
+        """Все разделы: словарь index -> текст"""
+        return {index: text for index, _, text in self.stream_sections(question)}
+
+    def invoke(self, question):
+        return self.assemble(self.generate(question))
+
+    def regenerate_section(self, question, index, texts, should_stop=None):
+        """Перегенерирует один раздел и возвращает обновленный словарь разделов (None, если прервано)"""
+        updated = dict(texts)
+        with ACTIVITY.request():
+            text = self.generate_section(question, index, should_stop=should_stop)
+        if text is None:
+            return None
+        updated[index] = text
+        return updated
@@ -5,10 +5,16 @@ from langchain_core.prompts import PromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
 from langchain_ollama import OllamaLLM
+from retrievers import MMRRetriever
 
 
-def setup_tt_chain(vectorstore):
-    retriever = vectorstore.as_retriever(search_type="mmr", search_kwargs={"k": 10, "lambda_mult": 0.6})
+def setup_tt_chain(vectorstore, parent_store=None):
+    if parent_store is not None:
+        # Child chunks of the index are expanded to their parent sections
+        retriever = MMRRetriever(vectorstore=vectorstore, settings={
+            "search_type": "mmr", "k": 10, "fetch_k": 20, "lambda_mult": 0.6, "parent_store": parent_store})
+    else:
+        retriever = vectorstore.as_retriever(search_type="mmr", search_kwargs={"k": 10, "lambda_mult": 0.6})
     def format_docs(docs):
         return "\n\n".join(doc.page_content for doc in docs)
     llm = OllamaLLM(model="qwen3:8b", temperature=0)
@@ -1,11 +1,18 @@
 import streamlit as st
-import json
-import os
 from datetime import datetime
+from functools import lru_cache
 from io import BytesIO
 from docx import Document
 from docx.shared import Inches
 from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+from cache_warmer import CacheWarmer
+from chat_store import ChatStore
+from collection_registry import CollectionCache
+from index_manager import IndexManager
+from retrieval_worker import create_query_embeddings, worker_address
+from job_queue import JobManager
+
+EMBEDDING_MODEL = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
 
 
 def load_css():
@@ -419,43 +426,73 @@ def apply_theme():
     """, unsafe_allow_html=True)
 
 
-def load_chat_history():
-    """Load chat history from JSON file"""
-    if os.path.exists("chat_history.json"):
-        try:
-            with open("chat_history.json", "r", encoding="utf-8") as f:
-                data = json.load(f)
-                # Ensure required keys exist
-                if "chats" not in data:
-                    data["chats"] = {}
-                if "current_chat_id" not in data:
-                    data["current_chat_id"] = None
-                return data
-        except Exception as e:
-            st.error(f"Ошибка загрузки истории чатов: {e}")
-    return {"chats": {}, "current_chat_id": None}
-
-
-def save_chat_history(chat_data):
-    """Save chat history to JSON file"""
+@st.cache_resource
+def get_chat_store():
+    """Shared SQLite chat store (one per server process)"""
+    return ChatStore()
+
+
+@st.cache_resource
+def get_embeddings(model_name=EMBEDDING_MODEL):
+    """Shared embedding model; concurrent sessions' queries are encoded in micro-batches.
+
+    With RETRIEVAL_WORKER set, queries are encoded by the retrieval worker process
+    and no model is loaded here.
+    """
+    return create_query_embeddings(model_name)
+
+
+@st.cache_resource
+def get_index_manager(_loader):
+    """Shared index snapshot; corpus changes are rebuilt in the background and swapped in.
+
+    With a retrieval worker the worker rebuilds indexes; here new versions are only picked up.
+    """
+    return IndexManager(_loader, watch_corpus=not worker_address()).start()
+
+
+@st.cache_resource
+def get_collection_cache(_embeddings, _index_manager):
+    """Shared cache of registry collections: indexes load on first use and are evicted under a memory budget"""
+    return CollectionCache(_embeddings, index_manager=_index_manager)
+
+
+@st.cache_resource
+def get_cache_warmer(_index_manager):
+    """Shared background warmer: frequent questions are answered into the answer cache while no one is asking"""
+    return CacheWarmer(_index_manager).start()
+
+
+@st.cache_resource
+def get_job_manager():
+    """Shared background job manager (worker threads live in the server process)"""
+    return JobManager()
+
+
+@lru_cache(maxsize=4096)
+def _message_html(role, content, time_label):
+    message_class = "user" if role == "user" else "assistant"
+    avatar_class = "user-avatar" if role == "user" else "assistant-avatar"
+    avatar_text = "U" if role == "user" else "AI"
+    return f"""
+    <div class="chat-message {message_class}">
+        <div class="message-avatar {avatar_class}">{avatar_text}</div>
+        <div class="message-content">
+            {content.replace(chr(10), '<br>')}
+            <div class="message-time">{time_label}</div>
+        </div>
+    </div>
+    """
+
+
+def render_message_html(message):
+    """Render a chat message to HTML (cached per message across reruns)"""
+    created_at = message.get("created_at")
     try:
-        with open("chat_history.json", "w", encoding="utf-8") as f:
-            json.dump(chat_data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        st.error(f"Ошибка сохранения истории чатов: {e}")
-
-
-def create_new_chat():
-    """Create a new chat session"""
-    chat_id = f"chat_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-    chat = {
-        "id": chat_id,
-        "title": "Новый чат",
-        "messages": [],
-        "created_at": datetime.now().isoformat(),
-        "updated_at": datetime.now().isoformat()
-    }
-    return chat_id, chat
+        time_label = datetime.fromisoformat(created_at).strftime("%H:%M") if created_at else ""
+    except ValueError:
+        time_label = ""
+    return _message_html(message["role"], message["content"], time_label)
 
 
 def update_chat_title(chat_id, messages):